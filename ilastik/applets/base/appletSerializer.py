@@ -13,11 +13,14 @@ import vigra
 import h5py
 import numpy
 import warnings
+import collections
+from functools import partial
 
 from lazyflow.roi import TinyVector, roiToSlice, sliceToRoi
 from lazyflow.rtype import SubRegion
 from lazyflow.slot import OutputSlot
 from lazyflow.utility import Timer, timeLogged
+from lazyflow.request import Request
 
 #######################
 # Convenience methods #
@@ -344,12 +347,20 @@ class SerialListSlot(SerialSlot):
 
 class SerialBlockSlot(SerialSlot):
     """A slot which only saves nonzero blocks."""
+
+    #: Number of blocks that are requested ahead of the block currently being written.
+    ParallelBlocks = 8
+
     def __init__(self, slot, inslot, blockslot, name=None, subname=None,
-                 default=None, depends=None, selfdepends=True, shrink_to_bb=False):
+                 default=None, depends=None, selfdepends=True, shrink_to_bb=False,
+                 compression=None, compression_opts=None):
         """
         :param blockslot: provides non-zero blocks.
         :param shrink_to_bb: If true, reduce each block of data from the slot to  
                              its nonzero bounding box before feeding saving it.
+        :param compression: h5py compression filter for the block datasets
+                            ('gzip' or 'lzf'), or None to store them uncompressed.
+        :param compression_opts: options for the compression filter (e.g. the gzip level)
 
         """
         super(SerialBlockSlot, self).__init__(
@@ -358,6 +369,28 @@ class SerialBlockSlot(SerialSlot):
         self.blockslot = blockslot
         self._bind(slot)
         self._shrink_to_bb = shrink_to_bb
+        self._compression = compression
+        self._compression_opts = compression_opts
+
+    def _fetchBlock(self, index, slicing):
+        """Request one block of data (runs in a worker thread).
+        Returns the slicing and data to store."""
+        block = self.slot[index][slicing].wait()
+
+        if self._shrink_to_bb:
+            nonzero_coords = numpy.nonzero(block)
+            if len(nonzero_coords[0]) > 0:
+                block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
+                block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
+                block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
+                block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
+                bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
+                bounding_box_roi += block_start
+                
+                # Overwrite the vars that are written to the file
+                slicing = roiToSlice(*bounding_box_roi)
+                block = block[block_slicing]
+        return slicing, block
 
     @timeLogged(logger, logging.DEBUG)
     def _serialize(self, group, name, slot):
@@ -367,25 +400,28 @@ class SerialBlockSlot(SerialSlot):
             subname = self.subname.format(index)
             subgroup = mygroup.create_group(subname)
             nonZeroBlocks = self.blockslot[index].value
-            for blockIndex, slicing in enumerate(nonZeroBlocks):
-                block = self.slot[index][slicing].wait()
-                blockName = 'block{:04d}'.format(blockIndex)
 
-                if self._shrink_to_bb:
-                    nonzero_coords = numpy.nonzero(block)
-                    if len(nonzero_coords[0]) > 0:
-                        block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
-                        block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
-                        block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
-                        block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
-                        bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
-                        bounding_box_roi += block_start
-                        
-                        # Overwrite the vars that are written to the file
-                        slicing = roiToSlice(*bounding_box_roi)
-                        block = block[block_slicing]
-
-                subgroup.create_dataset(blockName, data=block)
+            # Keep a window of block requests running in the background,
+            #  so fetching the next blocks overlaps with writing the current one.
+            blockRequests = ( Request( partial(self._fetchBlock, index, slicing) )
+                              for slicing in nonZeroBlocks )
+            pending = collections.deque()
+            for blockIndex in range(len(nonZeroBlocks)):
+                while len(pending) < self.ParallelBlocks:
+                    req = next(blockRequests, None)
+                    if req is None:
+                        break
+                    req.submit()
+                    pending.append( req )
+
+                slicing, block = pending.popleft().wait()
+                blockName = 'block{:04d}'.format(blockIndex)
+                if self._compression is None:
+                    subgroup.create_dataset(blockName, data=block)
+                else:
+                    subgroup.create_dataset(blockName, data=block, chunks=True,
+                                            compression=self._compression,
+                                            compression_opts=self._compression_opts)
                 subgroup[blockName].attrs['blockSlice'] = slicingToString(slicing)
 
     def _deserialize(self, mygroup, slot):
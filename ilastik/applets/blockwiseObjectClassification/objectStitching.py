@@ -0,0 +1,154 @@
+"""
+Stitching of objects that cross block boundaries.
+
+Each block is labeled independently (see labelBlock()). The labels on
+the faces of adjacent blocks are then matched to build a union-find
+over all block-local objects, and the per-block RegionStatistics are
+merged into one set of statistics per stitched object.
+"""
+import numpy
+import vigra
+
+from ilastik.applets.objectExtraction.regionStatistics import RegionStatistics
+
+def labelBlock(binary):
+    """Connected components of a 2D or 3D binary block (background is 0)."""
+    binary = numpy.asarray(binary, dtype=numpy.uint8)
+    if binary.ndim == 2:
+        return numpy.asarray( vigra.analysis.labelImageWithBackground(binary) )
+    return numpy.asarray( vigra.analysis.labelVolumeWithBackground(binary) )
+
+class UnionFind(object):
+    """Disjoint sets of the integers [0, n)."""
+    def __init__(self, n):
+        self.parent = numpy.arange(n)
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # path compression
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a != root_b:
+            # the smaller root wins, so 0 (the background) stays its own set
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def consecutiveLabels(self):
+        """Return an array that maps every element to its set, numbered
+        consecutively in the order of the smallest element of each set."""
+        roots = self.parent.copy()
+        while True:
+            next_roots = roots[roots]
+            if (next_roots == roots).all():
+                break
+            roots = next_roots
+        _, labels = numpy.unique(roots, return_inverse=True)
+        return labels
+
+class BlockLabels(object):
+    """The labels on the faces of a single labeled block.
+
+    * start, stop: spatial bounds of the block in global coordinates
+    * nobjects: number of block-local objects
+    * low_faces[d], high_faces[d]: the labels on the first and last
+      plane of the block along spatial axis d
+
+    """
+    def __init__(self, start, stop, labels):
+        assert labels.shape == tuple(numpy.subtract(stop, start))
+        self.start = tuple(start)
+        self.stop = tuple(stop)
+        self.nobjects = int(labels.max()) if labels.size else 0
+        self.low_faces = []
+        self.high_faces = []
+        for d in range(labels.ndim):
+            self.low_faces.append( labels.take(0, axis=d) )
+            self.high_faces.append( labels.take(labels.shape[d]-1, axis=d) )
+
+class BlockObjects(BlockLabels):
+    """The objects of a single (labeled) block.
+
+    In addition to the BlockLabels attributes:
+
+    * stats: RegionStatistics of the block-local objects
+
+    """
+    def __init__(self, start, stop, raw, labels):
+        super(BlockObjects, self).__init__(start, stop, labels)
+        self.stats = RegionStatistics.fromBlock(raw, labels, start)
+
+class StitchedObjects(object):
+    """The result of stitchBlocks().
+
+    * block_luts[block_start]: maps the block-local object labels to
+      stitched object ids (0 is background)
+    * stats: RegionStatistics of the stitched objects
+    * nobjects: number of stitched objects
+
+    """
+    def __init__(self, block_luts, stats):
+        self.block_luts = block_luts
+        self.stats = stats
+        self.nobjects = stats.nlabels - 1
+
+def stitchLabels(blocks, ndim):
+    """Find the block-local objects that touch each other across block faces.
+
+    :param blocks: list of BlockLabels, which must tile the volume on a regular grid
+    :returns: A tuple (block_luts, nobjects), where block_luts[block_start]
+              maps the block-local labels to stitched object ids (0 is background)
+
+    """
+    blocks = sorted(blocks, key=lambda b: b.start)
+    blocks_by_start = dict((b.start, b) for b in blocks)
+
+    # Give every block-local object a unique id (0 is the background)
+    local_luts = {}
+    next_id = 1
+    for block in blocks:
+        lut = numpy.zeros((block.nobjects+1,), dtype=numpy.int64)
+        lut[1:] = numpy.arange(next_id, next_id + block.nobjects)
+        local_luts[block.start] = lut
+        next_id += block.nobjects
+
+    # Union objects that touch across the face to the next block along each axis
+    union_find = UnionFind(next_id)
+    for block in blocks:
+        for d in range(ndim):
+            neighbor_start = list(block.start)
+            neighbor_start[d] = block.stop[d]
+            neighbor = blocks_by_start.get(tuple(neighbor_start))
+            if neighbor is None:
+                continue
+            a = local_luts[block.start][block.high_faces[d]]
+            b = local_luts[neighbor.start][neighbor.low_faces[d]]
+            touching = (a != 0) & (b != 0)
+            pairs = numpy.unique( a[touching] * next_id + b[touching] )
+            for pair in pairs:
+                union_find.union( *divmod(pair, next_id) )
+
+    stitched_ids = union_find.consecutiveLabels()
+    block_luts = dict( (start, stitched_ids[lut]) for start, lut in local_luts.items() )
+    nobjects = int(stitched_ids.max()) if len(stitched_ids) else 0
+    return block_luts, nobjects
+
+def stitchBlocks(blocks, nchannels, ndim):
+    """Merge the objects of blocks that touch each other across block faces.
+
+    :param blocks: list of BlockObjects, which must tile the volume on a regular grid
+    :returns: StitchedObjects
+
+    """
+    block_luts, _ = stitchLabels(blocks, ndim)
+
+    # Merge the statistics of all block-local objects into the stitched objects
+    stats = RegionStatistics(nchannels, ndim)
+    for block in sorted(blocks, key=lambda b: b.start):
+        stats.mergeRelabeled( block.stats, block_luts[block.start] )
+    return StitchedObjects(block_luts, stats)
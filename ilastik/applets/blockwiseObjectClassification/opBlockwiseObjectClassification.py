@@ -1,23 +1,28 @@
 # Built-in
 import logging
+import copy
 import collections
+from functools import partial
 
 # Third-party
 import numpy
+import vigra
 
 # lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.request import RequestLock
-from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
+from lazyflow.request import Request, RequestPool, RequestLock
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice, roiFromShape
 from lazyflow.operators import OpSubRegion
 from lazyflow.stype import Opaque
 from lazyflow.rtype import List
 
 # ilastik
 from ilastik.utility import bind
-from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
-from ilastik.applets.objectClassification.opObjectClassification import OpObjectPredict, OpRelabelSegmentation, OpMaxLabel
+from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction, features_mergeable, features_from_statistics
+from ilastik.applets.objectClassification.opObjectClassification import OpObjectPredict, OpRelabelSegmentation, OpMaxLabel, \
+                                                                        make_feature_array, replace_missing, predict_probabilities
 from ilastik.applets.base.applet import DatasetConstraintError
+from objectStitching import labelBlock, BlockObjects, stitchBlocks
 
 logger = logging.getLogger(__name__)
 traceLogger = logging.getLogger("TRACE." + __name__)
@@ -187,6 +192,12 @@ class OpSingleBlockObjectPrediction( Operator ):
 class OpBlockwiseObjectClassification( Operator ):
     """
     Handles prediction ONLY.  Training must be provided externally and loaded via the serializer.
+
+    By default, each block is processed independently, with a halo that must be large enough
+    to contain the objects crossing the block boundary.  If StitchObjects is True (and all selected
+    features are mergeable), the objects of all blocks are stitched across the block faces instead,
+    so every object gets exactly one prediction, computed from its features in the whole volume.
+    No halo is used in that mode.
     """
     RawImage = InputSlot()
     BinaryImage = InputSlot()
@@ -195,14 +206,22 @@ class OpBlockwiseObjectClassification( Operator ):
     SelectedFeatures = InputSlot(rtype=List, stype=Opaque)
     BlockShape3dDict = InputSlot( value={'x' : 512, 'y' : 512, 'z' : 512} ) # A dict of SPATIAL block dims
     HaloPadding3dDict = InputSlot( value={'x' : 64, 'y' : 64, 'z' : 64} ) # A dict of spatial block dims
+    MaxConcurrentBlocks = InputSlot( value=4 ) # How many block pipelines may compute at the same time
+    MaxBlockPipelines = InputSlot( value=64 ) # How many block pipelines are kept alive (least recently used are deleted)
+    StitchObjects = InputSlot( value=False ) # Stitch objects across block faces instead of using the halo
 
     PredictionImage = OutputSlot()
     BlockwiseRegionFeatures = OutputSlot()
     
     def __init__(self, *args, **kwargs):
         super( self.__class__, self ).__init__(*args, **kwargs)
-        self._blockPipelines = {} # indexed by blockstart
+        self._blockPipelines = collections.OrderedDict() # indexed by blockstart, least recently used first
+        self._pipelineUsers = collections.defaultdict(int) # indexed by blockstart: number of requests using the pipeline
         self._lock = RequestLock()
+
+        # For StitchObjects mode: indexed by t, (StitchedObjects, object predictions)
+        self._stitchedPredictions = {}
+        self._stitchingLock = RequestLock()
         
     def setupOutputs(self):
         # Check for preconditions.
@@ -241,28 +260,154 @@ class OpBlockwiseObjectClassification( Operator ):
             assert False, "Unknown output slot: {}".format( slot.name )
 
     def _executePredictionImage(self, roi, destination):
+        if self.StitchObjects.value:
+            if features_mergeable( self.SelectedFeatures([]).wait() ):
+                return self._executeStitchedPredictionImage( roi, destination )
+            logger.warn( "The selected features can't be merged across blocks. "
+                         "Falling back to independent blocks with halo." )
+
         # Determine intersecting blocks
         block_shape = self._getFullShape( self.BlockShape3dDict.value )
         block_starts = getIntersectingBlocks( block_shape, (roi.start, roi.stop) )
         block_starts = map( tuple, block_starts )
 
-        # Ensure that block pipelines exist (create first if necessary)
-        for block_start in block_starts:
-            self._ensurePipelineExists(block_start)
-
         # Retrieve result from each block, and write into the appropriate region of the destination
-        # TODO: Parallelize this loop
-        for block_start in block_starts:
-            opBlockPipeline = self._blockPipelines[block_start]
-            block_roi = opBlockPipeline.block_roi
-            block_intersection = getIntersection( block_roi, (roi.start, roi.stop) )
-            block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
-            destination_relative_intersection = numpy.subtract(block_intersection, roi.start)
-            
-            destination_slice = roiToSlice( *destination_relative_intersection )
-            req = opBlockPipeline.PredictionImage( *block_relative_intersection )
-            req.writeInto( destination[destination_slice] )
-            req.wait()
+        # At most MaxConcurrentBlocks block pipelines are computed at the same time.
+        def processBlock(block_start):
+            opBlockPipeline = self._acquirePipeline(block_start)
+            try:
+                block_roi = opBlockPipeline.block_roi
+                block_intersection = getIntersection( block_roi, (roi.start, roi.stop) )
+                block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
+                destination_relative_intersection = numpy.subtract(block_intersection, roi.start)
+
+                destination_slice = roiToSlice( *destination_relative_intersection )
+                req = opBlockPipeline.PredictionImage( *block_relative_intersection )
+                req.writeInto( destination[destination_slice] )
+                req.wait()
+            finally:
+                self._releasePipeline(block_start)
+
+        max_concurrent = max(1, self.MaxConcurrentBlocks.value)
+        for batch_start in range(0, len(block_starts), max_concurrent):
+            pool = RequestPool()
+            for block_start in block_starts[batch_start:batch_start+max_concurrent]:
+                pool.add( Request( partial(processBlock, block_start) ) )
+            pool.wait()
+            pool.clean()
+
+        return destination
+
+    def _stitchingGeometry(self):
+        """
+        Return the spatial axis keys, spatial shape and spatial block shape used in StitchObjects mode.
+        For 2D data, the z axis is dropped, like in object extraction.
+        """
+        tagged_shape = self.RawImage.meta.getTaggedShape()
+        spatial_axes = filter( lambda k: k in 'xyz', tagged_shape.keys() )
+        if tagged_shape.get('z', 1) == 1 and 'z' in spatial_axes:
+            spatial_axes.remove('z')
+        spatial_shape = [ tagged_shape[k] for k in spatial_axes ]
+        spatial_block_shape = [ min(self._block_shape_dict[k], tagged_shape[k]) for k in spatial_axes ]
+        return spatial_axes, spatial_shape, spatial_block_shape
+
+    def _readBlock(self, slot, t, spatial_axes, spatial_start, spatial_stop):
+        """
+        Read one time slice of a spatial block from the given slot.
+        Returns an array with axes spatial_axes + ['c'].
+        """
+        tagged_start = dict( zip(spatial_axes, spatial_start) )
+        tagged_stop = dict( zip(spatial_axes, spatial_stop) )
+        tagged_start['t'], tagged_stop['t'] = t, t+1
+        tagged_shape = slot.meta.getTaggedShape()
+        start = [ tagged_start.get(k, 0) for k in tagged_shape.keys() ]
+        stop = [ tagged_stop.get(k, n) for k, n in tagged_shape.items() ]
+
+        data = slot( start, stop ).wait()
+        data = data.view( vigra.VigraArray )
+        data.axistags = copy.copy( slot.meta.axistags )
+        return numpy.asarray( data.withAxes( *(spatial_axes + ['c']) ) )
+
+    def _getStitchedPredictions(self, t):
+        """
+        Label all blocks of time slice t, stitch their objects and predict them (computed only once).
+        Returns (StitchedObjects, predictions), where predictions is indexed by stitched object id.
+        """
+        with self._stitchingLock:
+            if t in self._stitchedPredictions:
+                return self._stitchedPredictions[t]
+
+            spatial_axes, spatial_shape, spatial_block_shape = self._stitchingGeometry()
+            block_starts = getIntersectingBlocks( spatial_block_shape, roiFromShape(spatial_shape) )
+            blocks = [None] * len(block_starts)
+
+            def computeBlock(block_index, block_start):
+                start, stop = getBlockBounds( spatial_shape, spatial_block_shape, block_start )
+                raw = self._readBlock( self.RawImage, t, spatial_axes, start, stop )
+                binary = self._readBlock( self.BinaryImage, t, spatial_axes, start, stop )
+                blocks[block_index] = BlockObjects( start, stop, raw, labelBlock( binary[..., 0] ) )
+
+            # The blocks are independent, so they are labeled in parallel
+            max_concurrent = max(1, self.MaxConcurrentBlocks.value)
+            for batch_start in range(0, len(block_starts), max_concurrent):
+                pool = RequestPool()
+                for block_index in range(batch_start, min(batch_start+max_concurrent, len(block_starts))):
+                    pool.add( Request( partial(computeBlock, block_index, block_starts[block_index]) ) )
+                pool.wait()
+                pool.clean()
+
+            nchannels = self.RawImage.meta.getTaggedShape()['c']
+            objects = stitchBlocks( blocks, nchannels, len(spatial_axes) )
+            logger.debug( "Stitched {} blocks into {} objects".format( len(blocks), objects.nobjects ) )
+
+            predictions = numpy.zeros( (objects.nobjects+1,), dtype=numpy.uint8 )
+            forests = self.Classifier[:].wait()
+            if objects.nobjects > 0 and forests is not None and forests[0] is not None:
+                selected = self.SelectedFeatures([]).wait()
+                feats = features_from_statistics( objects.stats, selected )
+                ftmatrix, _, _ = make_feature_array( {t : feats}, selected )
+                replace_missing( ftmatrix )
+                probabilities = predict_probabilities( forests, ftmatrix )
+                predictions[:] = 1 + numpy.argmax( probabilities, axis=1 )
+                predictions[0] = 0 # Background gets the zero label
+
+            # The statistics are not needed anymore
+            objects.stats = None
+            self._stitchedPredictions[t] = (objects, predictions)
+            return self._stitchedPredictions[t]
+
+    def _executeStitchedPredictionImage(self, roi, destination):
+        spatial_axes, spatial_shape, spatial_block_shape = self._stitchingGeometry()
+        axiskeys = self.PredictionImage.meta.getAxisKeys()
+        spatial_indexes = [ axiskeys.index(k) for k in spatial_axes ]
+        spatial_roi = ( numpy.array(roi.start)[spatial_indexes], numpy.array(roi.stop)[spatial_indexes] )
+        t_index = axiskeys.index('t')
+
+        destination_view = destination.view( vigra.VigraArray )
+        destination_view.axistags = copy.copy( self.PredictionImage.meta.axistags )
+
+        for t in range( roi.start[t_index], roi.stop[t_index] ):
+            objects, predictions = self._getStitchedPredictions(t)
+            destination_t = destination_view.bindAxis( 't', t - roi.start[t_index] ).withAxes( *(spatial_axes + ['c']) )
+            block_starts = getIntersectingBlocks( spatial_block_shape, spatial_roi )
+
+            def processBlock(block_start):
+                start, stop = getBlockBounds( spatial_shape, spatial_block_shape, block_start )
+                binary = self._readBlock( self.BinaryImage, t, spatial_axes, start, stop )
+                block_prediction = predictions[ objects.block_luts[tuple(start)][ labelBlock( binary[..., 0] ) ] ]
+
+                intersection = getIntersection( (start, stop), spatial_roi )
+                block_slicing = roiToSlice( *numpy.subtract(intersection, start) )
+                destination_slicing = roiToSlice( *numpy.subtract(intersection, spatial_roi[0]) )
+                destination_t[tuple(destination_slicing) + (0,)] = block_prediction[block_slicing]
+
+            max_concurrent = max(1, self.MaxConcurrentBlocks.value)
+            for batch_start in range(0, len(block_starts), max_concurrent):
+                pool = RequestPool()
+                for block_start in block_starts[batch_start:batch_start+max_concurrent]:
+                    pool.add( Request( partial(processBlock, block_start) ) )
+                pool.wait()
+                pool.clean()
 
         return destination
 
@@ -274,7 +419,7 @@ class OpBlockwiseObjectClassification( Operator ):
                    (1,20,30,40,5) should be requested via roi [(1,2,3,4,5),(2,3,4,5,6)]
         
         Note: It is assumed that you will request these features for debug purposes, AFTER requesting the prediction image.
-              Therefore, it is considered an error to request features that are not already computed.
+              If the block pipeline has been deleted in the meantime (see MaxBlockPipelines), the features are recomputed.
         """
         axiskeys = self.RawImage.meta.getAxisKeys()
         # Find the corresponding block start coordinates
@@ -284,8 +429,6 @@ class OpBlockwiseObjectClassification( Operator ):
         block_starts = map( tuple, block_starts )
         
         for block_start in block_starts:
-            assert block_start in self._blockPipelines, "Not allowed to request region features for blocks that haven't yet been processed." # See note above
-
             # Discard spatial axes to get (t,c) index for region slot roi
             tagged_block_start = zip( axiskeys, block_start )
             tagged_block_start_tc = filter( lambda (k,v): k in 'tc', tagged_block_start )
@@ -295,41 +438,74 @@ class OpBlockwiseObjectClassification( Operator ):
             destination_start = numpy.array(block_start) / block_shape - roi.start
             destination_stop = destination_start + numpy.array( [1]*len(axiskeys) )
 
-            opBlockPipeline = self._blockPipelines[block_start]
-            req = opBlockPipeline.BlockwiseRegionFeatures( *block_roi_tc )
-            req.writeInto( destination[ roiToSlice( destination_start, destination_stop ) ] )
-            req.wait()
+            opBlockPipeline = self._acquirePipeline(block_start)
+            try:
+                req = opBlockPipeline.BlockwiseRegionFeatures( *block_roi_tc )
+                req.writeInto( destination[ roiToSlice( destination_start, destination_stop ) ] )
+                req.wait()
+            finally:
+                self._releasePipeline(block_start)
         
         return destination
 
-    def _ensurePipelineExists(self, block_start):
-        if block_start in self._blockPipelines:
-            return
+    def _acquirePipeline(self, block_start):
+        """
+        Return the pipeline for the given block (create it first if necessary),
+        and mark it as in use, so it won't be deleted until _releasePipeline() is called.
+        """
         with self._lock:
             if block_start in self._blockPipelines:
-                return
+                # Mark as most recently used
+                opBlockPipeline = self._blockPipelines.pop(block_start)
+            else:
+                opBlockPipeline = self._createPipeline(block_start)
+            self._blockPipelines[block_start] = opBlockPipeline
+            self._pipelineUsers[block_start] += 1
+            return opBlockPipeline
 
-            logger.debug( "Creating pipeline for block: {}".format( block_start ) )
+    def _releasePipeline(self, block_start):
+        with self._lock:
+            self._pipelineUsers[block_start] -= 1
+            if self._pipelineUsers[block_start] == 0:
+                del self._pipelineUsers[block_start]
+            self._evictPipelines()
 
-            block_shape = self._getFullShape( self._block_shape_dict )
-            halo_padding = self._getFullShape( self._halo_padding_dict )
+    def _evictPipelines(self):
+        """
+        Delete the least recently used pipelines that are not in use, until
+        no more than MaxBlockPipelines are left. Must be called with self._lock held.
+        """
+        excess = len(self._blockPipelines) - self.MaxBlockPipelines.value
+        if excess <= 0:
+            return
+        unused = [block_start for block_start in self._blockPipelines.keys()
+                  if block_start not in self._pipelineUsers]
+        for block_start in unused[:excess]:
+            logger.debug( "Deleting pipeline for block: {}".format( block_start ) )
+            opBlockPipeline = self._blockPipelines.pop(block_start)
+            opBlockPipeline.cleanUp()
 
-            input_shape = self.RawImage.meta.shape
-            block_stop = getBlockBounds( input_shape, block_shape, block_start )[1]
-            block_roi = (block_start, block_stop)
+    def _createPipeline(self, block_start):
+        logger.debug( "Creating pipeline for block: {}".format( block_start ) )
 
-            # Instantiate pipeline
-            opBlockPipeline = OpSingleBlockObjectPrediction( block_roi, halo_padding, parent=self )
-            opBlockPipeline.RawImage.connect( self.RawImage )
-            opBlockPipeline.BinaryImage.connect( self.BinaryImage )
-            opBlockPipeline.Classifier.connect( self.Classifier )
-            opBlockPipeline.LabelsCount.connect( self.LabelsCount )
-            opBlockPipeline.SelectedFeatures.connect( self.SelectedFeatures )
+        block_shape = self._getFullShape( self._block_shape_dict )
+        halo_padding = self._getFullShape( self._halo_padding_dict )
 
-            # Forward dirtyness
-            opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
-            
-            self._blockPipelines[block_start] = opBlockPipeline
+        input_shape = self.RawImage.meta.shape
+        block_stop = getBlockBounds( input_shape, block_shape, block_start )[1]
+        block_roi = (block_start, block_stop)
+
+        # Instantiate pipeline
+        opBlockPipeline = OpSingleBlockObjectPrediction( block_roi, halo_padding, parent=self )
+        opBlockPipeline.RawImage.connect( self.RawImage )
+        opBlockPipeline.BinaryImage.connect( self.BinaryImage )
+        opBlockPipeline.Classifier.connect( self.Classifier )
+        opBlockPipeline.LabelsCount.connect( self.LabelsCount )
+        opBlockPipeline.SelectedFeatures.connect( self.SelectedFeatures )
+
+        # Forward dirtyness
+        opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
+        return opBlockPipeline
 
     
     def _getFullShape(self, spatialShapeDict):
@@ -353,9 +529,9 @@ class OpBlockwiseObjectClassification( Operator ):
     
     def _deleteAllPipelines(self):
         logger.debug("Deleting all pipelines.")
-        oldBlockPipelines = self._blockPipelines
-        self._blockPipelines = {}
         with self._lock:
+            oldBlockPipelines = self._blockPipelines
+            self._blockPipelines = collections.OrderedDict()
             for opBlockPipeline in oldBlockPipelines.values():
                 opBlockPipeline.cleanUp()
     
@@ -363,6 +539,17 @@ class OpBlockwiseObjectClassification( Operator ):
     def propagateDirty(self, slot, subindex, roi):
         if slot == self.BlockShape3dDict or slot == self.HaloPadding3dDict:
             self._deleteAllPipelines()
+            self._stitchedPredictions = {}
+            self.PredictionImage.setDirty( slice(None) )
+        elif slot == self.MaxBlockPipelines:
+            with self._lock:
+                self._evictPipelines()
+        elif slot == self.MaxConcurrentBlocks:
+            pass
+        elif slot == self.StitchObjects or self._stitchedPredictions:
+            # Stitched objects can span the whole volume, so any change invalidates everything.
+            # (Without stitching, dirtiness is forwarded through the block pipelines.)
+            self._stitchedPredictions = {}
             self.PredictionImage.setDirty( slice(None) )
     
     
@@ -8,12 +8,13 @@ import copy
 import importlib
 from functools import partial
 
-from lazyflow.graph import Operator, InputSlot, OutputSlot, OrderedSignal
+from lazyflow.graph import Operator, InputSlot, OutputSlot, OrderedSignal, OperatorWrapper
 from lazyflow.request import Request, RequestPool
+from lazyflow.roi import roiToSlice, getIntersectingBlocks, getBlockBounds, getIntersection
 from lazyflow.utility import traceLogged
-from lazyflow.operators import OpPixelOperator
+from lazyflow.operators import OpPixelOperator, OpBlockedArrayCache
 
-from ilastik.applets.counting.countingsvr import SVR
+from ilastik.applets.counting.countingsvr import SVR, forestJobs
 
 
 
@@ -78,6 +79,16 @@ class OpTrainCounter(Operator):
         self.Classifier.meta.dtype = object
         self.Classifier.meta.shape = (self.numRegressors,)
 
+        # The smoothed dot labels of each lane are cached, so that after a
+        # change only the blocks around the changed labels are smoothed again.
+        self._opSmoothing = OperatorWrapper( OpGaussianSmoothing, parent=self, broadcastingSlotNames=['Sigma'] )
+        self._opSmoothing.Input.connect( self.ForegroundLabels )
+        self._opSmoothing.Sigma.connect( self.Sigma )
+
+        self._opSmoothingCache = OperatorWrapper( OpBlockedArrayCache, parent=self, broadcastingSlotNames=['fixAtCurrent'] )
+        self._opSmoothingCache.Input.connect( self._opSmoothing.Output )
+        self._opSmoothingCache.fixAtCurrent.setValue( False )
+
     def initInputs(self, params):
         fix = False
         if self.fixClassifier.ready():
@@ -93,6 +104,15 @@ class OpTrainCounter(Operator):
         self.fixClassifier.setValue(fix)
 
     def setupOutputs(self):
+        # Cache the smoothed labels in the same blocks as the labels themselves
+        for i, labels in enumerate(self.ForegroundLabels):
+            if labels.meta.shape is not None:
+                taggedShape = labels.meta.getTaggedShape()
+                blockDims = { 't' : 1, 'x' : 64, 'y' : 64, 'z' : 64, 'c' : 1 }
+                blockShape = tuple( min( blockDims.get(k, n), n ) for k, n in taggedShape.items() )
+                self._opSmoothingCache.innerBlockShape[i].setValue( blockShape )
+                self._opSmoothingCache.outerBlockShape[i].setValue( blockShape )
+
         if self.inputs["fixClassifier"].value == False:
             method = self.SelectedOption.value
             if type(method) is dict:
@@ -127,9 +147,6 @@ class OpTrainCounter(Operator):
 
         for i,labels in enumerate(self.inputs["ForegroundLabels"]):
             if labels.meta.shape is not None:
-                opGaussian = OpGaussianSmoothing(parent = self, graph = self.graph)
-                opGaussian.Sigma.setValue(self.Sigma.value)
-                opGaussian.Input.connect(self.ForegroundLabels[i])
                 blocks = self.inputs["nonzeroLabelBlocks"][i][0].wait()
                 
                 reqlistlabels = []
@@ -139,7 +156,7 @@ class OpTrainCounter(Operator):
                 self.progressSignal(progress)
                 
                 for b in blocks[0]:
-                    request = opGaussian.Output[b]
+                    request = self._opSmoothingCache.Output[i][b]
                     #request = labels[b]
                     featurekey = list(b)
                     featurekey[-1] = slice(None, None, None)
@@ -214,10 +231,9 @@ class OpTrainCounter(Operator):
             negTags = [tag[1] for tag in tagList]
             numPosTags = np.sum(posTags)
             numTags = np.sum(posTags) + np.sum(negTags)
-            fullFeatMatrix = np.ndarray((numTags, self.Images[0].meta.shape[-1]), dtype = np.float64)
+            # The samples are assembled once, in float32, and shared (read-only) by all regressors
+            fullFeatMatrix = np.ndarray((numTags, self.Images[0].meta.shape[-1]), dtype = np.float32)
             fullLabelsMatrix = np.ndarray((numTags), dtype = np.float64)
-            fullFeatMatrix[:] = np.NAN
-            fullLabelsMatrix[:] = np.NAN
             currPosCount = 0
             currNegCount = numPosTags
             for i, posCount in enumerate(posTags):
@@ -227,12 +243,16 @@ class OpTrainCounter(Operator):
                 fullLabelsMatrix[currNegCount:currNegCount + negTags[i]] = labelsMatrix[i][posCount:]
                 currPosCount += posTags[i]
                 currNegCount += negTags[i]
+            # The per-block samples are not needed anymore
+            del featMatrix[:]
+            del labelsMatrix[:]
+            fullFeatMatrix.flags.writeable = False
+            fullLabelsMatrix.flags.writeable = False
 
-
-            assert(not np.isnan(np.sum(fullFeatMatrix)))
+            # The matrices are not initialized: every row must have been filled
+            assert currPosCount == numPosTags and currNegCount == numTags
 
             fullTags = [np.sum(posTags), np.sum(negTags)]
-            #pool = RequestPool()
 
             maxima = np.max(fullFeatMatrix, axis=0)
             minima = np.min(fullFeatMatrix, axis=0)
@@ -252,16 +272,23 @@ class OpTrainCounter(Operator):
 
             params = self._svr.get_params() 
             try:
-                pool = RequestPool()
-                def train_and_store(i):
-                    result[i] = SVR(minmax = normalizationFactors, **params)
+                def train_and_store(i, njobs=1):
+                    result[i] = SVR(minmax = normalizationFactors, njobs = njobs, **params)
                     result[i].fitPrepared(fullFeatMatrix, fullLabelsMatrix, tags = fullTags, boxConstraints = boxConstraints, numRegressors
                          = self.numRegressors, trainAll = False)
-                for i in range(self.numRegressors):
-                    req = pool.request(partial(train_and_store, i))
-                
-                pool.wait()
-                pool.clean()
+
+                njobs = forestJobs() if params["method"] == "RandomForest" else 1
+                if njobs > 1:
+                    # Each forest is built with all cores (by sklearn), one after the other
+                    for i in range(self.numRegressors):
+                        train_and_store(i, njobs = njobs)
+                else:
+                    pool = RequestPool()
+                    for i in range(self.numRegressors):
+                        req = pool.request(partial(train_and_store, i))
+                    
+                    pool.wait()
+                    pool.clean()
             
             except:
                 logger.error("ERROR: could not learn regressor")
@@ -326,6 +353,9 @@ class OpPredictCounter(Operator):
     inputSlots = [InputSlot("Image"),InputSlot("Classifier"),InputSlot("LabelsCount",stype='integer')]
     outputSlots = [OutputSlot("PMaps")]
 
+    # Maximum tile size (per axis) for prediction, all features are always predicted together
+    TileDims = { 't' : 1, 'x' : 256, 'y' : 256, 'z' : 64 }
+
     def setupOutputs(self):
         nlabels=self.inputs["LabelsCount"].value
         self.PMaps.meta.dtype = np.float32
@@ -348,36 +378,29 @@ class OpPredictCounter(Operator):
         traceLogger.debug("OpPredictRandomForest: Got classifier")
         #assert RF.labelCount() == nlabels, "ERROR: OpPredictRandomForest, labelCount differs from true labelCount! %r vs. %r" % (RF.labelCount(), nlabels)
 
-        newKey = key[:-1]
-        newKey += (slice(0,self.inputs["Image"].meta.shape[-1],None),)
-
-        res = self.inputs["Image"][newKey].wait()
-
-        shape=res.shape
-        prod = np.prod(shape[:-1])
-        res.shape = (prod, shape[-1])
-        features=res
-
-        predictions = [0]*len(forests)
+        # The roi is predicted in tiles, in parallel, so that only the features
+        # of the tiles in progress are held in memory at a time.
+        shape = self.Image.meta.shape
+        numFeatures = shape[-1]
+        featureRoi = ( tuple(roi.start[:-1]) + (0,), tuple(roi.stop[:-1]) + (numFeatures,) )
+        tileShape = tuple( min( self.TileDims.get(k, n), n ) for k, n in self.Image.meta.getTaggedShape().items() )
+        channels = range( roi.start[-1], roi.stop[-1] )
 
         t2 = time.time()
 
-        pool = RequestPool()
-        
-        def predict_forest(i):
-            predictions[i] = forests[i].predict(np.asarray(features, dtype = np.float32))
-            predictions[i] = predictions[i].reshape(result.shape[:-1])
-
-
-        for i,f in enumerate(forests):
-            req = pool.request(partial(predict_forest,i))
+        def predictTile(tileStart):
+            tileStart, tileStop = getIntersection( getBlockBounds( shape, tileShape, tileStart ), featureRoi )
+            features = self.Image( tileStart, tileStop ).wait()
+            features = np.asarray( features, dtype = np.float32 )
+            resultSlicing = roiToSlice( np.subtract(tileStart, featureRoi[0])[:-1], np.subtract(tileStop, featureRoi[0])[:-1] )
+            for k, c in enumerate(channels):
+                forests[c].predict( features, out = result[resultSlicing + (slice(k, k+1),)] )
 
+        pool = RequestPool()
+        for tileStart in getIntersectingBlocks( tileShape, featureRoi ):
+            pool.add( Request( partial(predictTile, tileStart) ) )
         pool.wait()
         pool.clean()
-        #predictions[0] = forests[0].predict(np.asarray(features, dtype = np.float32), normalize = False)
-        #predictions[0] = predictions[0].reshape(result.shape)
-        prediction=np.dstack(predictions)
-        result[...] = prediction
 
         # If our LabelsCount is higher than the number of labels in the training set,
         # then our results aren't really valid.  FIXME !!!
@@ -387,7 +410,7 @@ class OpPredictCounter(Operator):
 
         t3 = time.time()
 
-        logger.debug("Predict took %fseconds, actual RF time was %fs, feature time was %fs" % (t3-t1, t3-t2, t2-t1))
+        logger.debug("Predict took %fseconds, tiled prediction (features and regressors) took %fs" % (t3-t1, t3-t2))
         return result
 
 
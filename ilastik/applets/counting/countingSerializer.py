@@ -205,7 +205,8 @@ class CountingSerializer(AppletSerializer):
                                  operator.NonzeroLabelBlocks,
                                  name='LabelSets',
                                  subname='labels{:0}',
-                                 selfdepends=False),
+                                 selfdepends=False,
+                                 compression='gzip'),
                  SerialCountingSlot(operator.Classifier,
                                       operator.classifier_cache,
                                       name="CountingWrappers",
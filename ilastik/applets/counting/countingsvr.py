@@ -8,6 +8,8 @@ except:
 
 import h5py, cPickle
 import sys
+import re
+import multiprocessing
 
 class RegressorC(object):
 
@@ -324,6 +326,22 @@ class RegressorGurobi(object):
 
 
 
+def forestJobs():
+    """
+    The number of jobs for building a random forest with sklearn.
+    Since sklearn 0.15, the trees of a forest are built in threads.
+    Older versions fork one process per job (from a process with running
+    request threads) and copy the samples to each of them, so they get one job.
+    """
+    try:
+        import sklearn
+        version = tuple( int(v) for v in re.findall(r"\d+", sklearn.__version__)[:2] )
+    except ImportError:
+        return 1
+    if version < (0, 15):
+        return 1
+    return multiprocessing.cpu_count()
+
 class SVR(object):
 
 
@@ -350,6 +368,7 @@ class SVR(object):
 
     def __init__(self, method = options[0]["method"], Sigma = 2.5, C = 1, epsilon = 0.000, \
                   ntrees=10, maxdepth=50, minmax=None, #RF parameters, maxdepth=None means grows until purity
+                 njobs=1, #number of jobs used by sklearn to build a forest (see forestJobs())
                  **kwargs
                  ):
         """
@@ -368,6 +387,7 @@ class SVR(object):
         #RF parameters:
         self._ntrees=ntrees
         self._maxdepth=maxdepth
+        self._njobs=njobs
         self._minmax = minmax
         if minmax:
             self._scalingFactor = minmax[1] - minmax[0]
@@ -560,8 +580,10 @@ class SVR(object):
         if self._method == "RandomForest":
             from sklearn.ensemble import RandomForestRegressor as RFR
             
-            regressor = RFR(n_estimators=self._ntrees,max_depth=self._maxdepth)
+            regressor = RFR(n_estimators=self._ntrees,max_depth=self._maxdepth,n_jobs=self._njobs)
             regressor.fit(img, dot)
+            # Predictions are parallelized over tiles (see OpPredictCounter)
+            regressor.set_params(n_jobs=1)
 
         elif self._method == "svrBoxed-gurobi":
             regressor = RegressorGurobi(C = self._C, epsilon = self._epsilon)
@@ -583,25 +605,38 @@ class SVR(object):
         
 
 
-    def predict(self, oldImage):
-        oldShape = oldImage.shape
-        resShape = oldShape[:-1]
-        image = np.copy(oldImage.reshape((-1, oldImage.shape[-1])))
-        image = self.normalize(image)
-
-        reslist = []
-        for r in self._regressor:
-            if r is None:
-                reslist.append(np.zeros(oldImage.shape[:-1]))
-            else:
-                reslist.append(r.predict(image))
-            res = np.dstack(reslist)
-            resShape = oldShape[:-1] + (len(self._regressor),)
-        
-        #res = np.zeros(oldShape[:-1])
-        res = res.view(np.ndarray)
-        res[res < 0] = 0
-        return res.reshape(resShape)
+    def predict(self, oldImage, out=None, chunkSize=2**16):
+        """
+        Predict the densities of all regressors for the pixels of oldImage (features in the last axis).
+        The pixels are processed in chunks of chunkSize, so that only one chunk
+        at a time needs a normalized copy.
+        If out (shape oldImage.shape[:-1] + (number of regressors,)) is given, the result is written into it.
+        """
+        numRegressors = len(self._regressor)
+        resShape = oldImage.shape[:-1] + (numRegressors,)
+        if out is None:
+            out = np.ndarray(resShape, dtype=np.float64)
+        assert out.shape == resShape
+
+        image = oldImage.reshape((-1, oldImage.shape[-1]))
+        res = out.reshape((-1, numRegressors))
+        for start in range(0, image.shape[0], chunkSize):
+            chunk = image[start:start + chunkSize]
+            if self._normalizes():
+                # normalize() works in place
+                chunk = self.normalize(np.copy(chunk))
+            chunkRes = res[start:start + chunkSize]
+            for i, r in enumerate(self._regressor):
+                if r is None:
+                    chunkRes[:, i] = 0
+                else:
+                    chunkRes[:, i] = r.predict(chunk)
+            chunkRes[chunkRes < 0] = 0
+
+        if not np.may_share_memory(res, out):
+            # out could not be reshaped without a copy
+            out[...] = res.reshape(resShape)
+        return out
 
     def writeHDF5(self, cachePath, targetname):
         f = h5py.File(cachePath)
@@ -641,8 +676,11 @@ class SVR(object):
         return boxConstraints
 
 
+    def _normalizes(self):
+        return hasattr(self, "_scalingFactor") and self._method != "RandomForest"
+
     def normalize(self, image):
-        if not hasattr(self, "_scalingFactor") or self._method == "RandomForest":
+        if not self._normalizes():
             return image
         image - self._minmax[0]
 
@@ -1,4 +1,6 @@
 from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import RequestLock
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
 import numpy
 from ilastik.utility import MultiLaneOperatorABC, OperatorSubView
 
@@ -7,7 +9,14 @@ class OpDeviationFromMean(Operator):
     Multi-image operator.
     Calculates the pixelwise mean of a set of images, and produces a set of corresponding images for the difference from the mean.
     Note: Inputs must all have the same shape.
+    
+    The sum of all inputs is cached in blocks of (at most) BlockSize pixels per axis,
+    so each request only reads its own input and the cached sums.
+    Each block sum remembers which lanes it contains: new lanes are added to it when it's needed,
+    and when a lane's input becomes dirty, the affected blocks are summed up again.
     """    
+    BlockSize = 64
+    
     ScalingFactor = InputSlot() # Scale after subtraction
     Offset = InputSlot()        # Offset final results
     Input = InputSlot(level=1)  # Multi-image input
@@ -15,6 +24,14 @@ class OpDeviationFromMean(Operator):
     Mean = OutputSlot()
     Output = OutputSlot(level=1) # Multi-image output
     
+    def __init__(self, *args, **kwargs):
+        super(OpDeviationFromMean, self).__init__(*args, **kwargs)
+        self._lock = RequestLock()  # Protects the dicts below
+        self._blockShape = None
+        self._blockSums = {}        # block start -> ( sum, list of the input slots it contains )
+        self._blockLocks = {}       # block start -> RequestLock
+        self._blockGenerations = {} # block start -> number of times the block was invalidated
+    
     def setupOutputs(self):
         # Ensure all inputs have the same shape
         if len(self.Input) > 0:
@@ -30,20 +47,59 @@ class OpDeviationFromMean(Operator):
         
         self.Mean.meta.assignFrom(self.Input[0].meta)
 
+        blockShape = tuple( min(self.BlockSize, n) for n in self.Input[0].meta.shape )
+        if blockShape != self._blockShape:
+            with self._lock:
+                self._blockShape = blockShape
+                self._blockSums = {}
+
         def markAllOutputsDirty( *args ):
             self.propagateDirty( self.Input, (), slice(None) )
         self.Input.notifyInserted( markAllOutputsDirty )
         self.Input.notifyRemoved( markAllOutputsDirty )
 
-    def execute(self, slot, subindex, roi, result):
+    def _writeBlockMean(self, blockStart, roi, result):
         """
-        Compute.  This is a simple implementation, without optimizations.
+        Write the mean of all inputs within the intersection of roi and the given block into result.
         """
-        # Compute average of *all* inputs
-        result[:] = 0.0
-        for s in self.Input:
-            result[:] += s.get(roi).wait()
-        result[:] = result / len(self.Input)
+        with self._lock:
+            blockLock = self._blockLocks.setdefault( blockStart, RequestLock() )
+
+        shape = self.Input[0].meta.shape
+        blockStop = getBlockBounds( shape, self._blockShape, blockStart )[1]
+        lanes = list(self.Input)
+        with blockLock:
+            with self._lock:
+                generation = self._blockGenerations.get( blockStart, 0 )
+                blockSum, summedLanes = self._blockSums.get( blockStart, (None, []) )
+
+            if blockSum is None or any( s not in lanes for s in summedLanes ):
+                # The sum contains a lane that was removed in the meantime: start over
+                blockSum = numpy.zeros( tuple(numpy.subtract(blockStop, blockStart)), dtype=numpy.float64 )
+                summedLanes = []
+            else:
+                blockSum = blockSum.copy()
+
+            # Add the lanes that aren't in the sum yet
+            for s in lanes:
+                if s not in summedLanes:
+                    blockSum += s( blockStart, blockStop ).wait()
+                    summedLanes.append( s )
+
+            with self._lock:
+                # Don't keep the sum if an input became dirty while we were reading it
+                if self._blockGenerations.get( blockStart, 0 ) == generation:
+                    self._blockSums[blockStart] = (blockSum, summedLanes)
+
+        intersection = getIntersection( (blockStart, blockStop), (roi.start, roi.stop) )
+        blockSlicing = roiToSlice( *numpy.subtract(intersection, blockStart) )
+        resultSlicing = roiToSlice( *numpy.subtract(intersection, roi.start) )
+        result[resultSlicing] = blockSum[blockSlicing] / len(lanes)
+
+    def execute(self, slot, subindex, roi, result):
+        # Compute average of *all* inputs from the cached block sums
+        for blockStart in getIntersectingBlocks( self._blockShape, (roi.start, roi.stop) ):
+            self._writeBlockMean( tuple(blockStart), roi, result )
 
         # If the user wanted the mean, we're done.
         if slot == self.Mean:
@@ -66,8 +122,20 @@ class OpDeviationFromMean(Operator):
         # If the dirty slot is one of our two constants, then the entire image region is dirty
         if slot == self.Offset or slot == self.ScalingFactor:
             roi = slice(None) # The whole image region
+        elif slot == self.Input and len(subindex) > 0 and self._blockShape is not None:
+            # One lane's input changed: Its contribution to the blocks in the dirty region must be re-read.
+            # (Inserted and removed lanes are taken care of when the block sums are used.)
+            lane = self.Input[subindex[0]]
+            with self._lock:
+                for blockStart in getIntersectingBlocks( self._blockShape, (roi.start, roi.stop) ):
+                    blockStart = tuple(blockStart)
+                    # Sums that don't contain the lane yet (e.g. it was just inserted) are still valid
+                    if lane in self._blockSums.get( blockStart, (None, []) )[1]:
+                        del self._blockSums[blockStart]
+                    self._blockGenerations[blockStart] = self._blockGenerations.get( blockStart, 0 ) + 1
         
         # All inputs affect all outputs, so every image is dirty now
+        self.Mean.setDirty( roi )
         for oslot in self.Output:
             oslot.setDirty( roi )
 
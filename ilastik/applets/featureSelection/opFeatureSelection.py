@@ -4,7 +4,6 @@ import logging
 
 #SciPy
 import numpy
-import h5py
 
 #lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
@@ -15,6 +14,7 @@ from lazyflow.operators import OpPixelFeaturesInterpPresmoothed as OpPixelFeatur
 from lazyflow.operators.imgFilterOperators import OpPixelFeaturesPresmoothed as OpPixelFeaturesPresmoothed_Refactored
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.utility.h5HandlePool import h5HandlePool
 
 logger = logging.getLogger(__name__)
 
@@ -90,11 +90,8 @@ class OpFeatureSelectionNoCache(Operator):
             
             self.FeatureLayers.resize(len(self._files))
             for i in range(len(self._files)):
-                f = h5py.File(self._files[i], 'r')
-                shape = f["data"].shape
+                shape, dtype = h5HandlePool.getShapeAndDtype(self._files[i], "data")
                 assert len(shape) == 3
-                dtype = f["data"].dtype
-                f.close()
                 self.FeatureLayers[i].meta.shape    = shape+(1,)
                 self.FeatureLayers[i].meta.dtype    = dtype
                 self.FeatureLayers[i].meta.axistags = axistags 
@@ -133,10 +130,11 @@ class OpFeatureSelectionNoCache(Operator):
         
         key = roiToSlice(rroi.start, rroi.stop)
             
+        # The feature files are kept open in the process-wide pool,
+        #  and each feature is read with a single hyperslab selection directly into the result.
         if slot == self.FeatureLayers:
             index = subindex[0]
-            f = h5py.File(self._files[index], 'r')
-            result[...,0] = f["data"][key[0:3]]
+            self._readFeature(self._files[index], key[0:3], result, numpy.s_[...,0])
             return result
         elif slot == self.OutputImage or slot == self.CachedOutputImage:
             assert result.ndim == 4
@@ -144,17 +142,23 @@ class OpFeatureSelectionNoCache(Operator):
             assert rroi.start == 0, "rroi = %r" % (rroi,)
             assert rroi.stop  == len(self._files), "rroi = %r" % (rroi,)
             
-            j = 0
-            for i in range(key[3].start, key[3].stop):
-                f = h5py.File(self._files[i], 'r')
-                r = f["data"][key[0:3]]
-                assert r.dtype == numpy.float32
-                assert r.ndim == 3
-                f.close()
-                result[:,:,:,j] = r 
-                j += 1
+            # Files that provide several channels are only read once
+            firstChannels = {}
+            for j, i in enumerate(range(key[3].start, key[3].stop)):
+                path = self._files[i]
+                if path in firstChannels:
+                    result[:,:,:,j] = result[:,:,:,firstChannels[path]]
+                else:
+                    self._readFeature(path, key[0:3], result, numpy.s_[:,:,:,j])
+                    firstChannels[path] = j
             return result  
 
+    def _readFeature(self, path, key, result, resultKey):
+        if result.flags.c_contiguous:
+            h5HandlePool.read(path, "data", key, result, resultKey)
+        else:
+            result[resultKey] = h5HandlePool.read(path, "data", key)
+
 class OpFeatureSelection( OpFeatureSelectionNoCache ):
     """
     This is the top-level operator of the feature selection applet when used in a GUI.
@@ -10,6 +10,7 @@ class LabelingSerializer(AppletSerializer):
                                  operator.LabelInputs,
                                  operator.NonzeroLabelBlocks,
                                  name='LabelSets',
-                                 subname='labels{:03d}',)
+                                 subname='labels{:03d}',
+                                 compression='gzip')
         ]
         super(LabelingSerializer, self).__init__(projectFileGroupName, slots=slots)
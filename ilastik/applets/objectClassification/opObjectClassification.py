@@ -591,8 +591,64 @@ def replace_missing(a):
     return rows, cols
 
 
+def predict_probabilities(forests, featMatrix):
+    """Predict the object probabilities with all forests in parallel,
+    and average them.
+
+    Returns an array indexed as [object_index, class_index].
+
+    """
+    # Note: We can't use RandomForest.predictLabels() here because we're training in parallel,
+    #        and we have to average the PROBABILITIES from all forests.
+    #       Averaging the label predictions from each forest is NOT equivalent.
+    #       For details please see wikipedia:
+    #       http://en.wikipedia.org/wiki/Electoral_College_%28United_States%29#Irrelevancy_of_national_popular_vote
+    #       (^-^)
+    featMatrix = featMatrix.astype(numpy.float32)
+    prob_predictions = [0] * len(forests)
+    def predict_forest(forest_index):
+        prob_predictions[forest_index] = forests[forest_index].predictProbabilities(featMatrix)
+
+    # predict the data with all the forests in parallel
+    pool = RequestPool()
+    for i in range(len(forests)):
+        pool.add( Request( partial(predict_forest, i) ) )
+    pool.wait()
+    pool.clean()
+
+    # prob_predictions is a list-of-arrays, indexed as follows:
+    # prob_predictions[forest_index][object_index, class_index]
+
+    # Stack the forests together and average them.
+    stacked_predictions = numpy.array( prob_predictions )
+    averaged_predictions = numpy.average( stacked_predictions, axis=0 )
+    assert averaged_predictions.shape[0] == len(featMatrix)
+    return averaged_predictions
+
+
+class LaneTrainingSet(object):
+    """The labeled objects of one lane, ready for training.
+
+    * featMatrix: float32 array with one row per labeled object (missing values replaced)
+    * labels: uint32 array with the label of each row
+    * col_names: the (plugin, feature) of each column
+    * bad_objects: bad_objects[t] lists the objects with missing values in time slice t
+    * bad_feats: the features with missing values
+
+    """
+    def __init__(self, featMatrix, labels, col_names, bad_objects, bad_feats):
+        self.featMatrix = featMatrix
+        self.labels = labels
+        self.col_names = col_names
+        self.bad_objects = bad_objects
+        self.bad_feats = bad_feats
+
 class OpObjectTrain(Operator):
-    """Trains a random forest on all labeled objects."""
+    """Trains a random forest on all labeled objects.
+
+    The labeled part of each lane's feature matrix is cached, and only
+    recomputed for the lanes whose labels or features have changed.
+    """
 
     name = "TrainRandomForestObjects"
     description = "Train a random forest on multiple images"
@@ -612,6 +668,11 @@ class OpObjectTrain(Operator):
         self._tree_count = 100
         self.FixClassifier.setValue(False)
 
+        # Keyed by the lane's Labels subslot, so that the entries survive inserted and removed lanes
+        self._lock = RequestLock()
+        self._trainingSets = {}
+        self._generations = defaultdict(int) # incremented whenever a lane's training set becomes dirty
+
     def setupOutputs(self):
         if self.inputs["FixClassifier"].value == False:
             self.outputs["Classifier"].meta.dtype = object
@@ -622,11 +683,73 @@ class OpObjectTrain(Operator):
         self.BadObjects.meta.dtype = object
         self.BadObjects.meta.axistags = None
 
-    def execute(self, slot, subindex, roi, result):
-        featList = []
-        all_col_names = []
-        labelsList = []
+    def _computeTrainingSet(self, laneIndex, selected):
+        """Gather the features of all labeled objects of one lane.
+
+        Returns None if the lane has no labels.
+        """
+        # TODO: we should be able to use self.Labels[i].value,
+        # but the current implementation of Slot.value() does not
+        # do the right thing.
+        labels = self.Labels[laneIndex]([]).wait()
+
+        # Only the features of the labeled time slices are needed
+        times = [t for t in sorted(labels.keys()) if numpy.any(labels[t])]
+        if len(times) == 0:
+            return None
+        feats = self.Features[laneIndex](times).wait()
+
+        featstmp, row_names, col_names, labelstmp = make_feature_array(feats, selected, labels)
+        if labelstmp.size == 0 or featstmp.size == 0:
+            return None
+
+        # make_feature_array repeats the column names for each time slice
+        col_names = col_names[:featstmp.shape[1]]
+        rows, cols = replace_missing(featstmp)
+
+        bad_objects = defaultdict(list)
+        for idx in rows:
+            t, obj = row_names[idx]
+            bad_objects[t].append(obj)
+        bad_feats = set(col_names[c] for c in cols)
+
+        return LaneTrainingSet( featstmp.astype(numpy.float32),
+                                numpy.asarray(labelstmp, dtype=numpy.uint32).reshape(-1, 1),
+                                tuple(col_names), bad_objects, bad_feats )
+
+    def _getTrainingSets(self, selected):
+        """Return the LaneTrainingSet (or None) of every lane, recomputing only the dirty ones."""
+        lanes = list(self.Labels)
+        with self._lock:
+            # Forget the lanes that have been removed
+            for lane in self._trainingSets.keys():
+                if lane not in lanes:
+                    del self._trainingSets[lane]
+            trainingSets = [ self._trainingSets.get(lane, False) for lane in lanes ]
+            generations = [ self._generations[lane] for lane in lanes ]
+
+        dirtyLanes = [ i for i, trainingSet in enumerate(trainingSets) if trainingSet is False ]
+        if len(dirtyLanes) > 0:
+            logger.debug("Gathering the training features of lanes {}".format(dirtyLanes))
+
+        def computeLane(laneIndex):
+            trainingSets[laneIndex] = self._computeTrainingSet(laneIndex, selected)
+
+        pool = RequestPool()
+        for laneIndex in dirtyLanes:
+            pool.add( Request( partial(computeLane, laneIndex) ) )
+        pool.wait()
+        pool.clean()
+
+        with self._lock:
+            for laneIndex in dirtyLanes:
+                lane = lanes[laneIndex]
+                # Don't store the result if the lane became dirty in the meantime
+                if self._generations[lane] == generations[laneIndex]:
+                    self._trainingSets[lane] = trainingSets[laneIndex]
+        return trainingSets
 
+    def execute(self, slot, subindex, roi, result):
         # will be available at slot self.Warnings
         all_bad_objects = defaultdict(lambda: defaultdict(list))
         all_bad_feats = set()
@@ -636,33 +759,20 @@ class OpObjectTrain(Operator):
             # no features - no predictions
             self.Classifier.setValue(None)
             return
-        
-        for i in range(len(self.Labels)):
-            # FIXME: we should only compute the features if there are nonzero labels in this image
-            feats = self.Features[i]([]).wait()
-
-            # TODO: we should be able to use self.Labels[i].value,
-            # but the current implementation of Slot.value() does not
-            # do the right thing.
-            labels = self.Labels[i]([]).wait()
 
-            featstmp, row_names, col_names, labelstmp = make_feature_array(feats, selected, labels)
-            if labelstmp.size == 0 or featstmp.size == 0:
+        featList = []
+        all_col_names = []
+        labelsList = []
+        for i, trainingSet in enumerate(self._getTrainingSets(selected)):
+            if trainingSet is None:
                 continue
+            featList.append(trainingSet.featMatrix)
+            all_col_names.append(trainingSet.col_names)
+            labelsList.append(trainingSet.labels)
 
-            rows, cols = replace_missing(featstmp)
-
-            featList.append(featstmp)
-            all_col_names.append(tuple(col_names))
-            labelsList.append(labelstmp)
-
-            for idx in rows:
-                t, obj = row_names[idx]
-                all_bad_objects[i][t].append(obj)
-
-            for c in cols:
-                all_bad_feats.add(col_names[c])
-
+            for t, objs in trainingSet.bad_objects.items():
+                all_bad_objects[i][t].extend(objs)
+            all_bad_feats.update(trainingSet.bad_feats)
 
         if len(labelsList)==0:
             #no labels, return here
@@ -675,8 +785,8 @@ class OpObjectTrain(Operator):
         if not len(set(all_col_names)) == 1:
             raise Exception('different time slices did not have same features.')
 
-        featMatrix = _concatenate(featList, axis=0)
-        labelsMatrix = _concatenate(labelsList, axis=0)
+        featMatrix = numpy.concatenate(featList, axis=0)
+        labelsMatrix = numpy.concatenate(labelsList, axis=0)
 
         logger.info("training on matrix of shape {}".format(featMatrix.shape))
 
@@ -690,7 +800,7 @@ class OpObjectTrain(Operator):
             for i in range(self.ForestCount.value):
                 def train_and_store(number):
                     result[number] = vigra.learning.RandomForest(self._tree_count)
-                    oob[number] = result[number].learnRF(featMatrix.astype(numpy.float32), numpy.asarray(labelsMatrix, dtype=numpy.uint32))
+                    oob[number] = result[number].learnRF(featMatrix, labelsMatrix)
                 req = Request( partial(train_and_store, i) )
                 pool.add( req )
             pool.wait()
@@ -703,11 +813,25 @@ class OpObjectTrain(Operator):
         return result
 
     def propagateDirty(self, slot, subindex, roi):
+        if slot is self.Labels or slot is self.Features:
+            if len(subindex) > 0 and subindex[0] < len(self.Labels):
+                self._invalidateTrainingSets( [self.Labels[subindex[0]]] )
+            else:
+                self._invalidateTrainingSets( list(self.Labels) )
+        elif slot is self.SelectedFeatures:
+            self._invalidateTrainingSets( list(self.Labels) )
+
         if slot is not self.FixClassifier and \
            self.inputs["FixClassifier"].value == False:
             slcs = (slice(0, self.ForestCount.value, None),)
             self.outputs["Classifier"].setDirty(slcs)
 
+    def _invalidateTrainingSets(self, lanes):
+        with self._lock:
+            for lane in lanes:
+                self._trainingSets.pop(lane, None)
+                self._generations[lane] += 1
+
     def _warnBadObjects(self, bad_objects, bad_feats):
         messageTesting = False
         if len(bad_feats)>0 or any([len(bad_objects[i])>0 for i in bad_objects.keys()]) or messageTesting:
@@ -720,6 +844,12 @@ class OpObjectPredict(Operator):
     Performs prediction on all objects in a time slice at once, and
     caches the result.
 
+    The cache is kept per time slice: each time slice is computed
+    exactly once under its own lock, so requests for different time
+    slices run concurrently. Dirty features only invalidate the
+    affected time slices. A new classifier invalidates the
+    predictions, but not the cached feature matrices.
+
     """
     # WARNING: right now we predict and cache a whole time slice. We
     # expect this to be fast because there are relatively few objects
@@ -743,6 +873,25 @@ class OpObjectPredict(Operator):
 
     #SegmentationThreshold = 0.5
 
+    def __init__(self, *args, **kwargs):
+        super(OpObjectPredict, self).__init__(*args, **kwargs)
+        self._resetCaches()
+
+    def _resetCaches(self):
+        # one lock per time slice, see _lockForTime()
+        self._time_locks = {}
+
+        # time slice -> averaged probabilities
+        self.prob_cache = dict()
+
+        # time slice -> feature matrix (missing values replaced)
+        self.feature_cache = dict()
+        self.bad_objects = dict()
+
+        # time slice -> number of invalidations. Used to discard
+        # results that were computed from stale inputs.
+        self._generations = defaultdict(int)
+
     def setupOutputs(self):
         self.Predictions.meta.shape = self.Features.meta.shape
         self.Predictions.meta.dtype = object
@@ -769,9 +918,52 @@ class OpObjectPredict(Operator):
                 oslot.meta.axistags = None
                 oslot.meta.mapping_dtype = numpy.float32
 
-        self.lock = RequestLock()
-        self.prob_cache = dict()
-        self.bad_objects = dict()
+        self._resetCaches()
+
+    def _lockForTime(self, t):
+        # dict.setdefault() is atomic, so all requests get the same lock
+        return self._time_locks.setdefault(t, RequestLock())
+
+    def _getFeatureMatrix(self, t, selected):
+        """Return the feature matrix of time slice t and the objects
+        with missing features, computing them if necessary.
+
+        Must be called with the lock of time slice t held.
+
+        """
+        if t not in self.feature_cache:
+            generation = self._generations[t]
+            tmpfeats = self.Features([t]).wait()
+            ftmatrix, _, col_names = make_feature_array(tmpfeats, selected)
+            rows, cols = replace_missing(ftmatrix)
+            bad_objects = numpy.zeros((ftmatrix.shape[0],))
+            bad_objects[rows] = 1
+            if generation != self._generations[t]:
+                # the features changed while we were computing
+                return ftmatrix, bad_objects
+            self.feature_cache[t] = ftmatrix
+            self.bad_objects[t] = bad_objects
+        return self.feature_cache[t], self.bad_objects[t]
+
+    def _getProbabilities(self, t, forests, selected):
+        """Return the averaged probabilities of time slice t,
+        computing them exactly once."""
+        lock = self._lockForTime(t)
+        lock.acquire()
+        try:
+            if t in self.prob_cache:
+                return self.prob_cache[t]
+            generation = self._generations[t]
+            ftmatrix, _ = self._getFeatureMatrix(t, selected)
+
+            averaged_predictions = predict_probabilities(forests, ftmatrix)
+            averaged_predictions[0] = 0 # Background probability is always zero
+
+            if generation == self._generations[t]:
+                self.prob_cache[t] = averaged_predictions
+            return averaged_predictions
+        finally:
+            lock.release()
 
     def execute(self, slot, subindex, roi, result):
         assert slot in [self.Predictions,
@@ -793,99 +985,83 @@ class OpObjectPredict(Operator):
             # this happens if there was no data to train with
             return dict((t, numpy.array([])) for t in times)
 
-        feats = {}
-        prob_predictions = {}
-
         selected = self.SelectedFeatures([]).wait()
 
-        # FIXME: self.prob_cache is shared, so we need to block.
-        # However, this makes prediction single-threaded.
-        self.lock.acquire()
-        try:
+        if slot == self.BadObjects:
+            bad_objects = {}
             for t in times:
-                if t in self.prob_cache:
-                    continue
-
-                tmpfeats = self.Features([t]).wait()
-                ftmatrix, _, col_names = make_feature_array(tmpfeats, selected)
-                rows, cols = replace_missing(ftmatrix)
-                self.bad_objects[t] = numpy.zeros((ftmatrix.shape[0],))
-                self.bad_objects[t][rows] = 1
-                feats[t] = ftmatrix
-                prob_predictions[t] = [0] * len(forests)
-
-            def predict_forest(_t, forest_index):
-                # Note: We can't use RandomForest.predictLabels() here because we're training in parallel,
-                #        and we have to average the PROBABILITIES from all forests.
-                #       Averaging the label predictions from each forest is NOT equivalent.
-                #       For details please see wikipedia:
-                #       http://en.wikipedia.org/wiki/Electoral_College_%28United_States%29#Irrelevancy_of_national_popular_vote
-                #       (^-^)
-                prob_predictions[_t][forest_index] = forests[forest_index].predictProbabilities(feats[_t].astype(numpy.float32))
-
-            # predict the data with all the forests in parallel
-            pool = RequestPool()
-            for t in times:
-                if t in self.prob_cache:
-                    continue
-                for i, f in enumerate(forests):
-                    req = Request( partial(predict_forest, t, i) )
-                    pool.add(req)
-
-            pool.wait()
-            pool.clean()
-
-            for t in times:
-                if t not in self.prob_cache:
-                    # prob_predictions is a dict-of-lists-of-arrays, indexed as follows:
-                    # prob_predictions[t][forest_index][object_index, class_index]
-
-                    # Stack the forests together and average them.
-                    stacked_predictions = numpy.array( prob_predictions[t] )
-                    averaged_predictions = numpy.average( stacked_predictions, axis=0 )
-                    assert averaged_predictions.shape[0] == len(feats[t])
-                    self.prob_cache[t] = averaged_predictions
-
-                    self.prob_cache[t][0] = 0 # Background probability is always zero
-
-
-            if slot == self.Probabilities:
-                return { t : self.prob_cache[t] for t in times }
-            elif slot == self.Predictions:
-                # FIXME: Support SegmentationThreshold again...
-                labels = dict()
-                for t in times:
-                    prob_sum = numpy.sum(self.prob_cache[t], axis=1)
-                    labels[t] = 1 + numpy.argmax(self.prob_cache[t], axis=1)
-                    labels[t][0] = 0 # Background gets the zero label
-                
-                return labels
-
-            elif slot == self.ProbabilityChannels:
+                lock = self._lockForTime(t)
+                lock.acquire()
                 try:
-                    prob_single_channel = {t: self.prob_cache[t][:, subindex[0]]
-                                           for t in times}
-                except:
-                    # no probabilities available for this class; return zeros
-                    prob_single_channel = {t: numpy.zeros((self.prob_cache[t].shape[0], 1))
-                                           for t in times}
-                return prob_single_channel
+                    _, bad_objects[t] = self._getFeatureMatrix(t, selected)
+                finally:
+                    lock.release()
+            return bad_objects
+
+        # compute the time slices in parallel
+        probs = {}
+        pool = RequestPool()
+        for t in times:
+            def store_probabilities(_t):
+                probs[_t] = self._getProbabilities(_t, forests, selected)
+            pool.add( Request( partial(store_probabilities, t) ) )
+        pool.wait()
+        pool.clean()
+
+        if slot == self.Probabilities:
+            return probs
+        elif slot == self.Predictions:
+            # FIXME: Support SegmentationThreshold again...
+            labels = dict()
+            for t in times:
+                labels[t] = 1 + numpy.argmax(probs[t], axis=1)
+                labels[t][0] = 0 # Background gets the zero label
+            return labels
+
+        elif slot == self.ProbabilityChannels:
+            try:
+                prob_single_channel = {t: probs[t][:, subindex[0]]
+                                       for t in times}
+            except:
+                # no probabilities available for this class; return zeros
+                prob_single_channel = {t: numpy.zeros((probs[t].shape[0], 1))
+                                       for t in times}
+            return prob_single_channel
 
-            elif slot == self.BadObjects:
-                return { t : self.bad_objects[t] for t in times }
+        else:
+            assert False, "Unknown input slot"
 
-            else:
-                assert False, "Unknown input slot"
-        finally:
-            self.lock.release()
+    def _invalidate(self, times, features=False):
+        """Drop the cached results of the given time slices."""
+        for t in times:
+            self._generations[t] += 1
+            self.prob_cache.pop(t, None)
+            if features:
+                self.feature_cache.pop(t, None)
+                self.bad_objects.pop(t, None)
 
     def propagateDirty(self, slot, subindex, roi):
-        self.prob_cache = {}
+        all_times = range(self.Predictions.meta.shape[0]) if self.Predictions.meta.shape else []
+        if slot is self.Features and len(roi._l) > 0 and isinstance(roi._l[0], int):
+            # Only some time slices have new features
+            times = list(roi._l)
+            self._invalidate(times, features=True)
+            self.Predictions.setDirty(List(self.Predictions, times))
+            self.Probabilities.setDirty(List(self.Probabilities, times))
+            self.BadObjects.setDirty(List(self.BadObjects, times))
+            for oslot in self.ProbabilityChannels:
+                oslot.setDirty(List(oslot, times))
+            return
+
+        features_changed = slot is self.Features or slot is self.SelectedFeatures
+        self._invalidate(set(all_times) | set(self.prob_cache.keys()), features=features_changed)
         if slot is self.InputProbabilities:
             self.prob_cache = self.InputProbabilities([]).wait()
         self.Predictions.setDirty(())
         self.Probabilities.setDirty(())
         self.ProbabilityChannels.setDirty(())
+        if features_changed:
+            self.BadObjects.setDirty(())
 
 
 class OpRelabelSegmentation(Operator):
@@ -6,6 +6,7 @@ ilastik.ilastik_logging.default_config.init()
 from copy import copy
 import collections
 from collections import defaultdict
+from functools import partial
 
 #SciPy
 import numpy as np
@@ -15,7 +16,8 @@ import vigra.analysis
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OperatorWrapper
 from lazyflow.stype import Opaque
 from lazyflow.rtype import List
-from lazyflow.roi import roiToSlice
+from lazyflow.roi import roiToSlice, roiFromShape, getIntersectingBlocks, getBlockBounds
+from lazyflow.request import Request, RequestPool
 from lazyflow.operators import OpCachedLabelImage, OpMultiArraySlicer2, OpMultiArrayStacker, OpArrayCache, OpCompressedCache
 
 import logging
@@ -28,6 +30,7 @@ except:
     logger.warn('could not import pluginManager')
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.objectExtraction.regionStatistics import RegionStatistics
 
 import collections
 
@@ -96,6 +99,62 @@ def make_bboxes(binary_bbox, margin):
     return passed, context
 
 
+def finalize_features(all_features, nobj):
+    """Check and reshape the features of all plugins, and add the
+    background row.
+
+    Helper for feature computations.
+
+    """
+    # reshape all features
+    for pfeats in all_features.itervalues():
+        for key, value in pfeats.iteritems():
+            if value.shape[0] != nobj:
+                raise Exception('feature {} does not have enough rows, {} instead of {}'.format(key, value.shape[0], nobj))
+
+            # because object classification operator expects nobj to
+            # include background. FIXME: we should change that assumption.
+            value = np.vstack((np.zeros(value.shape[1]),
+                               value))
+
+            value = value.astype(np.float32) #turn Nones into numpy.NaNs
+
+            assert value.dtype == np.float32
+            assert value.shape[0] == nobj+1
+            assert value.ndim == 2
+
+            pfeats[key] = value
+    logger.debug("merged, returning")
+    return all_features
+
+
+def features_mergeable(feature_names):
+    """True if all selected features can be computed blockwise (see
+    ObjectFeaturesPlugin.mergeableFeatures)."""
+    for plugin_name, feature_dict in feature_names.iteritems():
+        plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
+        if not set(feature_dict.keys()) <= set(plugin.plugin_object.mergeableFeatures()):
+            logger.debug("{} has features that are not mergeable".format(plugin_name))
+            return False
+    return True
+
+def features_from_statistics(stats, feature_names):
+    """Compute the (mergeable) features and the default features from
+    merged RegionStatistics.
+
+    Returns the same nested dictionary as OpRegionFeatures3d.
+
+    """
+    all_features = {}
+    for plugin_name, feature_dict in feature_names.iteritems():
+        plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
+        all_features[plugin_name] = plugin.plugin_object.compute_merged(stats, feature_dict)
+
+    merged = stats.features()
+    all_features[default_features_key] = dict((k, merged[k]) for k in default_features)
+    return finalize_features(all_features, stats.nlabels - 1)
+
+
 class OpRegionFeatures3d(Operator):
     """Produces region features for a 3d image.
 
@@ -111,6 +170,11 @@ class OpRegionFeatures3d(Operator):
     * Features : a nested dictionary of features to compute.
       Features[plugin name][feature name][parameter name] = parameter value
 
+    * BlockShape : (optional) spatial block shape, in the order of the
+      spatial axes of the input. If given, and all selected features
+      are mergeable, the features are computed block by block and
+      the volume is never loaded as a whole.
+
     Outputs:
 
     * Output : a nested dictionary of features.
@@ -120,9 +184,16 @@ class OpRegionFeatures3d(Operator):
     RawVolume = InputSlot()
     LabelVolume = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    BlockShape = InputSlot(optional=True)
 
     Output = OutputSlot()
 
+    # Number of blocks that are computed at the same time in blockwise mode
+    BlockwiseConcurrency = 4
+
+    # Number of objects per request when computing local features
+    LocalFeaturesBatchSize = 100
+
     def setupOutputs(self):
         if self.LabelVolume.meta.axistags != self.RawVolume.meta.axistags:
             raise Exception('raw and label axis tags do not match')
@@ -157,29 +228,82 @@ class OpRegionFeatures3d(Operator):
         assert slot == self.Output
         import time
         start = time.time()
-        # Process ENTIRE volume
-        rawVolume = self.RawVolume[:].wait()
-        labelVolume = self.LabelVolume[:].wait()
-
-        # Convert to 4D (preserve axis order)
-        axes4d = self.RawVolume.meta.getTaggedShape().keys()
-        axes4d = filter(lambda k: k in 'xyzc', axes4d)
-
-        rawVolume = rawVolume.view(vigra.VigraArray)
-        rawVolume.axistags = self.RawVolume.meta.axistags
-        rawVolume4d = rawVolume.withAxes(*axes4d)
-
-        labelVolume = labelVolume.view(vigra.VigraArray)
-        labelVolume.axistags = self.LabelVolume.meta.axistags
-        labelVolume4d = labelVolume.withAxes(*axes4d)
-
         assert np.prod(roi.stop - roi.start) == 1
-        acc = self._extract(rawVolume4d, labelVolume4d)
+        if self.BlockShape.ready() and features_mergeable(self.Features([]).wait()):
+            acc = self._extractBlockwise()
+        else:
+            # Process ENTIRE volume
+            rawVolume = self.RawVolume[:].wait()
+            labelVolume = self.LabelVolume[:].wait()
+            acc = self._extract(self._to4d(rawVolume, self.RawVolume),
+                                self._to4d(labelVolume, self.LabelVolume))
         result[tuple(roi.start)] = acc
         stop = time.time()
         logger.info("TIMING: computing features took {:.3f}s".format(stop-start))
         return result
 
+    def _to4d(self, data, slot):
+        """View data from slot as a 4D VigraArray (preserve axis order)."""
+        axes4d = filter(lambda k: k in 'xyzc', slot.meta.getTaggedShape().keys())
+        data = data.view(vigra.VigraArray)
+        data.axistags = slot.meta.axistags
+        return data.withAxes(*axes4d)
+
+    def _extractBlockwise(self):
+        """Compute the (mergeable) features block by block.
+
+        Only BlockwiseConcurrency blocks of the raw and label volumes
+        are in memory at the same time.
+
+        """
+        feature_names = self.Features([]).wait()
+
+        taggedShape = self.RawVolume.meta.getTaggedShape()
+        spatial_axes = filter(lambda k: k in 'xyz', taggedShape.keys())
+        if taggedShape['z'] == 1:
+            # vigra features of 2D data have 2 coordinates
+            spatial_axes.remove('z')
+        block_spatial = dict(zip(filter(lambda k: k in 'xyz', taggedShape.keys()),
+                                 self.BlockShape.value))
+
+        shape = self.RawVolume.meta.shape
+        block_shape = [block_spatial.get(k, n) for k, n in taggedShape.items()]
+        block_shape = np.minimum(block_shape, shape)
+        block_starts = getIntersectingBlocks(block_shape, roiFromShape(shape))
+        channel_index = taggedShape.keys().index('c')
+        spatial_indexes = [taggedShape.keys().index(k) for k in spatial_axes]
+
+        def compute_block(block_start):
+            block_roi = getBlockBounds(shape, block_shape, block_start)
+            raw = self.RawVolume(*block_roi).wait()
+            labels = self.LabelVolume(*block_roi).wait()
+            raw = raw.view(vigra.VigraArray)
+            raw.axistags = self.RawVolume.meta.axistags
+            labels = labels.view(vigra.VigraArray)
+            labels.axistags = self.LabelVolume.meta.axistags
+            offset = [block_roi[0][i] for i in spatial_indexes]
+            return RegionStatistics.fromBlock(np.asarray(raw.withAxes(*(spatial_axes + ['c']))),
+                                              np.asarray(labels.withAxes(*spatial_axes)),
+                                              offset)
+
+        stats = RegionStatistics(shape[channel_index], len(spatial_axes))
+        concurrency = self.BlockwiseConcurrency
+        for wave_start in range(0, len(block_starts), concurrency):
+            wave = block_starts[wave_start:wave_start + concurrency]
+            block_stats = [None] * len(wave)
+            pool = RequestPool()
+            for i, block_start in enumerate(wave):
+                def store_block(i, block_start):
+                    block_stats[i] = compute_block(block_start)
+                pool.add( Request( partial(store_block, i, block_start) ) )
+            pool.wait()
+            pool.clean()
+            for block_stat in block_stats:
+                stats.merge(block_stat)
+        logger.debug("merged statistics of {} blocks".format(len(block_starts)))
+
+        return features_from_statistics(stats, feature_names)
+
     def compute_extent(self, i, image, mincoords, maxcoords, axes, margin):
         """Make a slicing to extract object i from the image."""
         #find the bounding box (margin is always 'xyz' order)
@@ -212,6 +336,42 @@ class OpRegionFeatures3d(Operator):
         key.insert(axes.c, slice(None))
         return image[tuple(key)]
 
+    def compute_extents(self, image, mincoords, maxcoords, axes, margin):
+        """Vectorized version of compute_extent() for all objects at once.
+
+        Returns (starts, stops), two arrays of shape (nobj, 3) in the
+        spatial axis order of the image.
+
+        """
+        nobj = mincoords.shape[0]
+        starts = np.zeros((nobj, 3), dtype=np.intp)
+        stops = np.ones((nobj, 3), dtype=np.intp)
+        for ax in (axes.x, axes.y, axes.z):
+            if ax >= mincoords.shape[1]:
+                # 2d data: no z coordinates, the extent is [0, 1)
+                continue
+            starts[:, ax] = np.maximum(mincoords[:, ax] - margin[ax], 0)
+            # [min,max] coords -> [min,max) bounding box, hence the +1
+            stops[:, ax] = np.minimum(maxcoords[:, ax] + 1 + margin[ax], image.shape[ax])
+        return starts, stops
+
+    def _compute_local_batch(self, image, labels, plugins, feature_names, starts, stops, axes, first, last):
+        """Compute the local features of objects [first, last).
+
+        Returns a dict: result[plugin_name] = list of per-object feature dicts.
+
+        """
+        result = dict((plugin_name, []) for plugin_name in plugins)
+        for i in range(first, last):
+            extent = [slice(start, stop) for start, stop in zip(starts[i], stops[i])]
+            rawbbox = self.compute_rawbbox(image, extent, axes)
+            #it's i+1 here, because the background has label 0
+            binary_bbox = (labels[tuple(extent)] == i+1)
+            for plugin_name, plugin in plugins.iteritems():
+                feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_names[plugin_name], axes)
+                result[plugin_name].append(feats)
+        return result
+
     def _extract(self, image, labels):
         if not (image.ndim == labels.ndim == 4):
             raise Exception("both images must be 4D. raw image shape: {}"
@@ -287,29 +447,37 @@ class OpRegionFeatures3d(Operator):
 
         local_features = defaultdict(lambda: defaultdict(list))
         margin = max_margin(feature_names)
-        has_local_features = {}
+        local_plugins = {}
         for plugin_name, feature_dict in feature_names.iteritems():
-            has_local_features[plugin_name] = False
             for features in feature_dict.itervalues():
                 if 'margin' in features:
-                    has_local_features[plugin_name] = True
+                    local_plugins[plugin_name] = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
                     break
-            
-                            
-        if np.any(margin) > 0:
-            #starting from 0, we stripped 0th background object in global computation
-            for i in range(0, nobj):
-                logger.debug("processing object {}".format(i))
-                extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
-                rawbbox = self.compute_rawbbox(image, extent, axes)
-                #it's i+1 here, because the background has label 0
-                binary_bbox = np.where(labels[tuple(extent)] == i+1, 1, 0).astype(np.bool)
-                for plugin_name, feature_dict in feature_names.iteritems():
-                    if not has_local_features[plugin_name]:
-                        continue
-                    plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
-                    feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes)
-                    local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
+
+        if np.any(margin) > 0 and nobj > 0 and local_plugins:
+            starts, stops = self.compute_extents(image, mincoords, maxcoords, axes, margin)
+
+            # Split the objects into batches and compute them in parallel.
+            batch_size = self.LocalFeaturesBatchSize
+            batch_bounds = [(first, min(first + batch_size, nobj))
+                            for first in range(0, nobj, batch_size)]
+            batch_results = [None] * len(batch_bounds)
+
+            pool = RequestPool()
+            for batch_index, (first, last) in enumerate(batch_bounds):
+                def compute_batch(batch_index, first, last):
+                    batch_results[batch_index] = self._compute_local_batch(
+                        image, labels, local_plugins, feature_names,
+                        starts, stops, axes, first, last)
+                pool.add( Request( partial(compute_batch, batch_index, first, last) ) )
+            pool.wait()
+            pool.clean()
+
+            # Assemble in object order, so the output layout is the same as before.
+            for batch in batch_results:
+                for plugin_name, feats_list in batch.iteritems():
+                    for feats in feats_list:
+                        local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
 
         logger.debug("computing done, removing failures")
         # remove local features that failed
@@ -332,30 +500,14 @@ class OpRegionFeatures3d(Operator):
             all_features[name] = dict(d1.items() + d2.items())
         all_features[default_features_key]=extrafeats
 
-        # reshape all features
-        for pfeats in all_features.itervalues():
-            for key, value in pfeats.iteritems():
-                if value.shape[0] != nobj:
-                    raise Exception('feature {} does not have enough rows, {} instead of {}'.format(key, value.shape[0], nobj))
-
-                # because object classification operator expects nobj to
-                # include background. FIXME: we should change that assumption.
-                value = np.vstack((np.zeros(value.shape[1]),
-                                   value))
-
-                value = value.astype(np.float32) #turn Nones into numpy.NaNs
-
-                assert value.dtype == np.float32
-                assert value.shape[0] == nobj+1
-                assert value.ndim == 2
-
-                pfeats[key] = value
-        logger.debug("merged, returning")
-        return all_features
+        return finalize_features(all_features, nobj)
 
     def propagateDirty(self, slot, subindex, roi):
         if slot is self.Features:
             self.Output.setDirty(slice(None))
+        elif slot is self.BlockShape:
+            # Blockwise results are exact, so they don't depend on the block shape.
+            pass
         else:
             axes = self.RawVolume.meta.getTaggedShape().keys()
             dirtyStart = collections.OrderedDict(zip(axes, roi.start))
@@ -379,6 +531,7 @@ class OpRegionFeatures(Operator):
     RawImage = InputSlot()
     LabelImage = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    BlockShape = InputSlot(optional=True)
     Output = OutputSlot()
 
     # Schematic:
@@ -408,6 +561,7 @@ class OpRegionFeatures(Operator):
         self.opRegionFeatures3dBlocks.RawVolume.connect(self.opRawTimeSlicer.Slices)
         self.opRegionFeatures3dBlocks.LabelVolume.connect(self.opLabelTimeSlicer.Slices)
         self.opRegionFeatures3dBlocks.Features.connect(self.Features)
+        self.opRegionFeatures3dBlocks.BlockShape.connect(self.BlockShape)
         assert self.opRegionFeatures3dBlocks.Output.level == 1
 
         self.opTimeStacker = OpMultiArrayStacker(parent=self)
@@ -433,6 +587,7 @@ class OpCachedRegionFeatures(Operator):
     LabelImage = InputSlot()
     CacheInput = InputSlot(optional=True)
     Features = InputSlot(rtype=List, stype=Opaque)
+    BlockShape = InputSlot(optional=True)
 
     Output = OutputSlot()
     CleanBlocks = OutputSlot()
@@ -453,6 +608,7 @@ class OpCachedRegionFeatures(Operator):
         self._opRegionFeatures.RawImage.connect(self.RawImage)
         self._opRegionFeatures.LabelImage.connect(self.LabelImage)
         self._opRegionFeatures.Features.connect(self.Features)
+        self._opRegionFeatures.BlockShape.connect(self.BlockShape)
 
         # Hook up the cache.
         self._opCache = OpArrayCache(parent=self)
@@ -609,6 +765,10 @@ class OpObjectExtraction(Operator):
     # for example {"Standard Object Features": {"Mean in neighborhood":{"margin": (5, 5, 2)}}}
     Features = InputSlot(rtype=List, stype=Opaque, value={})
 
+    # optional spatial block shape for out-of-core feature computation
+    # (only used if all selected features are mergeable)
+    RegionFeaturesBlockShape = InputSlot(optional=True)
+
     LabelImage = OutputSlot()
     ObjectCenterImage = OutputSlot()
 
@@ -658,6 +818,7 @@ class OpObjectExtraction(Operator):
         self._opRegFeats.RawImage.connect(self.RawImage)
         self._opRegFeats.LabelImage.connect(self._opLabelImage.Output)
         self._opRegFeats.Features.connect(self.Features)
+        self._opRegFeats.BlockShape.connect(self.RegionFeaturesBlockShape)
         self.RegionFeaturesCleanBlocks.connect(self._opRegFeats.CleanBlocks)
 
         self._opRegFeats.CacheInput.connect(self.RegionFeaturesCacheInput)
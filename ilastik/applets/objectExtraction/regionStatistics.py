@@ -0,0 +1,178 @@
+import numpy as np
+
+class RegionStatistics(object):
+    """Per-label accumulator statistics that can be computed on blocks
+    of a label image and merged into exact global results.
+
+    All arrays are indexed by label id (row 0 is the background and is
+    never accumulated):
+
+    * count : number of pixels
+    * mean, m2 : per channel mean and sum of squared deviations from
+      the mean (merged with the pairwise update of Chan et al.)
+    * minimum, maximum : per channel min/max of the raw values
+    * coord_min, coord_max : bounding box, inclusive, in global coordinates
+    * coord_sum : sum of the pixel coordinates
+
+    """
+    _fields = ('count', 'mean', 'm2', 'minimum', 'maximum',
+               'coord_min', 'coord_max', 'coord_sum')
+
+    def __init__(self, nchannels, ndim):
+        self.nchannels = nchannels
+        self.ndim = ndim
+        self._allocate(1)
+
+    def _allocate(self, nlabels):
+        self.count = np.zeros((nlabels,), dtype=np.int64)
+        self.mean = np.zeros((nlabels, self.nchannels), dtype=np.float64)
+        self.m2 = np.zeros((nlabels, self.nchannels), dtype=np.float64)
+        self.minimum = np.empty((nlabels, self.nchannels), dtype=np.float64)
+        self.minimum[:] = np.inf
+        self.maximum = np.empty((nlabels, self.nchannels), dtype=np.float64)
+        self.maximum[:] = -np.inf
+        self.coord_min = np.empty((nlabels, self.ndim), dtype=np.int64)
+        self.coord_min[:] = np.iinfo(np.int64).max
+        self.coord_max = np.empty((nlabels, self.ndim), dtype=np.int64)
+        self.coord_max[:] = -1
+        self.coord_sum = np.zeros((nlabels, self.ndim), dtype=np.float64)
+
+    @property
+    def nlabels(self):
+        """Number of rows, including the background row."""
+        return self.count.shape[0]
+
+    def _grow(self, nlabels):
+        if nlabels <= self.nlabels:
+            return
+        old = dict((name, getattr(self, name)) for name in self._fields)
+        self._allocate(nlabels)
+        for name, array in old.iteritems():
+            getattr(self, name)[:len(array)] = array
+
+    @classmethod
+    def fromBlock(cls, image, labels, offset):
+        """Compute the statistics of one block.
+
+        :param image: raw data, shape (spatial..., c)
+        :param labels: label image, same spatial shape as image, no channel axis
+        :param offset: global coordinates of the first pixel of the block
+
+        """
+        assert image.shape[:-1] == labels.shape
+        ndim = labels.ndim
+        stats = cls(image.shape[-1], ndim)
+
+        flat_labels = np.asarray(labels).ravel()
+        indices = np.flatnonzero(flat_labels)
+        if len(indices) == 0:
+            return stats
+
+        # Sort the foreground pixels by label, so every statistic is a
+        # single reduceat() over contiguous runs.
+        flat_labels = flat_labels[indices]
+        order = np.argsort(flat_labels, kind='mergesort')
+        indices = indices[order]
+        flat_labels = flat_labels[order]
+        present, run_starts = np.unique(flat_labels, return_index=True)
+        present = present.astype(np.intp)
+        counts = np.diff(np.append(run_starts, len(flat_labels)))
+
+        stats._grow(present[-1] + 1)
+        stats.count[present] = counts
+
+        values = np.asarray(image).reshape(-1, image.shape[-1])[indices].astype(np.float64)
+        sums = np.add.reduceat(values, run_starts, axis=0)
+        means = sums / counts[:, None]
+        deviations = values - np.repeat(means, counts, axis=0)
+        stats.mean[present] = means
+        stats.m2[present] = np.add.reduceat(deviations**2, run_starts, axis=0)
+        stats.minimum[present] = np.minimum.reduceat(values, run_starts, axis=0)
+        stats.maximum[present] = np.maximum.reduceat(values, run_starts, axis=0)
+
+        coords = np.column_stack(np.unravel_index(indices, labels.shape))
+        coords += np.asarray(offset, dtype=coords.dtype)
+        stats.coord_min[present] = np.minimum.reduceat(coords, run_starts, axis=0)
+        stats.coord_max[present] = np.maximum.reduceat(coords, run_starts, axis=0)
+        stats.coord_sum[present] = np.add.reduceat(coords.astype(np.float64), run_starts, axis=0)
+        return stats
+
+    def merge(self, other):
+        """Merge the statistics of another block into this one (in place)."""
+        self._grow(other.nlabels)
+        rows = np.arange(other.nlabels)
+        self._mergeRows(rows, other, rows)
+        return self
+
+    def mergeRelabeled(self, other, mapping):
+        """Merge row i of other into row mapping[i] of this one (in place).
+
+        Several rows of other may be mapped to the same row, e.g. when
+        objects of a block turn out to be connected through other blocks.
+
+        """
+        src = np.arange(1, other.nlabels)
+        dst = np.asarray(mapping)[src]
+        nonempty = other.count[src] > 0
+        src, dst = src[nonempty], dst[nonempty]
+        if len(dst) > 0:
+            self._grow(dst.max() + 1)
+        # _mergeRows() needs unique destination rows, so merge the
+        # duplicates in several rounds
+        while len(src) > 0:
+            _, first = np.unique(dst, return_index=True)
+            self._mergeRows(dst[first], other, src[first])
+            remaining = np.ones(len(src), dtype=bool)
+            remaining[first] = False
+            src, dst = src[remaining], dst[remaining]
+        return self
+
+    def _mergeRows(self, dst, other, src):
+        """Merge the rows src of other into the (unique) rows dst of this one."""
+        assert other.nchannels == self.nchannels and other.ndim == self.ndim
+
+        na = self.count[dst].astype(np.float64)[:, None]
+        nb = other.count[src].astype(np.float64)[:, None]
+        total = na + nb
+        nonempty = total[:, 0] > 0
+        delta = other.mean[src] - self.mean[dst]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.mean[dst] + delta * nb / total
+            m2 = self.m2[dst] + other.m2[src] + delta**2 * na * nb / total
+        self.mean[dst[nonempty]] = mean[nonempty]
+        self.m2[dst[nonempty]] = m2[nonempty]
+
+        self.count[dst] += other.count[src]
+        self.minimum[dst] = np.minimum(self.minimum[dst], other.minimum[src])
+        self.maximum[dst] = np.maximum(self.maximum[dst], other.maximum[src])
+        self.coord_min[dst] = np.minimum(self.coord_min[dst], other.coord_min[src])
+        self.coord_max[dst] = np.maximum(self.coord_max[dst], other.coord_max[src])
+        self.coord_sum[dst] += other.coord_sum[src]
+
+    def _objects(self, array, empty_value=0):
+        """Return array without the background row, with empty labels
+        set to empty_value."""
+        result = np.array(array[1:], dtype=np.float64)
+        result[self.count[1:] == 0] = empty_value
+        return result
+
+    def features(self):
+        """Final feature values for all labels except the background.
+
+        Returns a dict of 2d arrays (one row per object) named like the
+        corresponding vigra region features.
+
+        """
+        counts = self.count[1:].astype(np.float64)
+        safe_counts = np.maximum(counts, 1)[:, None]
+        return {
+            'Count' : counts.reshape(-1, 1),
+            'Sum' : self._objects(self.mean * self.count[:, None]),
+            'Mean' : self._objects(self.mean),
+            'Variance' : self._objects(self.m2) / safe_counts,
+            'Minimum' : self._objects(self.minimum),
+            'Maximum' : self._objects(self.maximum),
+            'Coord<Minimum>' : self._objects(self.coord_min),
+            'Coord<Maximum>' : self._objects(self.coord_max),
+            'RegionCenter' : self._objects(self.coord_sum) / safe_counts,
+        }
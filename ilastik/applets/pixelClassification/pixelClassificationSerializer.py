@@ -20,7 +20,8 @@ class PixelClassificationSerializer(AppletSerializer):
                                  name='LabelSets',
                                  subname='labels{:03d}',
                                  selfdepends=False,
-                                 shrink_to_bb=True),
+                                 shrink_to_bb=True,
+                                 compression='gzip'),
                  self._serialClassifierSlot ]
 
         super(PixelClassificationSerializer, self).__init__(projectFileGroupName, slots, operator)
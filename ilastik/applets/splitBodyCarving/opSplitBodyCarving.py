@@ -55,7 +55,7 @@ class OpSplitBodyCarving( OpCarving ):
         
         # LUTs of all fragments of the current Raveler body are combined into a single LUT
         self._opFragmentSetLut = OpFragmentSetLut( parent=self )
-        self._opFragmentSetLut.MST.connect( self._opMstCache.Output )
+        self._opFragmentSetLut.MST.connect( self.MstOut )
         self._opFragmentSetLut.RavelerLabel.connect( self.CurrentRavelerLabel )
         self._opFragmentSetLut.CurrentEditingFragment.connect( self.CurrentEditingFragment )
         self._opFragmentSetLut.Trigger.connect( self.Trigger )
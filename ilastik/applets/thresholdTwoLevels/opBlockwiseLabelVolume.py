@@ -0,0 +1,194 @@
+# Built-in
+import logging
+import itertools
+from functools import partial
+
+# Third-party
+import numpy
+
+# Lazyflow
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool, RequestLock
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiFromShape
+
+# ilastik
+from ilastik.applets.blockwiseObjectClassification.objectStitching import labelBlock, BlockLabels, stitchLabels
+
+logger = logging.getLogger(__name__)
+
+class BlockwiseLabeling(object):
+    """
+    The result of labeling one spatial volume (one time slice and channel) block by block.
+
+    * block_luts[block_start]: maps the labels of labelBlock() on this block to global labels
+    * sizes[label]: the size of each global object (sizes[0] is the background)
+
+    """
+    def __init__(self, block_luts, sizes):
+        self.block_luts = block_luts
+        self.sizes = sizes
+
+class OpBlockwiseLabelVolume(Operator):
+    """
+    Connected component labeling of a binary image, one spatial block at a time.
+
+    The first request for a time slice (and channel) labels all of its blocks once
+    to stitch the objects across the block faces into one global relabeling map.
+    Only the (small) maps are kept. Afterwards, each request labels just the blocks
+    it intersects and applies the map, so the cost of a small request does not
+    depend on the size of the volume.
+
+    FilteredOutput is Output with all objects smaller than MinSize or larger than
+    MaxSize removed, based on the sizes of the whole objects.
+    """
+    Input = InputSlot()
+    BlockShape = InputSlot(optional=True) # dict of { spatial axis key : block size }, whole volume if not given
+    MinSize = InputSlot(stype='int', value=0)
+    MaxSize = InputSlot(stype='int', value=1000000)
+    MaxConcurrentBlocks = InputSlot( value=4 ) # How many blocks may be labeled at the same time
+
+    Output = OutputSlot()
+    FilteredOutput = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super(OpBlockwiseLabelVolume, self).__init__(*args, **kwargs)
+        self._lock = RequestLock()
+        self._labelings = {}
+
+    def setupOutputs(self):
+        for slot in (self.Output, self.FilteredOutput):
+            slot.meta.assignFrom( self.Input.meta )
+            slot.meta.dtype = numpy.uint32
+            slot.meta.drange = None
+
+        # For 2D data, the z axis is not part of the blocks, like in object extraction.
+        tagged_shape = self.Input.meta.getTaggedShape()
+        axiskeys = tagged_shape.keys()
+        self._spatialAxes = [ i for i, k in enumerate(axiskeys) if k in 'xyz' ]
+        if tagged_shape.get('z', 1) == 1 and 'z' in axiskeys:
+            self._spatialAxes.remove( axiskeys.index('z') )
+        self._otherAxes = [ i for i in range(len(axiskeys)) if i not in self._spatialAxes ]
+
+        self._spatialShape = [ self.Input.meta.shape[i] for i in self._spatialAxes ]
+        block_shape = {}
+        if self.BlockShape.ready():
+            block_shape = self.BlockShape.value
+        self._spatialBlockShape = [ min( block_shape.get(axiskeys[i], n), n )
+                                    for i, n in zip(self._spatialAxes, self._spatialShape) ]
+
+        with self._lock:
+            self._labelings = {}
+
+    def _labelSpatialBlock(self, other_index, start, stop):
+        """
+        Read and label one block of the spatial volume at other_index
+        (the indexes of the non-spatial axes).
+        """
+        full_start = [0] * len(self.Input.meta.shape)
+        full_stop = [0] * len(self.Input.meta.shape)
+        for i, v in zip(self._otherAxes, other_index):
+            full_start[i], full_stop[i] = v, v+1
+        for i, v, w in zip(self._spatialAxes, start, stop):
+            full_start[i], full_stop[i] = v, w
+        data = self.Input( full_start, full_stop ).wait()
+        # Drop the non-spatial axes
+        data = data[ tuple( 0 if i in self._otherAxes else slice(None) for i in range(data.ndim) ) ]
+        return labelBlock( data )
+
+    def _getLabeling(self, other_index):
+        """
+        Label all blocks of the spatial volume at other_index and stitch them (computed only once).
+        """
+        with self._lock:
+            if other_index in self._labelings:
+                return self._labelings[other_index]
+
+            block_starts = getIntersectingBlocks( self._spatialBlockShape, roiFromShape(self._spatialShape) )
+            blocks = [None] * len(block_starts)
+            local_sizes = [None] * len(block_starts)
+
+            def computeBlock(block_index, block_start):
+                start, stop = getBlockBounds( self._spatialShape, self._spatialBlockShape, block_start )
+                labels = self._labelSpatialBlock( other_index, start, stop )
+                blocks[block_index] = BlockLabels( start, stop, labels )
+                local_sizes[block_index] = numpy.bincount( labels.ravel(), minlength=blocks[block_index].nobjects+1 )
+
+            max_concurrent = max(1, self.MaxConcurrentBlocks.value)
+            for batch_start in range(0, len(block_starts), max_concurrent):
+                pool = RequestPool()
+                for block_index in range(batch_start, min(batch_start+max_concurrent, len(block_starts))):
+                    pool.add( Request( partial(computeBlock, block_index, block_starts[block_index]) ) )
+                pool.wait()
+                pool.clean()
+
+            block_luts, nobjects = stitchLabels( blocks, len(self._spatialAxes) )
+
+            sizes = numpy.zeros( (nobjects+1,), dtype=numpy.int64 )
+            for block, block_sizes in zip(blocks, local_sizes):
+                lut = block_luts[block.start]
+                sizes += numpy.bincount( lut, weights=block_sizes, minlength=nobjects+1 ).astype(numpy.int64)
+            sizes[0] = 0
+
+            block_luts = dict( (start, lut.astype(numpy.uint32)) for start, lut in block_luts.items() )
+            logger.debug( "Stitched {} blocks into {} objects".format( len(blocks), nobjects ) )
+            self._labelings[other_index] = BlockwiseLabeling( block_luts, sizes )
+            return self._labelings[other_index]
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot == self.Output or slot == self.FilteredOutput
+        start = numpy.array(roi.start)
+        stop = numpy.array(roi.stop)
+        spatial_roi = ( start[self._spatialAxes], stop[self._spatialAxes] )
+        other_ranges = [ range(start[i], stop[i]) for i in self._otherAxes ]
+
+        for other_index in itertools.product( *other_ranges ):
+            labeling = self._getLabeling( other_index )
+
+            size_lut = None
+            if slot == self.FilteredOutput:
+                sizes = labeling.sizes
+                size_lut = numpy.arange( len(sizes), dtype=numpy.uint32 )
+                size_lut[ (sizes < self.MinSize.value) | (sizes > self.MaxSize.value) ] = 0
+                size_lut[0] = 0
+
+            def processBlock(block_start):
+                block_start = tuple(block_start)
+                block_stop = getBlockBounds( self._spatialShape, self._spatialBlockShape, block_start )[1]
+                labels = labeling.block_luts[block_start][ self._labelSpatialBlock( other_index, block_start, block_stop ) ]
+                if size_lut is not None:
+                    labels = size_lut[labels]
+
+                intersection = getIntersection( (block_start, block_stop), spatial_roi )
+                result_slicing = [None] * result.ndim
+                for i, v in zip(self._otherAxes, other_index):
+                    result_slicing[i] = v - start[i]
+                block_slicing = []
+                for d, i in enumerate(self._spatialAxes):
+                    result_slicing[i] = slice( intersection[0][d] - start[i], intersection[1][d] - start[i] )
+                    block_slicing.append( slice( intersection[0][d] - block_start[d], intersection[1][d] - block_start[d] ) )
+                result[tuple(result_slicing)] = labels[tuple(block_slicing)]
+
+            block_starts = getIntersectingBlocks( self._spatialBlockShape, spatial_roi )
+            max_concurrent = max(1, self.MaxConcurrentBlocks.value)
+            for batch_start in range(0, len(block_starts), max_concurrent):
+                pool = RequestPool()
+                for block_start in block_starts[batch_start:batch_start+max_concurrent]:
+                    pool.add( Request( partial(processBlock, block_start) ) )
+                pool.wait()
+                pool.clean()
+
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.Input or slot == self.BlockShape:
+            # A change anywhere may merge or split objects elsewhere
+            with self._lock:
+                self._labelings = {}
+            self.Output.setDirty( slice(None) )
+            self.FilteredOutput.setDirty( slice(None) )
+        elif slot == self.MinSize or slot == self.MaxSize:
+            self.FilteredOutput.setDirty( slice(None) )
+        elif slot == self.MaxConcurrentBlocks:
+            pass
+        else:
+            assert False, "Unknown input slot: {}".format( slot.name )
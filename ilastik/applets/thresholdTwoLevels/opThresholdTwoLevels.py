@@ -11,13 +11,15 @@ import psutil
 
 # Lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.operators import OpMultiArraySlicer2, OpPixelOperator, OpVigraLabelVolume, OpFilterLabels, \
+from lazyflow.operators import OpMultiArraySlicer2, OpPixelOperator, \
                                OpCompressedCache, OpColorizeLabels, OpSingleChannelSelector, OperatorWrapper, \
                                OpMultiArrayStacker, OpMultiArraySlicer
-from lazyflow.roi import extendSlice, TinyVector
+from lazyflow.request import RequestLock
+from lazyflow.roi import extendSlice, TinyVector, roiToSlice, roiFromShape
 
 # ilastik
 from lazyflow.utility.timer import Timer
+from opBlockwiseLabelVolume import OpBlockwiseLabelVolume
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +33,27 @@ def getMemoryUsageMb():
     mem_usage_mb = (vmem.total - vmem.available) / 1e6
     return mem_usage_mb
 
+def getCacheBlockShape(slot, spatialBlockShape):
+    """
+    Block shape for caching the data of slot in blocks of (at most) the given
+    spatial shape (a dict of { axis key : size }), for one time slice.
+    """
+    blockShape = []
+    for key, size in slot.meta.getTaggedShape().items():
+        if key == 't':
+            blockShape.append( 1 )
+        else:
+            blockShape.append( min( spatialBlockShape.get(key, size), size ) )
+    return tuple(blockShape)
+
+def getSliceBlockShape(slot):
+    """
+    Block shape for caching the data of slot in blocks of one whole time slice.
+    The caches that are stored in the project file use it, because projects store
+    their blocks as they are (and older projects have whole time slices).
+    """
+    return getCacheBlockShape(slot, {})
+
 
 class OpAnisotropicGaussianSmoothing(Operator):
     Input = InputSlot()
@@ -157,71 +180,141 @@ class OpSelectLabels(Operator):
     """
     Given two label images, produce a copy of BigLabels, EXCEPT first remove all labels 
     from BigLabels that do not overlap with any labels in SmallLabels.
+    If MinSize and MaxSize are given, the labels of BigLabels whose objects are smaller
+    or larger are removed as well.
+    
+    Which labels pass is determined once over the whole image, so the output of
+    a small roi is the same as the corresponding part of the whole output.
+    The image is processed in slabs of at most BlockSizeMb: the first pass over
+    the whole image collects the overlapping labels (and object sizes), each
+    request then relabels its roi slab by slab.
+    The inputs are requested slab by slab, so they should be cached upstream.
     """
     SmallLabels = InputSlot()
     BigLabels = InputSlot()
+    MinSize = InputSlot(stype='int', optional=True)
+    MaxSize = InputSlot(stype='int', optional=True)
     
     Output = OutputSlot()
     
+    # Approximate size of the input data requested at once
+    BlockSizeMb = 256
+    
+    def __init__(self, *args, **kwargs):
+        super(OpSelectLabels, self).__init__(*args, **kwargs)
+        self._lock = RequestLock()
+        self._labelValues = None
+    
     def setupOutputs(self):
         self.Output.meta.assignFrom( self.BigLabels.meta )
         self.Output.meta.dtype = numpy.uint8
         self.Output.meta.drange = (0,1)
+        with self._lock:
+            self._labelValues = None
+    
+    def _getBlockRois(self, start, stop):
+        """
+        Split the roi (start, stop) into slabs along its longest axis.
+        """
+        start = numpy.array(start)
+        stop = numpy.array(stop)
+        shape = stop - start
+        axis = numpy.argmax(shape)
+        
+        bytesPerVoxel = self.SmallLabels.meta.getDtypeBytes() + self.BigLabels.meta.getDtypeBytes()
+        sliceMb = bytesPerVoxel * numpy.prod(shape) / float(shape[axis]) / 1e6
+        thickness = max(1, int(self.BlockSizeMb / sliceMb))
+        
+        blockRois = []
+        for blockStart in range(start[axis], stop[axis], thickness):
+            blockRoi = (start.copy(), stop.copy())
+            blockRoi[0][axis] = blockStart
+            blockRoi[1][axis] = min(blockStart + thickness, stop[axis])
+            blockRois.append( blockRoi )
+        return blockRois
+    
+    def _getBlock(self, slot, blockRoi):
+        # Clean finished requests immediately (don't wait for the caller to exit)
+        req = slot(*blockRoi)
+        data = req.wait()
+        req.clean()
+        return data
+    
+    def _getLabelValues(self):
+        """
+        Return the lookup table from BigLabels to output values (computed only once).
+        """
+        with self._lock:
+            if self._labelValues is not None:
+                return self._labelValues
+
+            # This operator is typically used with very big images, so be extremely memory-conscious:
+            # - Only work on one block at a time.
+            # - Don't request the small and big inputs in parallel. 
+            # - Delete intermediate results as soon as possible.
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                starting_memory_usage_mb = getMemoryUsageMb()
+                logger.debug("Starting with memory usage: {} MB".format( starting_memory_usage_mb ))
+    
+            def logMemoryIncrease(msg):
+                """Log a debug message about the RAM usage compared to when this function started execution."""
+                if logger.isEnabledFor(logging.DEBUG):
+                    memory_increase_mb = getMemoryUsageMb() - starting_memory_usage_mb
+                    logger.debug("{}, memory increase is: {} MB".format( msg, memory_increase_mb ))
+    
+            # Find the big labels that overlap with a small label
+            passed = numpy.zeros( (0,), dtype=self.BigLabels.meta.dtype )
+            sizes = numpy.zeros( (1,), dtype=numpy.int64 )
+            for blockRoi in self._getBlockRois( *roiFromShape(self.BigLabels.meta.shape) ):
+                smallNonZero = ( self._getBlock(self.SmallLabels, blockRoi) != 0 )
+                bigLabels = self._getBlock(self.BigLabels, blockRoi)
+                logMemoryIncrease("After obtaining labels of block {}".format( blockRoi ))
+    
+                # Equivalent to numpy.unique( smallNonZero * bigLabels )
+                passed = numpy.union1d( passed, numpy.unique( numpy.where( smallNonZero, bigLabels, 0 ) ) )
+                del smallNonZero
+                
+                blockSizes = numpy.bincount( bigLabels.ravel() )
+                if len(blockSizes) > len(sizes):
+                    blockSizes[:len(sizes)] += sizes
+                    sizes = blockSizes
+                else:
+                    sizes[:len(blockSizes)] += blockSizes
+                del bigLabels
+            
+            labelValues = numpy.zeros( (len(sizes),), dtype=numpy.uint8 )
+            labelValues[passed] = numpy.arange( 1, len(passed)+1 )
+            if self.MinSize.ready():
+                labelValues[ sizes < self.MinSize.value ] = 0
+            if self.MaxSize.ready():
+                labelValues[ sizes > self.MaxSize.value ] = 0
+            labelValues[0] = 0
+            
+            logMemoryIncrease("After computing the label values")
+            self._labelValues = labelValues
+            return self._labelValues
     
     def execute(self, slot, subindex, roi, result):
         assert slot == self.Output
-
-        # This operator is typically used with very big rois, so be extremely memory-conscious:
-        # - Don't request the small and big inputs in parallel. 
-        # - Clean finished requests immediately (don't wait for this function to exit)
-        # - Delete intermediate results as soon as possible.
         
         if logger.isEnabledFor(logging.DEBUG):
             dtypeBytes = self.SmallLabels.meta.getDtypeBytes()
             roiShape = roi.stop - roi.start
             logger.debug( "Roi shape is {} = {} MB".format( roiShape, numpy.prod(roiShape) * dtypeBytes / 1e6 ) )
-            starting_memory_usage_mb = getMemoryUsageMb()
-            logger.debug("Starting with memory usage: {} MB".format( starting_memory_usage_mb ))
 
-        def logMemoryIncrease(msg):
-            """Log a debug message about the RAM usage compared to when this function started execution."""
-            if logger.isEnabledFor(logging.DEBUG):
-                memory_increase_mb = getMemoryUsageMb() - starting_memory_usage_mb
-                logger.debug("{}, memory increase is: {} MB".format( msg, memory_increase_mb ))
-
-        smallLabelsReq = self.SmallLabels(roi.start, roi.stop)
-        smallLabels = smallLabelsReq.wait()
-        smallLabelsReq.clean()
-        logMemoryIncrease("After obtaining small labels")
-
-        smallNonZero = numpy.ndarray(shape=smallLabels.shape, dtype=bool)
-        smallNonZero[...] = (smallLabels != 0)
-        del smallLabels
-
-        logMemoryIncrease("Before obtaining big labels")
-        bigLabels = self.BigLabels(roi.start, roi.stop).wait()
-        logMemoryIncrease("After obtaining big labels")
-        
-        prod = smallNonZero * bigLabels
-        
-        del smallNonZero
-        
-        passed = numpy.unique(prod)
-        logMemoryIncrease("After taking product")
-        del prod
-        
-        all_label_values = numpy.zeros( (bigLabels.max()+1,), dtype=numpy.uint8 )
-        for i, l in enumerate(passed):
-            all_label_values[l] = i+1
-        all_label_values[0] = 0
-        
-        result[:] = all_label_values[ bigLabels ]
-        
-        logMemoryIncrease("Just before return")
+        labelValues = self._getLabelValues()
+        for blockRoi in self._getBlockRois(roi.start, roi.stop):
+            bigLabels = self._getBlock(self.BigLabels, blockRoi)
+            result[roiToSlice(blockRoi[0] - roi.start, blockRoi[1] - roi.start)] = labelValues[ bigLabels ]
+            del bigLabels
         return result        
 
     def propagateDirty(self, slot, subindex, roi):
-        if slot == self.SmallLabels or slot == self.BigLabels:
+        if slot == self.SmallLabels or slot == self.BigLabels or \
+           slot == self.MinSize or slot == self.MaxSize:
+            with self._lock:
+                self._labelValues = None
             self.Output.setDirty( slice(None) )
         else:
             assert False, "Unknown input slot: {}".format( slot.name )
@@ -240,6 +333,9 @@ class OpThresholdTwoLevels(Operator):
     SmootherSigma = InputSlot(value={ 'x':1.0, 'y':1.0, 'z':1.0})
     Channel = InputSlot(value=0)
     CurOperator = InputSlot(stype='int', value=0)
+    # The outputs are computed and cached in blocks of this shape,
+    #  so small requests don't need to compute the whole volume.
+    SpatialBlockShape = InputSlot(value={ 'x':256, 'y':256, 'z':256 })
     
     Output = OutputSlot()
     
@@ -280,6 +376,7 @@ class OpThresholdTwoLevels(Operator):
         self.opThreshold1.Threshold.connect(self.SingleThreshold)
         self.opThreshold1.MinSize.connect(self.MinSize)
         self.opThreshold1.MaxSize.connect(self.MaxSize)
+        self.opThreshold1.SpatialBlockShape.connect(self.SpatialBlockShape)
         
         
         self.opThreshold2 = OperatorWrapper(OpThresholdTwoLevels4d, parent = self)
@@ -288,6 +385,7 @@ class OpThresholdTwoLevels(Operator):
         self.opThreshold2.MaxSize.connect(self.MaxSize)
         self.opThreshold2.LowThreshold.connect(self.LowThreshold)
         self.opThreshold2.HighThreshold.connect(self.HighThreshold)
+        self.opThreshold2.SpatialBlockShape.connect(self.SpatialBlockShape)
         
         self._opTimeStacker2 = OpMultiArrayStacker(parent=self)
         self._opTimeStacker2.AxisFlag.setValue('t')
@@ -357,10 +455,7 @@ class OpThresholdTwoLevels(Operator):
         curIndex = self.CurOperator.value
         if curIndex==0:
             self.Output.connect(self._opTimeStacker1.Output)
-            # Blockshape is the entire block, except only 1 time slice
-            tagged_shape = self._opTimeStacker1.Output.meta.getTaggedShape()
-            tagged_shape['t'] = 1
-            self._opCache.BlockShape.setValue( tuple( tagged_shape.values() ) )
+            self._opCache.BlockShape.setValue( getSliceBlockShape( self._opTimeStacker1.Output ) )
             self._opCache.Input.connect( self._opTimeStacker1.Output )
             
             self._bigRegionsStacker.Images.disconnect()
@@ -375,6 +470,7 @@ class OpThresholdTwoLevels(Operator):
 
         elif curIndex==1:
             self.Output.connect(self._opTimeStacker2.Output)
+            self._opCache.BlockShape.setValue( getSliceBlockShape( self._opTimeStacker2.Output ) )
             self._opCache.Input.connect( self._opTimeStacker2.Output )
             
             self._bigRegionsStacker.Images.connect(self.opThreshold2.BigRegions)
@@ -410,6 +506,7 @@ class OpThresholdTwoLevels4d(Operator):
     MaxSize = InputSlot(stype='int', value=1000000)
     HighThreshold = InputSlot(stype='float', value=0.5)
     LowThreshold = InputSlot(stype='float', value=0.2)
+    SpatialBlockShape = InputSlot(value={ 'x':256, 'y':256, 'z':256 })
     
     Output = OutputSlot()
     CachedOutput = OutputSlot() # For the GUI (blockwise-access)
@@ -426,15 +523,18 @@ class OpThresholdTwoLevels4d(Operator):
 
     # Schematic:
     #
-    #           HighThreshold                         MinSize,MaxSize                       --(cache)--> opColorize -> FilteredSmallLabels
-    #                   \                                       \                     /
-    #           opHighThresholder --> opHighLabeler --> opHighLabelSizeFilter                           Output
-    #          /                   \          /                 \                                            \                         /
-    # InputImage        --(cache)--> SmallRegions                    opSelectLabels -->opFinalLabelSizeFilter--> opCache --> CachedOutput
-    #          \                                                              /                                           /       \
-    #           opLowThresholder ----> opLowLabeler --------------------------                                       InputHdf5     --> OutputHdf5
-    #                   /                \                                                                                        -> CleanBlocks
-    #           LowThreshold            --(cache)--> BigRegions
+    #           HighThreshold                             MinSize,MaxSize                 --(cache)--> opColorize -> FilteredSmallLabels
+    #                   \                                           \                   /
+    #           opHighThresholder --(cache)--> opHighLabeler (blockwise) --> FilteredOutput                  Output
+    #          /                       \                                               \                    /
+    # InputImage                        --> SmallRegions                                opSelectLabels --> opCache --> CachedOutput
+    #          \                                                                       /       /          /       \
+    #           opLowThresholder --(cache)--> opLowLabeler (blockwise) --> (cache) ---  MinSize,MaxSize  InputHdf5  --> OutputHdf5
+    #                   /              \                                                                           -> CleanBlocks
+    #           LowThreshold            --> BigRegions
+    #
+    # All caches store blocks of SpatialBlockShape, except opCache (it has the serialization
+    #  outputs, so it stores whole time slices).
     
     def __init__(self, *args, **kwargs):
         super(OpThresholdTwoLevels4d, self).__init__(*args, **kwargs)
@@ -445,40 +545,56 @@ class OpThresholdTwoLevels4d(Operator):
         self._opHighThresholder = OpPixelOperator(parent=self )
         self._opHighThresholder.Input.connect( self.InputImage )
         
-        self._opLowLabeler = OpVigraLabelVolume(parent=self )
-        self._opLowLabeler.Input.connect( self._opLowThresholder.Output )
+        # The thresholded images are cached, because the labelers read each block twice.
+        # These caches also provide the BigRegions and SmallRegions debug outputs.
+        self._opBigRegionCache = OpCompressedCache( parent=self )
+        self._opBigRegionCache.name = "OpThresholdTwoLevels4d._opBigRegionCache"
+        self._opBigRegionCache.Input.connect( self._opLowThresholder.Output )
         
-        self._opHighLabeler = OpVigraLabelVolume(parent=self )
-        self._opHighLabeler.Input.connect( self._opHighThresholder.Output )
+        self._opSmallRegionCache = OpCompressedCache( parent=self )
+        self._opSmallRegionCache.name = "OpThresholdTwoLevels4d._opSmallRegionCache"
+        self._opSmallRegionCache.Input.connect( self._opHighThresholder.Output )
         
-        self._opHighLabelSizeFilter = OpFilterLabels(parent=self )
-        self._opHighLabelSizeFilter.Input.connect( self._opHighLabeler.Output )
-        self._opHighLabelSizeFilter.MinLabelSize.connect( self.MinSize )
-        self._opHighLabelSizeFilter.MaxLabelSize.connect( self.MaxSize )
-        self._opHighLabelSizeFilter.BinaryOut.setValue(False) #we do the binarization in opSelectLabels
-                                                              #this way, we get to display pretty colors
-
-        self._opSelectLabels = OpSelectLabels( parent=self )        
-        self._opSelectLabels.BigLabels.connect( self._opLowLabeler.Output )
-        self._opSelectLabels.SmallLabels.connect( self._opHighLabelSizeFilter.Output )
+        self._opLowLabeler = OpBlockwiseLabelVolume(parent=self )
+        self._opLowLabeler.Input.connect( self._opBigRegionCache.Output )
+        self._opLowLabeler.BlockShape.connect( self.SpatialBlockShape )
+        
+        # The size filter is based on the sizes of the whole (stitched) objects.
+        # The output is not binarized; we do the binarization in opSelectLabels
+        #  this way, we get to display pretty colors
+        self._opHighLabeler = OpBlockwiseLabelVolume(parent=self )
+        self._opHighLabeler.Input.connect( self._opSmallRegionCache.Output )
+        self._opHighLabeler.BlockShape.connect( self.SpatialBlockShape )
+        self._opHighLabeler.MinSize.connect( self.MinSize )
+        self._opHighLabeler.MaxSize.connect( self.MaxSize )
+
+        # OpSelectLabels requests its inputs blockwise (twice), so they are cached.
+        # (The small labels cache is shared with the FilteredSmallLabels debug output below.)
+        self._opBigLabelCache = OpCompressedCache( parent=self )
+        self._opBigLabelCache.name = "OpThresholdTwoLevels4d._opBigLabelCache"
+        self._opBigLabelCache.Input.connect( self._opLowLabeler.Output )
         
-        #remove the remaining very large objects - 
+        self._opFilteredSmallLabelsCache = OpCompressedCache( parent=self )
+        self._opFilteredSmallLabelsCache.name = "OpThresholdTwoLevels4d._opFilteredSmallLabelsCache"
+        self._opFilteredSmallLabelsCache.Input.connect( self._opHighLabeler.FilteredOutput )
+
+        #also remove the remaining very large objects - 
         #they might still be present in case a big object
         #was split into many small ones for the higher threshold
         #and they got reconnected again at lower threshold
-        self._opFinalLabelSizeFilter = OpFilterLabels( parent=self )
-        self._opFinalLabelSizeFilter.Input.connect(self._opSelectLabels.Output )
-        self._opFinalLabelSizeFilter.MinLabelSize.connect( self.MinSize )
-        self._opFinalLabelSizeFilter.MaxLabelSize.connect( self.MaxSize )
-        self._opFinalLabelSizeFilter.BinaryOut.setValue(False)
+        self._opSelectLabels = OpSelectLabels( parent=self )        
+        self._opSelectLabels.BigLabels.connect( self._opBigLabelCache.Output )
+        self._opSelectLabels.SmallLabels.connect( self._opFilteredSmallLabelsCache.Output )
+        self._opSelectLabels.MinSize.connect( self.MinSize )
+        self._opSelectLabels.MaxSize.connect( self.MaxSize )
 
         self._opCache = OpCompressedCache( parent=self )
         self._opCache.name = "OpThresholdTwoLevels4d._opCache"
         self._opCache.InputHdf5.connect( self.InputHdf5 )
-        self._opCache.Input.connect( self._opFinalLabelSizeFilter.Output )
+        self._opCache.Input.connect( self._opSelectLabels.Output )
 
         # Connect our own outputs
-        self.Output.connect( self._opFinalLabelSizeFilter.Output )
+        self.Output.connect( self._opSelectLabels.Output )
         self.CachedOutput.connect( self._opCache.Output )
 
         # Serialization outputs
@@ -491,19 +607,9 @@ class OpThresholdTwoLevels4d(Operator):
         #self.InputChannel.connect( self._opChannelSelector.Output )
         
         # More debug outputs.  These all go through their own caches
-        self._opBigRegionCache = OpCompressedCache( parent=self )
-        self._opBigRegionCache.name = "OpThresholdTwoLevels4d._opBigRegionCache"
-        self._opBigRegionCache.Input.connect( self._opLowThresholder.Output )
         self.BigRegions.connect( self._opBigRegionCache.Output )
-        
-        self._opSmallRegionCache = OpCompressedCache( parent=self )
-        self._opSmallRegionCache.name = "OpThresholdTwoLevels4d._opSmallRegionCache"
-        self._opSmallRegionCache.Input.connect( self._opHighThresholder.Output )
         self.SmallRegions.connect( self._opSmallRegionCache.Output )
         
-        self._opFilteredSmallLabelsCache = OpCompressedCache( parent=self )
-        self._opFilteredSmallLabelsCache.name = "OpThresholdTwoLevels4d._opFilteredSmallLabelsCache"
-        self._opFilteredSmallLabelsCache.Input.connect( self._opHighLabelSizeFilter.Output )
         self._opColorizeSmallLabels = OpColorizeLabels( parent=self )
         self._opColorizeSmallLabels.Input.connect( self._opFilteredSmallLabelsCache.Output )
         self.FilteredSmallLabels.connect( self._opColorizeSmallLabels.Output )
@@ -528,6 +634,12 @@ class OpThresholdTwoLevels4d(Operator):
         
         self._opLowThresholder.Function.setValue( partial( thresholdToUint8, self.LowThreshold.value ) )
         self._opHighThresholder.Function.setValue( partial( thresholdToUint8, self.HighThreshold.value ) )
+        
+        blockShape = getCacheBlockShape( self.InputImage, self.SpatialBlockShape.value )
+        for cache in ( self._opBigRegionCache, self._opSmallRegionCache, self._opBigLabelCache,
+                       self._opFilteredSmallLabelsCache ):
+            cache.BlockShape.setValue( blockShape )
+        self._opCache.BlockShape.setValue( getSliceBlockShape( self.InputImage ) )
 
         # Copy the input metadata to the output
         self.Output.meta.assignFrom( self.InputImage.meta )
@@ -553,6 +665,7 @@ class OpThresholdOneLevel(Operator):
     MinSize = InputSlot(stype='int', value=0)
     MaxSize = InputSlot(stype='int', value=1000000)
     Threshold = InputSlot(stype='float', value=0.5)
+    SpatialBlockShape = InputSlot(value={ 'x':256, 'y':256, 'z':256 })
     
     Output = OutputSlot()
     
@@ -565,8 +678,17 @@ class OpThresholdOneLevel(Operator):
         self._opThresholder = OpPixelOperator(parent=self )
         self._opThresholder.Input.connect( self.InputImage )
         
-        self._opLabeler = OpVigraLabelVolume( parent=self )
-        self._opLabeler.Input.connect(self._opThresholder.Output)
+        # The labeler reads each block of the thresholded image twice
+        self._opThresholdCache = OpCompressedCache( parent=self )
+        self._opThresholdCache.name = "OpThresholdOneLevel._opThresholdCache"
+        self._opThresholdCache.Input.connect( self._opThresholder.Output )
+        
+        # The size filter is based on the sizes of the whole (stitched) objects
+        self._opLabeler = OpBlockwiseLabelVolume( parent=self )
+        self._opLabeler.Input.connect( self._opThresholdCache.Output )
+        self._opLabeler.BlockShape.connect( self.SpatialBlockShape )
+        self._opLabeler.MinSize.connect( self.MinSize )
+        self._opLabeler.MaxSize.connect( self.MaxSize )
 
         self._opLabelCache = OpCompressedCache( parent=self )
         self._opLabelCache.name = "OpThresholdOneLevel._opLabelCache"
@@ -574,13 +696,7 @@ class OpThresholdOneLevel(Operator):
         
         self.BeforeSizeFilter.connect( self._opLabelCache.Output )
         
-        self._opFilter = OpFilterLabels( parent=self )
-        self._opFilter.Input.connect(self._opLabelCache.Output )
-        self._opFilter.MinLabelSize.connect( self.MinSize )
-        self._opFilter.MaxLabelSize.connect( self.MaxSize )
-        self._opFilter.BinaryOut.setValue(False)
-        
-        self.Output.connect(self._opFilter.Output)
+        self.Output.connect(self._opLabeler.FilteredOutput)
         
     def setupOutputs(self):
         timeIndex = self.InputImage.meta.axistags.index('t')
@@ -601,6 +717,11 @@ class OpThresholdOneLevel(Operator):
                 return (a > thresholdValue).astype(numpy.uint8)
         
         self._opThresholder.Function.setValue( partial( thresholdToUint8, self.Threshold.value ) )
+        
+        blockShape = getCacheBlockShape( self.InputImage, self.SpatialBlockShape.value )
+        self._opThresholdCache.BlockShape.setValue( blockShape )
+        self._opLabelCache.BlockShape.setValue( blockShape )
+        
         # Copy the input metadata to the output
         self.Output.meta.assignFrom( self.InputImage.meta )
         self.Output.meta.dtype=numpy.uint8
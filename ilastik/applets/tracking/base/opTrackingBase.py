@@ -1,11 +1,16 @@
+import copy
+import logging
+from functools import partial
+
 from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request
 from lazyflow.rtype import List
 from lazyflow.stype import Opaque
 
 import numpy as np
 import pgmlink
-from ilastik.applets.tracking.base.trackingUtilities import relabel,\
-    get_dict_value
+from ilastik.applets.tracking.base.trackingUtilities import relabelLut,\
+    applyLut, get_dict_value
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
 from ilastik.applets.base.applet import DatasetConstraintError
 from lazyflow.operators.opCompressedCache import OpCompressedCache
@@ -13,6 +18,8 @@ from lazyflow.operators.valueProviders import OpZeroDefault
 
 from lazyflow.roi import sliceToRoi
 
+logger = logging.getLogger(__name__)
+
 
 class OpTrackingBase(Operator):
     name = "Tracking"
@@ -34,9 +41,16 @@ class OpTrackingBase(Operator):
         
     Output = OutputSlot()    
     
+    # Input slots the traxelstore is built from (ClassMapping and RegionLocalCenters are defined by subclasses)
+    _traxelstoreInputs = ('ObjectFeatures', 'ClassMapping', 'RegionLocalCenters')
+    
     def __init__(self, parent=None, graph=None):
         super(OpTrackingBase, self).__init__(parent=parent, graph=graph)        
         self.label2color = []    
+        # t -> dense relabeling array for label2color[t] (reset whenever the tracking changes)
+        self._relabelLuts = {}
+        # (parameters, result) of the last _generate_traxelstore() call
+        self._traxelstoreCache = None
     
         self._opCache = OpCompressedCache( parent=self )        
         self._opCache.InputHdf5.connect( self.InputHdf5 )
@@ -105,7 +119,7 @@ class OpTrackingBase(Operator):
             t_end = roi.stop[0]
             for t in range(t_start, t_end):
                 if ('time_range' in parameters and t <= parameters['time_range'][-1] and t >= parameters['time_range'][0]) and len(self.label2color) > t:                
-                    result[t-t_start, ..., 0] = relabel(result[t-t_start, ..., 0], self.label2color[t])
+                    result[t-t_start, ..., 0] = applyLut(result[t-t_start, ..., 0], self._getRelabelLut(t, result.dtype))
                 else:
                     result[t-t_start,...] = 0
             return result         
@@ -127,11 +141,20 @@ class OpTrackingBase(Operator):
             return result
             
         
+    def _getRelabelLut(self, t, dtype):
+        lut = self._relabelLuts.get(t)
+        if lut is None or lut.dtype != dtype:
+            lut = relabelLut(self.label2color[t], dtype=dtype)
+            self._relabelLuts[t] = lut
+        return lut
+
     def propagateDirty(self, inputSlot, subindex, roi):     
         if inputSlot is self.LabelImage:
             self.Output.setDirty(roi)
         elif inputSlot is self.EventsVector:
             self._setLabel2Color()
+        elif inputSlot.name in self._traxelstoreInputs:
+            self._traxelstoreCache = None
 
     def setInSlot(self, slot, subindex, roi, value):
         assert slot == self.InputHdf5, "Invalid slot for setInSlot(): {}".format( slot.name )
@@ -222,6 +245,7 @@ class OpTrackingBase(Operator):
 
         self.label2color = label2color
         self.mergers = mergers        
+        self._relabelLuts = {}
         
         self.Output._value = None
         self.Output.setDirty(slice(None))
@@ -252,102 +276,148 @@ class OpTrackingBase(Operator):
         parameters['z_range'] = z_range
         parameters['size_range'] = size_range
         
+        cacheKey = ( tuple(time_range), tuple(x_range), tuple(y_range), tuple(z_range), tuple(size_range),
+                     x_scale, y_scale, z_scale, with_div, with_local_centers )
+        if self._traxelstoreCache is not None and self._traxelstoreCache[0] == cacheKey:
+            logger.debug("reusing traxels")
+            traxels, empty_frame, filtered_labels, median_size = self._traxelstoreCache[1]
+            if median_object_size is not None:
+                median_object_size[0] = median_size
+            self.FilteredLabels.setValue(copy.deepcopy(filtered_labels), check_changed=False)
+            return self._fill_traxelstore(traxels), empty_frame
+        
         print "generating traxels"
         print "fetching region features and division probabilities"
         feats = self.ObjectFeatures(time_range).wait()        
         
+        divProbs = None
         if with_div:
             divProbs = self.ClassMapping(time_range).wait()
         
+        localCenters = None
         if with_local_centers:
             localCenters = self.RegionLocalCenters(time_range).wait()
         
-        print "filling traxelstore"
-        ts = pgmlink.TraxelStore()
-                
+        # Filter and build the traxels of all timesteps in parallel
+        timesteps = feats.keys()
+        requests = []
+        for t in timesteps:
+            req = Request( partial( self._generate_traxels_at, t, feats[t][default_features_key],
+                                    divProbs[t] if with_div else None,
+                                    localCenters[t] if with_local_centers else None,
+                                    x_range, y_range, z_range, size_range, x_scale, y_scale, z_scale ) )
+            req.submit()
+            requests.append(req)
+        
         max_traxel_id_at = pgmlink.VectorOfInt()  
         filtered_labels = {}        
         obj_sizes = []
+        all_traxels = []
         total_count = 0
         empty_frame = False
-        for t in feats.keys():
-            rc = feats[t][default_features_key]['RegionCenter']
-            if rc.size:
-                rc = rc[1:, ...]
-
-            ct = feats[t][default_features_key]['Count']
-            if ct.size:
-                ct = ct[1:, ...]
-            
-            print "at timestep ", t, rc.shape[0], "traxels found"
-            count = 0
-            filtered_labels_at = []
-            for idx in range(rc.shape[0]):
-                # for 2d data, set z-coordinate to 0:
-                if len(rc[idx]) == 2:
-                    x, y = rc[idx]
-                    z = 0
-                elif len(rc[idx]) == 3:                    
-                    x, y, z = rc[idx]
-                else:
-                    raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
-                size = ct[idx]
-                if (x < x_range[0] or x >= x_range[1] or
-                    y < y_range[0] or y >= y_range[1] or
-                    z < z_range[0] or z >= z_range[1] or
-                    size < size_range[0] or size >= size_range[1]):
-                    filtered_labels_at.append(int(idx + 1))
-                    continue
-                else:
-                    count += 1
-                tr = pgmlink.Traxel()
-                tr.set_x_scale(x_scale)
-                tr.set_y_scale(y_scale)
-                tr.set_z_scale(z_scale)
-                tr.Id = int(idx + 1)
-                tr.Timestep = t
-                
-                # pgmlink expects always 3 coordinates, z=0 for 2d data
-                tr.add_feature_array("com", 3)
-                for i, v in enumerate([x,y,z]):
-                    tr.set_feature_value('com', i, float(v))                    
-                
-                if with_div:
-                    tr.add_feature_array("divProb", 1)
-                    # idx+1 because rc and ct start from 1, divProbs starts from 0
-                    tr.set_feature_value("divProb", 0, float(divProbs[t][idx+1][1]))
-                
-                # FIXME: check whether it is 2d or 3d data!
-                if with_local_centers:
-                    tr.add_feature_array("localCentersX", len(localCenters[t][idx+1]))  
-                    tr.add_feature_array("localCentersY", len(localCenters[t][idx+1]))
-                    tr.add_feature_array("localCentersZ", len(localCenters[t][idx+1]))            
-                    for i, v in enumerate(localCenters[t][idx+1]):
-                        tr.set_feature_value("localCentersX", i, float(v[0]))
-                        tr.set_feature_value("localCentersY", i, float(v[1]))
-                        tr.set_feature_value("localCentersZ", i, float(v[2]))                
-                
-                tr.add_feature_array("count", 1)
-                tr.set_feature_value("count", 0, float(size))
-                if median_object_size is not None:
-                    obj_sizes.append(float(size))
-                ts.add(tr)   
+        for t, req in zip(timesteps, requests):
+            traxels, filtered_labels_at, sizes, num_objects = req.wait()
+            all_traxels += traxels
+            count = len(traxels)
+            print "at timestep ", t, num_objects, "traxels found,", count, "traxels passed filter"
             
             if len(filtered_labels_at) > 0:
                 filtered_labels[str(int(t)-time_range[0])] = filtered_labels_at
-            print "at timestep ", t, count, "traxels passed filter"
-            max_traxel_id_at.append(int(rc.shape[0]))
+            max_traxel_id_at.append(int(num_objects))
             if count == 0:
                 empty_frame = True
+            obj_sizes.append(sizes)
                 
             total_count += count
         
+        # Always computed, so the cached traxels have it for any later call
+        median_size = np.median(np.concatenate(obj_sizes) if obj_sizes else np.zeros((0,)),overwrite_input=True)
         if median_object_size is not None:
-            median_object_size[0] = np.median(np.array(obj_sizes),overwrite_input=True)
+            median_object_size[0] = median_size
             print 'median object size = ' + str(median_object_size[0])
         
-        self.FilteredLabels.setValue(filtered_labels, check_changed=False)
+        # Only the traxels are cached, not the TraxelStore: the solvers may modify the store they are given.
+        self._traxelstoreCache = (cacheKey, (all_traxels, empty_frame, filtered_labels, median_size))
+        self.FilteredLabels.setValue(copy.deepcopy(filtered_labels), check_changed=False)
         
-        return ts, empty_frame
+        return self._fill_traxelstore(all_traxels), empty_frame
+
+    def _fill_traxelstore(self, traxels):
+        """
+        Return a new TraxelStore with the given traxels.
+        TraxelStore.add() stores a copy, so the traxels themselves are never handed to a solver.
+        """
+        print "filling traxelstore"
+        ts = pgmlink.TraxelStore()
+        for tr in traxels:
+            ts.add(tr)
+        return ts
+
+    
 
-    
\ No newline at end of file
+    def _generate_traxels_at(self, t, feats_at, divProbs_at, localCenters_at,
+                             x_range, y_range, z_range, size_range,
+                             x_scale, y_scale, z_scale):
+        """
+        Build the traxels of timestep t from its region features.
+        Returns (traxels, filtered_labels, sizes, num_objects), where filtered_labels are the ids
+        of the objects outside of the x/y/z/size ranges and sizes are the sizes of the traxels.
+        """
+        # skip the background object (label 0)
+        rc = np.asarray(feats_at['RegionCenter'])
+        ct = np.asarray(feats_at['Count'])
+        num_objects = max(rc.shape[0] - 1, 0)
+        if num_objects > 0:
+            rc = rc[1:].reshape(num_objects, -1)
+            ct = ct[1:].reshape(num_objects, -1)[:, 0]
+        else:
+            rc = np.zeros((0, 3))
+            ct = np.zeros((0,))
+        
+        # for 2d data, set z-coordinate to 0:
+        if rc.shape[1] == 2:
+            rc = np.column_stack((rc, np.zeros(num_objects)))
+        elif rc.shape[1] != 3:
+            raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
+        x, y, z = rc[:, 0], rc[:, 1], rc[:, 2]
+        
+        passed = ((x >= x_range[0]) & (x < x_range[1]) &
+                  (y >= y_range[0]) & (y < y_range[1]) &
+                  (z >= z_range[0]) & (z < z_range[1]) &
+                  (ct >= size_range[0]) & (ct < size_range[1]))
+        filtered_labels = (np.flatnonzero(~passed) + 1).tolist()
+        
+        traxels = []
+        for idx in np.flatnonzero(passed):
+            tr = pgmlink.Traxel()
+            tr.set_x_scale(x_scale)
+            tr.set_y_scale(y_scale)
+            tr.set_z_scale(z_scale)
+            tr.Id = int(idx + 1)
+            tr.Timestep = t
+            
+            # pgmlink expects always 3 coordinates, z=0 for 2d data
+            tr.add_feature_array("com", 3)
+            for i, v in enumerate(rc[idx]):
+                tr.set_feature_value('com', i, float(v))                    
+            
+            if divProbs_at is not None:
+                tr.add_feature_array("divProb", 1)
+                # idx+1 because rc and ct start from 1, divProbs starts from 0
+                tr.set_feature_value("divProb", 0, float(divProbs_at[idx+1][1]))
+            
+            # FIXME: check whether it is 2d or 3d data!
+            if localCenters_at is not None:
+                tr.add_feature_array("localCentersX", len(localCenters_at[idx+1]))  
+                tr.add_feature_array("localCentersY", len(localCenters_at[idx+1]))
+                tr.add_feature_array("localCentersZ", len(localCenters_at[idx+1]))            
+                for i, v in enumerate(localCenters_at[idx+1]):
+                    tr.set_feature_value("localCentersX", i, float(v[0]))
+                    tr.set_feature_value("localCentersY", i, float(v[1]))
+                    tr.set_feature_value("localCentersZ", i, float(v[2]))                
+            
+            tr.add_feature_array("count", 1)
+            tr.set_feature_value("count", 0, float(ct[idx]))
+            traxels.append(tr)
+        
+        return traxels, filtered_labels, ct[passed].astype(np.float64), num_objects
@@ -4,32 +4,42 @@ import os.path as path
 import pgmlink
 
 
+def relabelLut(replace, size=0, dtype=np.uint32, default=1):
+    """
+    Build a dense lookup array for relabeling a label image:
+    0 (background) stays 0, label l is mapped to replace[l] if present, and to default otherwise.
+    The array covers at least all labels < size.
+    """
+    keys = np.fromiter(replace.keys(), dtype=np.float64, count=len(replace)).astype(np.int64)
+    values = np.fromiter(replace.values(), dtype=np.float64, count=len(replace))
+    n = max(size, keys.max() + 1 if len(keys) else 0, 1)
+    lut = np.empty(n, dtype=dtype)
+    lut[:] = default
+    lut[0] = 0
+    valid = keys > 0
+    lut[keys[valid]] = values[valid]
+    return lut
+
+def applyLut(volume, lut, default=1):
+    """
+    Relabel volume with a lookup array from relabelLut().
+    Labels beyond the end of lut are mapped to default.
+    """
+    if volume.size == 0:
+        return lut[volume]
+    max_label = int(np.amax(volume))
+    if max_label >= len(lut):
+        extended = np.empty(max_label + 1, dtype=lut.dtype)
+        extended[:len(lut)] = lut
+        extended[len(lut):] = default
+        lut = extended
+    return lut[volume]
+
 def relabel(volume, replace):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
-    mp[1:] = 1
-    labels = np.unique(volume)
-    for label in labels:
-        if label > 0:
-            try:
-                r = replace[label]
-                mp[label] = r
-            except:                
-                pass
-#    mp[replace.keys()] = replace.values()
-    return mp[volume]
-    
+    return applyLut(volume, relabelLut(replace, dtype=volume.dtype))
     
 def relabelMergers(volume, merger):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)    
-    mp[:] = 0
-    labels = np.unique(volume)
-    for label in labels:
-        if label > 0:
-            if label in merger:
-                mp[label] = merger[label]
-            else:
-                mp[label] = 1
-    return mp[volume]
+    return applyLut(volume, relabelLut(merger, dtype=volume.dtype))
 
 def get_dict_value(dic, key, default=[]):
     if key not in dic:
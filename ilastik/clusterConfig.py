@@ -15,6 +15,11 @@ ClusterConfigFields = \
     "task_parallel_subrequests" : AutoEval(int),
     "task_threadpool_size" : AutoEval(int),
     "task_timeout_secs" : AutoEval(int),
+    "task_max_retries" : AutoEval(int),
+    "task_poll_interval_secs" : AutoEval(int),
+    "task_max_concurrent" : AutoEval(int),
+    "task_speculative_fraction" : AutoEval(float), # Re-launch stragglers when this fraction of the tasks is left.
+    "task_command_submits" : bool, # True if command_format only submits the task to a queue (e.g. qsub).  Requires task_timeout_secs.
     "use_node_local_scratch" : bool,
     "use_master_local_scratch" : bool,
     "node_output_compression_cmd" :   FormattedField( requiredFields=["compressed_file", "uncompressed_file"]),
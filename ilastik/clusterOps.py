@@ -1,24 +1,141 @@
 import os
 import copy
+import shutil
+import tempfile
 import subprocess
 import collections
 import hashlib
 import functools
+import pipes
+import threading
 
 import numpy
+import h5py
 
 from lazyflow.rtype import Roi, SubRegion
+from lazyflow.roi import roiToSlice
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OrderedSignal
 from lazyflow.utility import BigRequestStreamer
 from lazyflow.utility.io.blockwiseFileset import BlockwiseFileset
 
 from ilastik.clusterConfig import parseClusterConfigFile
+from ilastik.clusterScheduler import TaskScheduler, LocalTaskProcess
 from lazyflow.utility.timer import Timer
 from lazyflow.utility.pathHelpers import getPathVariants
 
 import logging
 logger = logging.getLogger(__name__)
 
+class NodeScratchStager(object):
+    """
+    Collects the data a task writes for the blocks of a BlockwiseFileset in
+    node-local scratch files instead of writing each sub-block to shared storage.
+    When the task is done, commit() moves each block file to its final location
+    in a single sequential copy and atomically renames it into place.
+    If a compression command is given, each block file is compressed on the scratch disk,
+    and only the compressed file is copied (next to the final location, see compressedBlockPath()).
+    The master decompresses it into place with decompressStagedBlock().
+    """
+    def __init__(self, blockwiseFileset, scratchDir, compressionCmd=None):
+        self._fileset = blockwiseFileset
+        self._scratchDir = scratchDir
+        self._compressionCmd = compressionCmd
+        self._blockFiles = collections.OrderedDict() # block start -> (h5py.File, dataset)
+        self._lock = threading.Lock() # Results may arrive from several threads at once
+
+    def writeData(self, roi, data):
+        """
+        Same signature as BlockwiseFileset.writeData, but the roi must lie within a single block.
+        """
+        blockStart, blockStop = self._fileset.getEntireBlockRoi( roi[0] )
+        blockStart = tuple(blockStart)
+        assert (numpy.array(roi[1]) <= blockStop).all(), "Staged writes must not cross block boundaries"
+        relativeRoi = ( numpy.subtract(roi[0], blockStart), numpy.subtract(roi[1], blockStart) )
+        with self._lock:
+            if blockStart not in self._blockFiles:
+                self._blockFiles[blockStart] = self._createScratchBlock( blockStart, blockStop )
+            _, dataset = self._blockFiles[blockStart]
+            dataset[ roiToSlice( *relativeRoi ) ] = data
+
+    def _createScratchBlock(self, blockStart, blockStop):
+        pathComponents = self._fileset.getDatasetPathComponents( blockStart )
+        scratchPath = os.path.join( self._scratchDir, "{}_{}".format( len(self._blockFiles), pathComponents.filename ) )
+        description = self._fileset.description
+        f = h5py.File( scratchPath, 'w' )
+        dataset = f.create_dataset( pathComponents.internalPath,
+                                    shape=tuple( numpy.subtract(blockStop, blockStart) ),
+                                    dtype=numpy.dtype(description.dtype),
+                                    chunks=description.chunks and tuple(description.chunks) )
+        return f, dataset
+
+    def commit(self):
+        """
+        Move all staged block files (compressed, if a compression command was given) to the shared storage.
+        Returns the list of block starts that were committed.
+        """
+        for blockStart, (f, _) in self._blockFiles.items():
+            scratchPath = f.filename
+            f.close()
+
+            finalPath = self._fileset.getDatasetPathComponents( blockStart ).externalPath
+            finalDir = os.path.split( finalPath )[0]
+            if not os.path.exists( finalDir ):
+                os.makedirs( finalDir )
+
+            if self._compressionCmd is not None:
+                compressedPath = scratchPath + ".compressed"
+                runShellCommand( self._compressionCmd.format( compressed_file=compressedPath, uncompressed_file=scratchPath ) )
+                os.remove( scratchPath )
+                scratchPath = compressedPath
+                finalPath = compressedBlockPath( finalPath )
+
+            # The temporary file lives in the destination directory, so the final rename is atomic.
+            tmpPath = "{}.{}.tmp".format( finalPath, os.getpid() )
+            shutil.copyfile( scratchPath, tmpPath )
+            os.rename( tmpPath, finalPath )
+            os.remove( scratchPath )
+
+        committed = self._blockFiles.keys()
+        self._blockFiles.clear()
+        return committed
+
+    def discard(self):
+        """
+        Delete all staged block files without writing anything to the shared storage.
+        """
+        for f, _ in self._blockFiles.values():
+            scratchPath = f.filename
+            f.close()
+            os.remove( scratchPath )
+        self._blockFiles.clear()
+
+def compressedBlockPath(blockPath):
+    """
+    Where NodeScratchStager puts the compressed version of the given block file.
+    """
+    return blockPath + ".compressed"
+
+def decompressStagedBlock(blockwiseFileset, blockStart, decompressionCmd):
+    """
+    If a compressed block file was staged for the given block, decompress it into place (atomically).
+    Returns True if there was a compressed block file.
+    """
+    finalPath = blockwiseFileset.getDatasetPathComponents( blockStart ).externalPath
+    compressedPath = compressedBlockPath( finalPath )
+    if not os.path.exists( compressedPath ):
+        return False
+    tmpPath = "{}.{}.tmp".format( finalPath, os.getpid() )
+    runShellCommand( decompressionCmd.format( compressed_file=compressedPath, uncompressed_file=tmpPath ) )
+    os.rename( tmpPath, finalPath )
+    os.remove( compressedPath )
+    return True
+
+def runShellCommand(cmd):
+    logger.debug( "Running: " + cmd )
+    returncode = subprocess.call( cmd, shell=True )
+    if returncode != 0:
+        raise RuntimeError( "Command failed with return code {}: {}".format( returncode, cmd ) )
+
 class OpTaskWorker(Operator):
     Input = InputSlot()
     RoiString = InputSlot(stype='string')
@@ -36,6 +153,8 @@ class OpTaskWorker(Operator):
         self.progressSignal = OrderedSignal()
         self._primaryBlockwiseFileset = None
         self._secondaryBlockwiseFilesets = []
+        self._primaryWriter = None
+        self._secondaryWriters = []
 
     def setupOutputs(self):
         self.ReturnCode.meta.dtype = bool
@@ -79,9 +198,6 @@ class OpTaskWorker(Operator):
 
         logger.info( "Executing for roi: {}".format(roi) )
 
-        if config.use_node_local_scratch:
-            assert False, "FIXME."
-
         assert (blockwiseFileset.getEntireBlockRoi( roi.start )[1] == roi.stop).all(), "Each task must execute exactly one full block.  ({},{}) is not a valid block roi.".format( roi.start, roi.stop )
         assert self.Input.ready()
 
@@ -92,17 +208,45 @@ class OpTaskWorker(Operator):
             # If the output dataset specified a sub_block_shape, override the cluster config
             subrequest_shape = primary_subrequest_shape
 
-        with Timer() as computeTimer:
-            # Stream the data out to disk.
-            streamer = BigRequestStreamer(self.Input, (roi.start, roi.stop), subrequest_shape, config.task_parallel_subrequests )
-            streamer.progressSignal.subscribe( self.progressSignal )
-            streamer.resultSignal.subscribe( self._handlePrimaryResultBlock )
-            streamer.execute()
+        if config.use_node_local_scratch:
+            # Stage all output in node-local files and copy each block to the shared filesystem at the end.
+            scratchDir = tempfile.mkdtemp( prefix="ilastik_task_" )
+            stagers = [ NodeScratchStager( fileset, scratchDir, config.node_output_compression_cmd )
+                        for fileset in [self._primaryBlockwiseFileset] + self._secondaryBlockwiseFilesets ]
+            self._primaryWriter = stagers[0]
+            self._secondaryWriters = stagers[1:]
+        else:
+            stagers = []
+            self._primaryWriter = self._primaryBlockwiseFileset
+            self._secondaryWriters = self._secondaryBlockwiseFilesets
 
-            # Now the block is ready.  Update the status.
-            blockwiseFileset.setBlockStatus( roi.start, BlockwiseFileset.BLOCK_AVAILABLE )
+        try:
+            with Timer() as computeTimer:
+                # Stream the data out to disk.
+                streamer = BigRequestStreamer(self.Input, (roi.start, roi.stop), subrequest_shape, config.task_parallel_subrequests )
+                streamer.progressSignal.subscribe( self.progressSignal )
+                streamer.resultSignal.subscribe( self._handlePrimaryResultBlock )
+                streamer.execute()
+
+            with Timer() as commitTimer:
+                # Secondaries first: Once the primary block is marked available, the master considers the task done.
+                for stager in reversed(stagers):
+                    stager.commit()
 
-        logger.info( "Finished task in {} seconds".format( computeTimer.seconds() ) )
+            # Now the block is ready.  Update the status.
+            # (Compressed blocks are marked available by the master, once it has decompressed them.)
+            if not stagers or config.node_output_compression_cmd is None:
+                blockwiseFileset.setBlockStatus( roi.start, BlockwiseFileset.BLOCK_AVAILABLE )
+        finally:
+            for stager in stagers:
+                stager.discard()
+            if stagers:
+                shutil.rmtree( scratchDir, ignore_errors=True )
+
+        if stagers:
+            logger.info( "Finished task in {} seconds ({} seconds to copy from node-local scratch)".format( computeTimer.seconds() + commitTimer.seconds(), commitTimer.seconds() ) )
+        else:
+            logger.info( "Finished task in {} seconds".format( computeTimer.seconds() ) )
         result[0] = True
         return result
 
@@ -111,13 +255,13 @@ class OpTaskWorker(Operator):
         
     def _handlePrimaryResultBlock(self, roi, result):
         # First write the primary
-        self._primaryBlockwiseFileset.writeData(roi, result)
+        self._primaryWriter.writeData(roi, result)
 
         # Get this block's index with respect to the primary dataset
         sub_block_index = roi[0] / self._primaryBlockwiseFileset.description.sub_block_shape
         
         # Now request the secondaries
-        for slot, fileset in zip(self.SecondaryInputs, self._secondaryBlockwiseFilesets):
+        for slot, fileset, writer in zip(self.SecondaryInputs, self._secondaryBlockwiseFilesets, self._secondaryWriters):
             # Compute the corresponding sub_block in this output dataset
             sub_block_shape = fileset.description.sub_block_shape
             sub_block_start = sub_block_index * sub_block_shape
@@ -126,7 +270,7 @@ class OpTaskWorker(Operator):
             sub_block_roi = (sub_block_start, sub_block_stop)
             
             secondary_result = slot( *sub_block_roi ).wait()
-            fileset.writeData( sub_block_roi, secondary_result )
+            writer.writeData( sub_block_roi, secondary_result )
 
 class OpClusterize(Operator):
     Input = InputSlot()
@@ -171,8 +315,13 @@ class OpClusterize(Operator):
                 raise RuntimeError(msg)
     
     def _validateConfig(self):
-        if not self._config.use_master_local_scratch:
-            assert self._config.node_output_compression_cmd is None, "Can't use node dataset compression unless master local scratch is also used."
+        if not self._config.use_node_local_scratch:
+            assert self._config.node_output_compression_cmd is None, "Can't use node dataset compression unless node local scratch is also used."
+        if self._config.node_output_compression_cmd is not None:
+            assert self._config.node_output_decompression_cmd is not None, "Node output compression requires a node_output_decompression_cmd."
+        if self._config.task_speculative_fraction is not None:
+            # Each copy of a task writes its blocks on its own node, and only one copy commits them.
+            assert self._config.use_node_local_scratch, "Can't launch speculative task copies unless node local scratch is also used."
     
     def execute(self, slot, subindex, roi, result):
         dtypeBytes = self._getDtypeBytes()
@@ -187,12 +336,31 @@ class OpClusterize(Operator):
 
         # Create the destination file if necessary
         blockwiseFileset, taskInfos = self._prepareDestination()
+        secondaryFilesets = []
+        if self._config.node_output_compression_cmd is not None:
+            # The master decompresses the blocks of all outputs
+            secondaryFilesets = [ BlockwiseFileset( slot.value, 'a' ) for slot in self.SecondaryOutputDescriptions ]
+
+        def isFinished( roi ):
+            if blockwiseFileset.getBlockStatus( roi[0] ) == BlockwiseFileset.BLOCK_AVAILABLE:
+                return True
+            # The primary block is committed last: once it's there, the whole task is done.
+            if self._config.node_output_compression_cmd is None \
+            or not os.path.exists( compressedBlockPath( blockwiseFileset.getDatasetPathComponents( roi[0] ).externalPath ) ):
+                return False
+            decompressionCmd = self._config.node_output_decompression_cmd
+            blockIndex = numpy.array( roi[0] ) / blockwiseFileset.description.block_shape
+            for fileset in secondaryFilesets:
+                decompressStagedBlock( fileset, blockIndex * fileset.description.block_shape, decompressionCmd )
+            decompressStagedBlock( blockwiseFileset, roi[0], decompressionCmd )
+            blockwiseFileset.setBlockStatus( roi[0], BlockwiseFileset.BLOCK_AVAILABLE )
+            return True
 
         try:
             # Figure out which work doesn't need to be recomputed (if any)
             unneeded_rois = []
             for roi in taskInfos.keys():
-                if blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE \
+                if isFinished(roi) \
                 or blockwiseFileset.isBlockLocked(roi[0]): # We don't attempt to process currently locked blocks.
                     unneeded_rois.append( roi )
     
@@ -203,32 +371,45 @@ class OpClusterize(Operator):
 
             absWorkDir, _ = getPathVariants(self._config.server_working_directory, os.path.split( configFilePath )[0] )
             if self._config.task_launch_server == "localhost":
-                def localCommand( cmd ):
-                    cwd = os.getcwd()
-                    os.chdir( absWorkDir )
-                    subprocess.call( cmd, shell=True )
-                    os.chdir( cwd )
-                launchFunc = localCommand
+                launchFunc = functools.partial( LocalTaskProcess, cwd=absWorkDir )
             else:
-                # We use fabric for executing remote tasks
-                # Import it here because it isn't required that the nodes can use it.
-                import fabric.api as fab
-                @fab.hosts( self._config.task_launch_server )
-                def remoteCommand( cmd ):
-                    with fab.cd( absWorkDir ):
-                        fab.run( cmd )
-                launchFunc = functools.partial( fab.execute, remoteCommand )
-    
-            # Spawn each task
-            for taskInfo in taskInfos.values():
-                logger.info("Launching node task: " + taskInfo.command )
-                launchFunc( taskInfo.command )
-        
-            # Return immediately.  We do not attempt to monitor the task progress.
-            result[0] = True
+                # Remote tasks are run through ssh, so they run concurrently and
+                #  can be polled and killed just like local tasks.
+                # (With a tty, killing ssh also hangs up the remote command.)
+                def launchFunc( cmd ):
+                    remoteCmd = "cd {} && {}".format( pipes.quote(absWorkDir), cmd )
+                    return LocalTaskProcess( "ssh -tt -o BatchMode=yes {} {}".format( self._config.task_launch_server,
+                                                                                      pipes.quote(remoteCmd) ) )
+
+            poll_interval_secs = self._config.task_poll_interval_secs
+            if poll_interval_secs is None:
+                poll_interval_secs = 10
+            scheduler = TaskScheduler( launchFunc,
+                                       isFinished,
+                                       timeout_secs=self._config.task_timeout_secs,
+                                       max_retries=self._config.task_max_retries or 0,
+                                       poll_interval_secs=poll_interval_secs,
+                                       max_concurrent=self._config.task_max_concurrent,
+                                       speculative_fraction=self._config.task_speculative_fraction,
+                                       launch_submits=bool(self._config.task_command_submits) )
+
+            commands = collections.OrderedDict( (roi, taskInfo.command) for roi, taskInfo in taskInfos.items() )
+            with Timer() as clusterTimer:
+                durations, failed_rois = scheduler.run( commands )
+
+            logger.info( "Finished {} tasks in {} seconds".format( len(durations), clusterTimer.seconds() ) )
+            if durations:
+                logger.info( "Task durations: min {:.1f}s, median {:.1f}s, max {:.1f}s".format(
+                    min(durations.values()), numpy.median(durations.values()), max(durations.values()) ) )
+            for roi in failed_rois:
+                logger.error( "Task {} for roi {} could not be completed.".format( taskInfos[roi].taskName, roi ) )
+
+            result[0] = (len(failed_rois) == 0)
             return result
         finally:
             blockwiseFileset.close()
+            for fileset in secondaryFilesets:
+                fileset.close()
 
     def _prepareTaskInfos(self, roiList):
         # Divide up the workload into large pieces
@@ -0,0 +1,168 @@
+import os
+import time
+import signal
+import subprocess
+import collections
+
+import numpy
+
+import logging
+logger = logging.getLogger(__name__)
+
+class LocalTaskProcess(object):
+    """
+    A task command running as a subprocess on this machine.
+    The command is started in its own process group, so kill() also stops
+    any children spawned by the shell.
+    """
+    def __init__(self, command, cwd=None):
+        self._process = subprocess.Popen( command, shell=True, cwd=cwd, preexec_fn=os.setsid )
+
+    def poll(self):
+        """Return the exit code, or None if the task is still running."""
+        return self._process.poll()
+
+    def kill(self):
+        if self._process.poll() is None:
+            try:
+                os.killpg( self._process.pid, signal.SIGKILL )
+            except OSError:
+                pass # Already gone
+            self._process.wait()
+
+class TaskScheduler(object):
+    """
+    Launches a set of tasks and monitors them until each one has finished or has failed too often.
+
+    Task completion is determined by polling isFinished(key) (e.g. the status of the task's
+    block in a BlockwiseFileset), so tasks may be launched on any backend.
+    If the launch function returns a handle (with poll() and kill(), like LocalTaskProcess),
+    tasks that exit without finishing are detected immediately and timed-out tasks are killed.
+    If it returns None, the launch is assumed to have run the task to its end.
+
+    If launch_submits is True, the launch command only submits the task to a queue (e.g. qsub),
+    so its exit says nothing about the task itself.  A submission that exits with code 0
+    (or a launch that returns None) counts as running until the task is finished or times out,
+    so a timeout is required.
+
+    Failed and timed-out tasks are re-launched up to max_retries times.
+    When only speculative_fraction of the tasks are left, tasks that have been running
+    for longer than twice the median task duration are launched a second time
+    and whichever copy finishes first wins.
+    """
+    Attempt = collections.namedtuple('Attempt', 'handle start_time')
+
+    def __init__(self, launchFunc, isFinished, timeout_secs=None, max_retries=0,
+                 poll_interval_secs=10, max_concurrent=None, speculative_fraction=None, launch_submits=False):
+        if launch_submits and timeout_secs is None:
+            raise ValueError("Submitted tasks can only be monitored with a timeout.")
+        self._launchFunc = launchFunc
+        self._isFinished = isFinished
+        self._timeout_secs = timeout_secs
+        self._max_retries = max_retries
+        self._poll_interval_secs = poll_interval_secs
+        self._max_concurrent = max_concurrent
+        self._speculative_fraction = speculative_fraction
+        self._launch_submits = launch_submits
+
+    def run(self, commands):
+        """
+        Run all tasks and wait for them.
+
+        :param commands: dict of { key : command string }
+        :returns: A tuple (finished_durations, failed_keys), where finished_durations
+                  is a dict of { key : seconds }
+        """
+        pending = collections.deque( commands.keys() )
+        running = collections.OrderedDict() # key -> list of Attempts
+        num_launches = collections.defaultdict(int)
+        speculated = set()
+        durations = {}
+        failed = []
+
+        def launch(key):
+            logger.info("Launching node task: " + commands[key])
+            handle = self._launchFunc( commands[key] )
+            running.setdefault(key, []).append( TaskScheduler.Attempt(handle, time.time()) )
+            num_launches[key] += 1
+
+        while True:
+            now = time.time()
+            for key in list(running.keys()):
+                # Check the handles before the status, so a task that marks
+                #  its block finished right before it exits isn't counted as failed.
+                live_attempts = []
+                for attempt in running[key]:
+                    exit_code = None
+                    if attempt.handle is not None:
+                        exit_code = attempt.handle.poll()
+                        if exit_code is None:
+                            live_attempts.append( attempt )
+                            continue
+                    if self._launch_submits and not exit_code:
+                        # Submitted.  From now on, only the status and the timeout tell us about the task.
+                        live_attempts.append( attempt._replace(handle=None) )
+
+                if self._isFinished(key):
+                    durations[key] = now - min( a.start_time for a in running[key] )
+                    for attempt in live_attempts:
+                        if attempt.handle is not None:
+                            attempt.handle.kill()
+                    del running[key]
+                    logger.info( "Task {} finished. ({} of {} tasks complete)".format( key, len(durations), len(commands) ) )
+                    continue
+
+                if len(live_attempts) < len(running[key]):
+                    if self._launch_submits:
+                        logger.warn( "Task {} could not be submitted.".format( key ) )
+                    else:
+                        logger.warn( "Task {} exited without finishing its work.".format( key ) )
+
+                if self._timeout_secs is not None:
+                    timed_out = filter( lambda a: now - a.start_time > self._timeout_secs, live_attempts )
+                    for attempt in timed_out:
+                        logger.warn( "Task {} timed out after {} seconds.".format( key, self._timeout_secs ) )
+                        if attempt.handle is not None:
+                            attempt.handle.kill()
+                        live_attempts.remove( attempt )
+
+                if live_attempts:
+                    running[key] = live_attempts
+                    continue
+
+                del running[key]
+                if num_launches[key] <= self._max_retries:
+                    logger.info( "Retrying task {} (attempt {} of {})".format( key, num_launches[key]+1, self._max_retries+1 ) )
+                    pending.append( key )
+                else:
+                    logger.error( "Task {} failed {} times.  Giving up.".format( key, num_launches[key] ) )
+                    failed.append( key )
+
+            if not pending and not running:
+                break
+
+            if not pending:
+                self._launchStragglers( running, durations, len(commands), speculated, launch )
+
+            while pending and (self._max_concurrent is None or len(running) < self._max_concurrent):
+                launch( pending.popleft() )
+
+            time.sleep( self._poll_interval_secs )
+
+        return durations, failed
+
+    def _launchStragglers(self, running, durations, num_tasks, speculated, launch):
+        """
+        Near the end of the run, launch a second copy of any task that takes much longer than usual.
+        """
+        if self._speculative_fraction is None or not durations:
+            return
+        if len(running) > self._speculative_fraction * num_tasks:
+            return
+        now = time.time()
+        threshold = 2 * numpy.median( durations.values() )
+        for key, attempts in running.items():
+            if key not in speculated and now - attempts[0].start_time > threshold:
+                logger.info( "Task {} is a straggler.  Launching a second copy.".format( key ) )
+                speculated.add( key )
+                launch( key )
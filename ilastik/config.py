@@ -9,6 +9,7 @@ Example:
 [ilastik]
 debug: false
 plugin_directories: ~/.ilastik/plugins,
+plugin_manifest: ~/.ilastik/plugin_manifest.json
 logging_config: ~/custom_ilastik_logging_config.json
 """
 
@@ -16,6 +17,7 @@ default_config = """
 [ilastik]
 debug: false
 plugin_directories: ~/.ilastik/plugins,
+plugin_manifest: ~/.ilastik/plugin_manifest.json
 """
 
 cfg = ConfigParser.SafeConfigParser()
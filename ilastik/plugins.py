@@ -1,19 +1,29 @@
 from ilastik.config import cfg
 
 from yapsy.IPlugin import IPlugin
-from yapsy.PluginManager import PluginManager
 
 import os
+import re
+import imp
+import json
+import logging
+import threading
+import ConfigParser
 from collections import namedtuple
 from functools import partial
 import numpy
 
+logger = logging.getLogger(__name__)
+
 # these directories are searched for plugins
 plugin_paths = cfg.get('ilastik', 'plugin_directories')
 plugin_paths = list(os.path.expanduser(d) for d in plugin_paths.split(',')
                     if len(d) > 0)
 plugin_paths.append(os.path.join(os.path.split(__file__)[0], "plugins_default"))
 
+# the plugins found in plugin_paths are remembered in this file
+plugin_manifest = os.path.expanduser(cfg.get('ilastik', 'plugin_manifest'))
+
 ##########################
 # different plugin types #
 ##########################
@@ -73,6 +83,31 @@ class ObjectFeaturesPlugin(IPlugin):
         """
         return dict()
 
+    def mergeableFeatures(self):
+        """Reports which features can be computed blockwise.
+
+        These features must be derivable exactly from per-label
+        statistics that were accumulated on blocks of the image and
+        merged (see compute_merged).
+
+        :returns: a set of feature names
+
+        """
+        return set()
+
+    def compute_merged(self, stats, features):
+        """Calculate mergeable features from merged block statistics.
+
+        :param stats: RegionStatistics, accumulated over all blocks of
+            the image
+        :param features: which features to compute. Only called if all
+            of them are in mergeableFeatures()
+
+        :returns: like compute_global()
+
+        """
+        return dict()
+
     @staticmethod
     def combine_dicts(ds):
         return dict(sum((d.items() for d in ds), []))
@@ -118,13 +153,179 @@ class ObjectFeaturesPlugin(IPlugin):
 # the manager #
 ###############
 
-pluginManager = PluginManager()
-pluginManager.setPluginPlaces(plugin_paths)
+class PluginInfo(object):
+    """Description of a single plugin, as read from its .yapsy-plugin file.
+
+    Like yapsy's PluginInfo, but the plugin module is only imported
+    (and plugin_object created) when it is first needed.
+
+    """
+    def __init__(self, manager, name, path, description=""):
+        self._manager = manager
+        self.name = name
+        self.path = path # module path (without .py) or package directory
+        self.description = description
+        self.category = None
+        self._plugin_object = None
+
+    @property
+    def plugin_object(self):
+        self._manager.loadPlugin(self)
+        return self._plugin_object
+
+    def toDict(self):
+        return dict(name=self.name, path=self.path, description=self.description)
+
+class LazyPluginManager(object):
+    """Finds plugins like yapsy's PluginManager, but does not import
+    anything up front.
+
+    The plugin directories are only scanned on first use, and the
+    result is stored in a manifest file, which is reused as long as
+    the modification times of the plugin directories do not change.
+    A plugin module is only imported when the plugin is requested by
+    name (or when all plugins of a category are requested).
+
+    """
+    PLUGIN_INFO_EXT = "yapsy-plugin"
+
+    def __init__(self, plugin_places, categories_filter, manifest_path=None):
+        self._plugin_places = list(plugin_places)
+        self._categories_filter = dict(categories_filter)
+        self._manifest_path = manifest_path
+        self._plugins = None # name -> PluginInfo
+        self._lock = threading.RLock()
+
+    def _directoryTimes(self):
+        times = {}
+        for directory in self._plugin_places:
+            if os.path.isdir(directory):
+                times[directory] = os.path.getmtime(directory)
+        return times
+
+    def _scanDirectories(self):
+        """Read all plugin info files in the plugin directories."""
+        plugins = []
+        for directory in self._plugin_places:
+            if not os.path.isdir(directory):
+                continue
+            for filename in sorted(os.listdir(directory)):
+                if not filename.endswith("." + self.PLUGIN_INFO_EXT):
+                    continue
+                parser = ConfigParser.SafeConfigParser()
+                try:
+                    parser.read(os.path.join(directory, filename))
+                    name = parser.get("Core", "Name").strip()
+                    module = parser.get("Core", "Module").strip()
+                except ConfigParser.Error:
+                    logger.warn("Could not read plugin info file {}".format(filename))
+                    continue
+                description = ""
+                if parser.has_option("Documentation", "Description"):
+                    description = parser.get("Documentation", "Description")
+                plugins.append( dict( name=name,
+                                      path=os.path.join(directory, module),
+                                      description=description ) )
+        return plugins
+
+    def _readManifest(self, times):
+        if self._manifest_path is None or not os.path.exists(self._manifest_path):
+            return None
+        try:
+            with open(self._manifest_path) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if manifest.get("places") != self._plugin_places or manifest.get("times") != times:
+            return None
+        return manifest["plugins"]
+
+    def _writeManifest(self, times, plugins):
+        if self._manifest_path is None:
+            return
+        manifest = dict( places=self._plugin_places, times=times, plugins=plugins )
+        try:
+            directory = os.path.dirname(self._manifest_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            # Write to a temporary file first, so that concurrent processes never see a partial manifest
+            tmp_path = "{}.{}.tmp".format(self._manifest_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tmp_path, self._manifest_path)
+        except (IOError, OSError) as ex:
+            logger.debug("Could not write plugin manifest {}: {}".format(self._manifest_path, ex))
+
+    def collectPlugins(self):
+        """Find the plugins (without importing them), using the manifest if it is up-to-date."""
+        with self._lock:
+            if self._plugins is not None:
+                return
+            times = self._directoryTimes()
+            # json turns the directory keys into unicode and the times into floats
+            times = dict( (unicode(k), float(v)) for k, v in times.items() )
+            plugins = self._readManifest(times)
+            if plugins is None:
+                plugins = self._scanDirectories()
+                self._writeManifest(times, plugins)
+            self._plugins = {}
+            for p in plugins:
+                name = str(p["name"])
+                if name in self._plugins:
+                    # the first directory wins, like the order of plugin_directories
+                    continue
+                self._plugins[name] = PluginInfo( self, name, str(p["path"]), p["description"] )
+
+    def loadPlugin(self, plugin_info):
+        """Import the module of a plugin and create (and activate) its plugin object."""
+        with self._lock:
+            if plugin_info._plugin_object is not None or plugin_info.category is not None:
+                return
+            module_name = "ilastik_plugin_" + re.sub(r'\W', '_', plugin_info.name)
+            directory, module = os.path.split(plugin_info.path)
+            try:
+                module = imp.load_module( module_name, *imp.find_module(module, [directory]) )
+            except Exception:
+                logger.error("Could not import plugin {} from {}".format(plugin_info.name, plugin_info.path), exc_info=True)
+                plugin_info.category = ""
+                return
+            for element in vars(module).values():
+                for category, category_class in self._categories_filter.items():
+                    if isinstance(element, type) and issubclass(element, category_class) \
+                            and element is not category_class:
+                        plugin_info.category = category
+                        plugin_info._plugin_object = element()
+                        plugin_info._plugin_object.activate()
+                        return
+            logger.warn("Plugin module {} does not contain a plugin class".format(plugin_info.path))
+            plugin_info.category = ""
+
+    def getPluginByName(self, name, category="ObjectFeatures"):
+        """Return the PluginInfo of the plugin, importing only this one plugin."""
+        self.collectPlugins()
+        plugin_info = self._plugins.get(name)
+        if plugin_info is None:
+            return None
+        self.loadPlugin(plugin_info)
+        if plugin_info.category != category:
+            return None
+        return plugin_info
+
+    def getPluginsOfCategory(self, category):
+        """Return the PluginInfos of all plugins in the category (imports all plugins)."""
+        self.collectPlugins()
+        for plugin_info in self._plugins.values():
+            self.loadPlugin(plugin_info)
+        return sorted( (p for p in self._plugins.values() if p.category == category),
+                       key=lambda p: p.name )
 
-pluginManager.setCategoriesFilter({
-   "ObjectFeatures" : ObjectFeaturesPlugin,
-   })
+    def getAllPlugins(self):
+        self.collectPlugins()
+        for plugin_info in self._plugins.values():
+            self.loadPlugin(plugin_info)
+        return sorted( (p for p in self._plugins.values() if p.category),
+                       key=lambda p: p.name )
 
-pluginManager.collectPlugins()
-for pluginInfo in pluginManager.getAllPlugins():
-    pluginManager.activatePluginByName(pluginInfo.name)
+pluginManager = LazyPluginManager( plugin_paths,
+                                   { "ObjectFeatures" : ObjectFeaturesPlugin },
+                                   plugin_manifest )
@@ -42,6 +42,11 @@ class VigraObjFeats(ObjectFeaturesPlugin):
     local_suffix = " in neighborhood" #note the space in front, it's important
     local_out_suffixes = [local_suffix, " in object and neighborhood"]
 
+    # features that can be merged from RegionStatistics of blocks
+    mergeable_features = set(["Count", "Sum", "Mean", "Variance", \
+                              "Minimum", "Maximum", "Coord<Minimum>", \
+                              "Coord<Maximum>", "RegionCenter"])
+
     ndim = None
     
     def availableFeatures(self, image, labels):
@@ -121,6 +126,13 @@ class VigraObjFeats(ObjectFeaturesPlugin):
             
         return self._do_4d(image, labels, features, axes)
 
+    def mergeableFeatures(self):
+        return self.mergeable_features
+
+    def compute_merged(self, stats, features):
+        merged = stats.features()
+        return dict((k, merged[k]) for k in features)
+
     def compute_local(self, image, binary_bbox, feature_dict, axes):
         """helper that deals with individual objects"""
         
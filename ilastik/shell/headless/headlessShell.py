@@ -27,13 +27,13 @@ class HeadlessShell(object):
                                               workflow_cmdline_args=self._workflow_cmdline_args  )
         self.projectManager._loadProject(hdf5File, newProjectFilePath, readOnly)
         
-    def openProjectFile(self, projectFilePath):
+    def openProjectFile(self, projectFilePath, readOnly=False):
         # Make sure all workflow sub-classes have been loaded,
         #  so we can detect the workflow type in the project.
         import ilastik.workflows
         try:
             # Open the project file
-            hdf5File, workflow_class, _ = ProjectManager.openProjectFile(projectFilePath)
+            hdf5File, workflow_class, readOnly = ProjectManager.openProjectFile(projectFilePath, readOnly)
 
             if workflow_class is None:
                 # If the project file has no known workflow, we assume pixel classification
@@ -49,9 +49,12 @@ class HeadlessShell(object):
                                                   workflow_class,
                                                   headless=True,
                                                   workflow_cmdline_args=self._workflow_cmdline_args )
-            self.projectManager._loadProject(hdf5File, projectFilePath, readOnly = False)
+            self.projectManager._loadProject(hdf5File, projectFilePath, readOnly)
             
         except ProjectManager.ProjectVersionError:
+            if readOnly:
+                # Importing would write a new project file.
+                raise
             # Couldn't open project.  Try importing it.
             oldProjectFilePath = projectFilePath
             name, ext = os.path.splitext(oldProjectFilePath)
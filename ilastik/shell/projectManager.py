@@ -88,12 +88,13 @@ class ProjectManager(object):
         return str( projectFile['workflowName'][()] )
 
     @classmethod
-    def openProjectFile(cls, projectFilePath):
+    def openProjectFile(cls, projectFilePath, forceReadOnly=False):
         """
         Class method.
         Attempt to open the given path to an existing project file.
         If it doesn't exist, raise a ``ProjectManager.FileMissingError``.
         If its version is outdated, raise a ``ProjectManager.ProjectVersionError.``
+        If forceReadOnly is True, the file is opened read-only even if it is writable.
         """
         logger.info("Opening Project: " + projectFilePath)
 
@@ -101,13 +102,15 @@ class ProjectManager(object):
             raise ProjectManager.FileMissingError()
 
         # Open the file as an HDF5 file
-        try:
-            hdf5File = h5py.File(projectFilePath)
-            readOnly = False
-        except IOError:
-            # Maybe the project is read-only
+        readOnly = forceReadOnly
+        if not readOnly:
+            try:
+                hdf5File = h5py.File(projectFilePath, 'r+')
+            except IOError:
+                # Maybe the project is read-only
+                readOnly = True
+        if readOnly:
             hdf5File = h5py.File(projectFilePath, 'r')
-            readOnly = True
 
         projectVersion = "0.5"
         if "ilastikVersion" in hdf5File.keys():
@@ -0,0 +1,100 @@
+import os
+import threading
+import collections
+
+import h5py
+
+class H5HandlePool(object):
+    """
+    Keeps hdf5 files open (read-only) so that repeated reads from the same
+    datasets don't pay for opening the file and re-reading its metadata each time.
+
+    If a file is modified or replaced on disk (i.e. its mtime changes),
+    it is re-opened on the next access.
+    At most maxOpenFiles files are kept open; the least recently used ones are closed first.
+    Threadsafe.  (Files are only closed when no read is in progress.)
+    """
+    class _Entry(object):
+        def __init__(self, path, mtime):
+            self.mtime = mtime
+            self.file = h5py.File(path, 'r')
+            self.datasets = {}
+            self.lock = threading.Lock()
+
+        def dataset(self, datasetName):
+            if datasetName not in self.datasets:
+                self.datasets[datasetName] = self.file[datasetName]
+            return self.datasets[datasetName]
+
+        def close(self):
+            with self.lock:
+                self.file.close()
+
+    def __init__(self, maxOpenFiles=64):
+        self.maxOpenFiles = maxOpenFiles
+        self._entries = collections.OrderedDict() # path -> _Entry, least recently used first
+        self._lock = threading.Lock()
+
+    def _getEntry(self, path):
+        path = os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+        closing = []
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None and entry.mtime != mtime:
+                closing.append( entry )
+                entry = None
+            if entry is None:
+                entry = H5HandlePool._Entry( path, mtime )
+            # Re-insert as the most recently used file
+            self._entries[path] = entry
+
+            while len(self._entries) > self.maxOpenFiles:
+                closing.append( self._entries.popitem(last=False)[1] )
+
+        for oldEntry in closing:
+            oldEntry.close()
+        return entry
+
+    def _withDataset(self, path, datasetName, func):
+        """
+        Call func(dataset) while the file is guaranteed to stay open.
+        """
+        while True:
+            entry = self._getEntry(path)
+            with entry.lock:
+                # The file may have been closed (evicted) right after we got it.
+                if entry.file:
+                    return func( entry.dataset(datasetName) )
+
+    def getShapeAndDtype(self, path, datasetName):
+        return self._withDataset( path, datasetName, lambda dataset: (dataset.shape, dataset.dtype) )
+
+    def read(self, path, datasetName, key, out=None, outKey=None):
+        """
+        Read dataset[key] from the file at path.
+        If out is given, the data is written directly into out[outKey] (out must be C-contiguous)
+        and out is returned.
+        """
+        def readDataset(dataset):
+            if out is None:
+                return dataset[key]
+            dataset.read_direct(out, key, outKey)
+            return out
+        return self._withDataset( path, datasetName, readDataset )
+
+    def close(self, path=None):
+        """
+        Close the given file, or all files if no path is given.
+        """
+        with self._lock:
+            if path is None:
+                closing = self._entries.values()
+                self._entries.clear()
+            else:
+                closing = filter( None, [self._entries.pop(os.path.abspath(path), None)] )
+        for entry in closing:
+            entry.close()
+
+# The process-wide pool
+h5HandlePool = H5HandlePool()
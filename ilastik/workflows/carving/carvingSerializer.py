@@ -1,18 +1,41 @@
 from ilastik.applets.base.appletSerializer import AppletSerializer, getOrCreateGroup, deleteIfPresent
+from ilastik.workflows.carving.lazyObjectDict import LazyObjectDict
+from ilastik.workflows.carving.supervoxelObjectIndex import SupervoxelObjectIndex
 import numpy
+import h5py
+from functools import partial
 
 from lazyflow.roi import roiFromShape, roiToSlice
 
+def _readVoxels(dataset):
+    """Read an (n,3) voxel coordinate dataset as a list of three coordinate arrays."""
+    v = dataset[...]
+    return [v[:,k] for k in range(3)]
+
+def _readValue(dataset):
+    return dataset.value
+
 class CarvingSerializer( AppletSerializer ):
+    #: Maximum number of objects whose seeds and supervoxels are kept in memory after loading them from the project
+    MaxResidentObjects = 50
+
     def __init__(self, carvingTopLevelOperator, *args, **kwargs):
         super(CarvingSerializer, self).__init__(*args, **kwargs)
         self._o = carvingTopLevelOperator 
+        # The project file that lazily loaded objects are read from
+        self._projectFile = None
+        self._projectFilePath = None
         
         
     def _serializeToHdf5(self, topGroup, hdf5File, projectFilePath):
+        if projectFilePath == self._projectFilePath:
+            # Saving to the project file itself (possibly re-opened since we loaded it)
+            self._projectFile = hdf5File
         obj = getOrCreateGroup(topGroup, "objects")
         for imageIndex, opCarving in enumerate( self._o.innerOperators ):
-            mst = opCarving._mst 
+            # Lanes without changed objects don't need their MST (which might not be loaded yet)
+            if opCarving._dirtyObjects:
+                mst = opCarving._mst 
             for name in opCarving._dirtyObjects:
                 print "[CarvingSerializer] serializing %s" % name
                
@@ -24,6 +47,12 @@ class CarvingSerializer( AppletSerializer ):
                 else:
                     print "  -> added"
                     
+                if name in mst.object_seeds_fg_voxels:
+                    # Get the data before deleting the datasets it might be loaded from
+                    fg_voxels = mst.object_seeds_fg_voxels[name]
+                    bg_voxels = mst.object_seeds_bg_voxels[name]
+                    sv = mst.object_lut[name]
+
                 g = getOrCreateGroup(obj, name)
                 deleteIfPresent(g, "fg_voxels")
                 deleteIfPresent(g, "bg_voxels")
@@ -36,21 +65,26 @@ class CarvingSerializer( AppletSerializer ):
                     deleteIfPresent(obj, name)
                     continue
                
-                v = mst.object_seeds_fg_voxels[name]
-                v = [v[i][:,numpy.newaxis] for i in range(3)]
+                v = [fg_voxels[i][:,numpy.newaxis] for i in range(3)]
                 v = numpy.concatenate(v, axis=1)
                 g.create_dataset("fg_voxels", data=v)
-                v = mst.object_seeds_bg_voxels[name]
-                v = [v[i][:,numpy.newaxis] for i in range(3)]
+                v = [bg_voxels[i][:,numpy.newaxis] for i in range(3)]
                 v = numpy.concatenate(v, axis=1)
                 g.create_dataset("bg_voxels", data=v)
-                g.create_dataset("sv", data=mst.object_lut[name])
+                g.create_dataset("sv", data=sv)
                 
                 d1 = numpy.asarray(mst.bg_priority[name], dtype=numpy.float32)
                 d2 = numpy.asarray(mst.no_bias_below[name], dtype=numpy.int32)
                 g.create_dataset("bg_prio", data=d1)
                 g.create_dataset("no_bias_below", data=d2)
+
+                if hdf5File is self._projectFile:
+                    # The object is safely stored now, so it may be dropped from memory like the loaded ones.
+                    # (Not if we're writing a snapshot to a different file.)
+                    self._setLazyObject(mst, name)
                 
+            if opCarving._dirtyObjects or "object_index" not in topGroup:
+                self._serializeObjectIndex(topGroup, opCarving)
             opCarving._dirtyObjects = set()
         
             # save current seeds
@@ -75,36 +109,32 @@ class CarvingSerializer( AppletSerializer ):
         
     def _deserializeFromHdf5(self, topGroup, groupVersion, hdf5File, projectFilePath):
         obj = topGroup["objects"]
+        self._projectFile = hdf5File
+        self._projectFilePath = projectFilePath
         for imageIndex, opCarving in enumerate( self._o.innerOperators ):
-            mst = opCarving._mst 
-            
+            # Only the object names and the per-object parameters are read now.
+            # Seeds and supervoxel lists are read from the project file when they are first needed.
+            objects = []
             for i, name in enumerate(obj):
-                print " loading object with name='%s'" % name
                 try:
                     g = obj[name]
-                    fg_voxels = g["fg_voxels"]
-                    bg_voxels = g["bg_voxels"]
-                    fg_voxels = [fg_voxels[:,k] for k in range(3)]
-                    bg_voxels = [bg_voxels[:,k] for k in range(3)]
-                    
-                    sv = g["sv"].value
-                  
-                    mst.object_names[name]           = i+1 
-                    mst.object_seeds_fg_voxels[name] = fg_voxels
-                    mst.object_seeds_bg_voxels[name] = bg_voxels
-                    mst.object_lut[name]             = sv
-                    mst.bg_priority[name]            = g["bg_prio"].value
-                    mst.no_bias_below[name]          = g["no_bias_below"].value
+                    objects.append( (name, i+1, g["bg_prio"].value, g["no_bias_below"].value) )
                     
-                    print "[CarvingSerializer] de-serializing %s, with opCarving=%d, mst=%d" % (name, id(opCarving), id(mst))
-                    print "  %d voxels labeled with green seed" % fg_voxels[0].shape[0] 
-                    print "  %d voxels labeled with red seed" % bg_voxels[0].shape[0] 
-                    print "  object is made up of %d supervoxels" % sv.size
-                    print "  bg priority = %f" % mst.bg_priority[name]
-                    print "  no bias below = %d" % mst.no_bias_below[name]
+                    print "[CarvingSerializer] registered object %s: %d fg seeds, %d bg seeds, bg priority = %f, no bias below = %d" \
+                          % (name, g["fg_voxels"].shape[0], g["bg_voxels"].shape[0], g["bg_prio"].value, g["no_bias_below"].value)
                 except Exception as e:
                     print 'object %s could not be loaded due to exception: %s'% (name,e)
 
+            objectIndex = None
+            if "object_index" in topGroup:
+                g = topGroup["object_index"]
+                objectIndex = SupervoxelObjectIndex.fromArrays( g["supervoxels"].value,
+                                                                g["names"].value,
+                                                                g["object_names"].value )
+
+            # The objects are attached to the MST when the lane loads it
+            opCarving.callWithMst( partial(self._restoreObjects, opCarving, objects, objectIndex) )
+
             shape = opCarving.opLabelArray.Output.meta.shape
             dtype = opCarving.opLabelArray.Output.meta.dtype
 
@@ -148,9 +178,48 @@ class CarvingSerializer( AppletSerializer ):
                 bounding_box_slicing = roiToSlice( bounding_box_roi[0], bounding_box_roi[1] )
                 opCarving.WriteSeeds[(slice(0,1),) + bounding_box_slicing + (slice(0,1),)] = z[numpy.newaxis, :,:,:, numpy.newaxis]
                 print "restored seeds"
-                
-            opCarving._buildDone()
            
+    def _restoreObjects(self, opCarving, objects, objectIndex, mst):
+        mst.object_seeds_fg_voxels = LazyObjectDict( self.MaxResidentObjects )
+        mst.object_seeds_bg_voxels = LazyObjectDict( self.MaxResidentObjects )
+        mst.object_lut             = LazyObjectDict( self.MaxResidentObjects )
+        for name, number, bgPriority, noBiasBelow in objects:
+            mst.object_names[name]  = number
+            mst.bg_priority[name]   = bgPriority
+            mst.no_bias_below[name] = noBiasBelow
+            self._setLazyObject(mst, name)
+        opCarving._objectIndex = objectIndex
+        opCarving._buildDone()
+
+    def _serializeObjectIndex(self, topGroup, opCarving):
+        deleteIfPresent(topGroup, "object_index")
+        if opCarving._mst is None:
+            return
+        supervoxels, names, objectNames = opCarving.getObjectIndex().toArrays()
+        g = topGroup.create_group("object_index")
+        g.create_dataset("supervoxels", data=supervoxels)
+        g.create_dataset("names", data=names, dtype=h5py.special_dtype(vlen=str))
+        g.create_dataset("object_names", data=objectNames, dtype=h5py.special_dtype(vlen=str))
+
+    def _setLazyObject(self, mst, name):
+        """Read the seeds and supervoxels of the object from the project file on demand."""
+        for d in (mst.object_seeds_fg_voxels, mst.object_seeds_bg_voxels, mst.object_lut):
+            if not isinstance(d, LazyObjectDict):
+                return
+        mst.object_seeds_fg_voxels.setLazy( name, partial(self._readObjectData, name, "fg_voxels", _readVoxels) )
+        mst.object_seeds_bg_voxels.setLazy( name, partial(self._readObjectData, name, "bg_voxels", _readVoxels) )
+        mst.object_lut.setLazy( name, partial(self._readObjectData, name, "sv", _readValue) )
+
+    def _readObjectData(self, name, key, reader):
+        if not self._projectFile:
+            # Our file handle was closed (e.g. by "Save As"), so open the project file again.
+            self._projectFile = h5py.File(self._projectFilePath, 'r')
+        return reader( self._projectFile[self.topGroupName]["objects"][name][key] )
+
+    def updateWorkingDirectory(self, newdir, olddir):
+        # After "Save As", the current project file is the one at the new path
+        self._projectFilePath = newdir
+
     def isDirty(self):
         for index, innerOp in enumerate(self._o.innerOperators):
             if len(innerOp._dirtyObjects) > 0:
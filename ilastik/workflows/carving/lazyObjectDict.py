@@ -0,0 +1,99 @@
+import threading
+import collections
+
+_NOT_LOADED = object()
+
+class LazyObjectDict(dict):
+    """
+    A dict for per-object carving data (seeds, supervoxel lists) whose
+    values can be registered with a loader function instead of a value.
+    Such values are loaded on first access and kept in memory until more than
+    maxResident of them are loaded, at which point the least recently used
+    ones are dropped again (they are re-loaded on the next access).
+
+    Values that are assigned directly (e.g. a newly saved object) are never dropped.
+    """
+    def __init__(self, maxResident=None):
+        super(LazyObjectDict, self).__init__()
+        self.maxResident = maxResident
+        self._loaders = {}
+        self._resident = collections.OrderedDict() # loaded lazy keys, least recently used first
+        self._lock = threading.RLock()
+
+    def setLazy(self, key, loader):
+        """
+        Register loader() as the source of the value for key.
+        The value is not loaded until it is accessed.
+        """
+        with self._lock:
+            dict.__setitem__(self, key, _NOT_LOADED)
+            self._loaders[key] = loader
+            self._resident.pop(key, None)
+
+    def isLoaded(self, key):
+        return dict.__getitem__(self, key) is not _NOT_LOADED
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = dict.__getitem__(self, key)
+            if value is _NOT_LOADED:
+                value = self._loaders[key]()
+                dict.__setitem__(self, key, value)
+                self._resident[key] = True
+                self._evict()
+            elif key in self._resident:
+                # Mark as most recently used
+                del self._resident[key]
+                self._resident[key] = True
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._loaders.pop(key, None)
+            self._resident.pop(key, None)
+            dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._loaders.pop(key, None)
+            self._resident.pop(key, None)
+            dict.__delitem__(self, key)
+
+    def _evict(self):
+        if self.maxResident is None:
+            return
+        while len(self._resident) > self.maxResident:
+            key, _ = self._resident.popitem(last=False)
+            dict.__setitem__(self, key, _NOT_LOADED)
+
+    # The dict methods below don't go through __getitem__, so they must be overridden as well.
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *default):
+        with self._lock:
+            if key not in self:
+                return dict.pop(self, key, *default)
+            value = self[key]
+            del self[key]
+            return value
+
+    def itervalues(self):
+        for key in self.keys():
+            yield self[key]
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        return dict(self.iteritems())
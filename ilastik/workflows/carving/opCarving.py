@@ -2,6 +2,7 @@
 import time
 import numpy, h5py
 import copy
+import scipy.ndimage
 
 #Lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
@@ -9,11 +10,11 @@ from lazyflow.stype import Opaque
 from lazyflow.rtype import List
 from lazyflow.roi import roiToSlice
 from lazyflow.operators.opDenseLabelArray import OpDenseLabelArray
-from lazyflow.operators.valueProviders import OpValueCache
 
 #ilastik
 from lazyflow.utility.timer import Timer
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.workflows.carving.supervoxelObjectIndex import SupervoxelObjectIndex
 
 #carving
 from cylemon.segmentation import MSTSegmentor
@@ -95,7 +96,11 @@ class OpCarving(Operator):
         self.opLabelArray.MetaInput.connect( self.InputData )
         
         self._hintOverlayFile = hintOverlayFile
-        self._mst = None
+        # The MST is only fetched from the MST slot when it is first used (see _mst)
+        self._loadedMst = None
+        # seeds written before the MST was fetched, and functions waiting for it (see callWithMst)
+        self._pendingSeeds = []
+        self._mstCallbacks = []
         self.has_seeds = False # keeps track of whether or not there are seeds currently loaded, either drawn by the user or loaded from a saved object
         
         self.LabelNames.setValue( ["Background", "Object"] )
@@ -103,6 +108,12 @@ class OpCarving(Operator):
         #supervoxels of finished and saved objects
         self._done_lut = None
         self._done_seg_lut = None
+        #supervoxel id -> names of the saved objects containing it (built on demand)
+        self._objectIndex = None
+        #name -> object number of the objects that are currently part of the done luts
+        self._doneNumbers = {}
+        #bounding box (start, stop) of each supervoxel (built on demand)
+        self._supervoxelBoxes = None
         self._hints = None
         self._pmap = None
         if hintOverlayFile is not None:
@@ -128,10 +139,45 @@ class OpCarving(Operator):
         self._dirtyObjects = set()
         self.preprocessingApplet = None
         
-        self._opMstCache = OpValueCache( parent=self )
-        self.MstOut.connect( self._opMstCache.Output )
-
         self.InputData.notifyReady( self._checkConstraints )
+
+    @property
+    def _mst(self):
+        """
+        The MSTSegmentor of this lane.  Loading it from the project file is expensive,
+        so it is fetched from the MST slot when it is first used, not when the slot changes.
+        """
+        if self._loadedMst is None and self.MST.ready():
+            mst = self.MST.value
+            if mst is not None:
+                self._setMst( mst )
+        return self._loadedMst
+
+    @_mst.setter
+    def _mst(self, mst):
+        self._setMst( mst )
+
+    def _setMst(self, mst):
+        self._loadedMst = mst
+        self._objectIndex = None
+        self._supervoxelBoxes = None
+        if mst is None:
+            return
+        pendingSeeds, self._pendingSeeds = self._pendingSeeds, []
+        for key, value in pendingSeeds:
+            mst.seeds[key] = value
+        callbacks, self._mstCallbacks = self._mstCallbacks, []
+        for callback in callbacks:
+            callback( mst )
+
+    def callWithMst(self, callback):
+        """
+        Call callback(mst) as soon as the MST of this lane is loaded, which may be right away.
+        """
+        if self._loadedMst is None:
+            self._mstCallbacks.append( callback )
+        else:
+            callback( self._loadedMst )
     
     def _checkConstraints(self, *args):
         slot = self.InputData
@@ -174,22 +220,120 @@ class OpCarving(Operator):
 
     def _buildDone(self):
         """
-        Builds the done segmentation anew, for example after saving an object or
-        deleting an object.
+        Builds the done segmentation anew, e.g. after loading a project.
+        Single objects are added and removed with _updateDone().
+        The luts are built from the supervoxel -> object index, so the supervoxel
+        lists of the objects don't have to be loaded from the project file.
         """
         if self._mst is None:
             return
         with Timer() as timer:
-            self._done_lut = numpy.zeros(len(self._mst.objects.lut), dtype=numpy.int32)
-            self._done_seg_lut = numpy.zeros(len(self._mst.objects.lut), dtype=numpy.int32)
+            numSupervoxels = len(self._mst.objects.lut)
+            self._done_lut = numpy.zeros(numSupervoxels, dtype=numpy.int32)
+            self._done_seg_lut = numpy.zeros(numSupervoxels, dtype=numpy.int32)
             print "building 'done' luts"
-            for name, objectSupervoxels in self._mst.object_lut.iteritems():
-                if name == self._currObjectName:
-                    continue
-                self._done_lut[objectSupervoxels] += 1
+            supervoxels, names, objectNames = self.getObjectIndex().toArrays()
+            for name in objectNames:
                 assert name in self._mst.object_names, "%s not in self._mst.object_names, keys are %r" % (name, self._mst.object_names.keys())
-                self._done_seg_lut[objectSupervoxels] = self._mst.object_names[name]
+            self._doneNumbers = dict( (name, self._mst.object_names[name]) for name in objectNames if name != self._currObjectName )
+
+            done = numpy.array([name in self._doneNumbers for name in names], dtype=bool)
+            supervoxels = supervoxels[done]
+            names = names[done]
+            self._done_lut[:] = numpy.bincount(supervoxels, minlength=numSupervoxels)[:numSupervoxels]
+            self._done_seg_lut[supervoxels] = [self._doneNumbers[name] for name in names]
         print "building the 'done' luts took {} seconds".format( timer.seconds() )
+
+    def _updateDone(self, changes):
+        """
+        Updates the done luts for the given objects only, and marks the
+        region they cover as dirty.
+
+        :param changes: list of (name, oldSupervoxels) pairs. oldSupervoxels are the
+                        supervoxels the object had when it was added to the done luts,
+                        or None if they haven't changed since.
+        """
+        if self._mst is None:
+            return
+        if self._done_lut is None or len(self._done_lut) != len(self._mst.objects.lut):
+            self._buildDone()
+            self._setDoneDirty(None)
+            return
+
+        changed = []
+        updated = set()
+        for name, oldSupervoxels in changes:
+            if name in updated:
+                continue
+            updated.add(name)
+            if name in self._doneNumbers:
+                # Remove the object's old contribution
+                if oldSupervoxels is None:
+                    oldSupervoxels = self._mst.object_lut[name]
+                oldSupervoxels = numpy.asarray(oldSupervoxels).ravel()
+                objNr = self._doneNumbers.pop(name)
+                self._done_lut[oldSupervoxels] -= 1
+                stale = oldSupervoxels[self._done_seg_lut[oldSupervoxels] == objNr]
+                self._done_seg_lut[stale] = 0
+                changed.append(oldSupervoxels)
+
+            if name in self._mst.object_lut and name != self._currObjectName:
+                objectSupervoxels = numpy.asarray(self._mst.object_lut[name]).ravel()
+                objNr = self._mst.object_names[name]
+                self._done_lut[objectSupervoxels] += 1
+                self._done_seg_lut[objectSupervoxels] = objNr
+                self._doneNumbers[name] = objNr
+                changed.append(objectSupervoxels)
+
+        if not changed:
+            return
+        changed = numpy.unique(numpy.concatenate(changed))
+
+        # Supervoxels whose label was removed, but which still belong to another done object
+        uncovered = changed[(self._done_seg_lut[changed] == 0) & (self._done_lut[changed] > 0)]
+        if len(uncovered) > 0:
+            objectIndex = self.getObjectIndex()
+            for sv in uncovered:
+                for name in objectIndex.namesAt(sv):
+                    if name in self._doneNumbers:
+                        self._done_seg_lut[sv] = self._doneNumbers[name]
+
+        self._setDoneDirty(changed)
+
+    def _getSupervoxelBoxes(self):
+        """
+        Returns (starts, stops), the bounding boxes of all supervoxels, indexed by supervoxel id.
+        """
+        if self._supervoxelBoxes is None:
+            regionVol = numpy.asarray(self._mst.regionVol)
+            nsv = max(len(self._mst.objects.lut), int(regionVol.max()) + 1)
+            starts = numpy.zeros((nsv, 3), dtype=numpy.int64)
+            stops = numpy.zeros((nsv, 3), dtype=numpy.int64)
+            starts[:] = regionVol.shape
+            for i, slicing in enumerate(scipy.ndimage.find_objects(regionVol)):
+                if slicing is not None:
+                    starts[i+1] = [s.start for s in slicing]
+                    stops[i+1] = [s.stop for s in slicing]
+            self._supervoxelBoxes = (starts, stops)
+        return self._supervoxelBoxes
+
+    def _setDoneDirty(self, supervoxels):
+        """
+        Marks the bounding box of the given supervoxels dirty in the done outputs.
+        (supervoxels=None: the whole volume)
+        """
+        if supervoxels is None:
+            self.DoneObjects.setDirty(slice(None))
+            self.DoneSegmentation.setDirty(slice(None))
+            return
+        starts, stops = self._getSupervoxelBoxes()
+        start = starts[supervoxels].min(axis=0)
+        stop = stops[supervoxels].max(axis=0)
+        if (stop <= start).any():
+            return
+        slicing = (slice(None),) + roiToSlice(start, stop) + (slice(None),)
+        self.DoneObjects.setDirty(slicing)
+        self.DoneSegmentation.setDirty(slicing)
     
     def dataIsStorable(self):
         if self._mst is None:
@@ -219,19 +363,21 @@ class OpCarving(Operator):
         self.Trigger.meta.shape = (1,)
         self.Trigger.meta.dtype = numpy.uint8
 
-        if self._mst is not None:
-            objects = self._mst.object_names.keys()
+        if self._loadedMst is not None:
+            objects = self._loadedMst.object_names.keys()
             self.AllObjectNames.meta.shape = (len(objects),)
         else: 
             self.AllObjectNames.meta.shape = (0,)
         
         self.AllObjectNames.meta.dtype = object
+
+        self.MstOut.meta.assignFrom(self.MST.meta)
     
     def connectToPreprocessingApplet(self,applet):
         self.PreprocessingApplet = applet
     
     def updatePreprocessing(self):
-        if self.PreprocessingApplet is None or self._mst is None:
+        if self.PreprocessingApplet is None or self._loadedMst is None:
             return
         #FIXME: why were the following lines needed ?
         # if len(self._mst.object_names)==0:
@@ -269,13 +415,20 @@ class OpCarving(Operator):
 
         #find the supervoxel that was clicked
         sv = self._mst.regionVol[position3d]
-        names = []
-        for name, objectSupervoxels in self._mst.object_lut.iteritems():
-            if numpy.sum(sv == objectSupervoxels) > 0:
-                names.append(name)
+        names = self.getObjectIndex().namesAt(sv)
         print "click on %r, supervoxel=%d: %r" % (position3d, sv, names)
         return names
 
+    def getObjectIndex(self):
+        """
+        Returns the SupervoxelObjectIndex of the saved objects, building it if necessary.
+        """
+        if self._objectIndex is None or self._objectIndex.objectNames() != set(self._mst.object_lut.keys()):
+            with Timer() as timer:
+                self._objectIndex = SupervoxelObjectIndex.fromObjects(self._mst.object_lut)
+            print "building the supervoxel -> object index took {} seconds".format( timer.seconds() )
+        return self._objectIndex
+
     @Operator.forbidParallelExecute
     def attachVoxelLabelsToObject(self, name, fgVoxels, bgVoxels):
         """
@@ -331,11 +484,12 @@ class OpCarving(Operator):
         newSegmentation[ self._mst.object_lut[name] ] = 2
         lut_segmentation[:] = newSegmentation
 
+        previousObjectName = self._currObjectName
         self._setCurrObjectName(name)
         self.HasSegmentation.setValue(True)
 
-        #now that 'name' is no longer part of the set of finished objects, rebuild the done overlay
-        self._buildDone()
+        #now that 'name' is no longer part of the set of finished objects, update the done overlay
+        self._updateDone([(name, None), (previousObjectName, None)])
         return (fgVoxels, bgVoxels)
     
     def loadObject(self, name):
@@ -413,6 +567,9 @@ class OpCarving(Operator):
         # clean seeds
         lut_seeds[:] = 0
 
+        oldSupervoxels = self._mst.object_lut[name]
+        if self._objectIndex is not None:
+            self._objectIndex.remove(name, oldSupervoxels)
         del self._mst.object_lut[name]
         del self._mst.object_seeds_fg_voxels[name]
         del self._mst.object_seeds_bg_voxels[name]
@@ -424,10 +581,11 @@ class OpCarving(Operator):
         if name in self._mst.object_names:
             del self._mst.object_names[name]
 
+        previousObjectName = self._currObjectName
         self._setCurrObjectName("<not saved yet>")
 
-        #now that 'name' has been deleted, rebuild the done overlay
-        self._buildDone()
+        #now that 'name' has been deleted, update the done overlay
+        self._updateDone([(name, oldSupervoxels), (previousObjectName, None)])
         self.updatePreprocessing()
     
     def deleteObject(self, name):
@@ -489,6 +647,13 @@ class OpCarving(Operator):
         lut_objects[:] = numpy.where(lut_segmentation == seed, objNr, lut_objects)
 
         objectSupervoxels = numpy.where(lut_segmentation == seed)
+        oldSupervoxels = None
+        if name in self._mst.object_lut:
+            oldSupervoxels = self._mst.object_lut[name]
+        if self._objectIndex is not None:
+            if oldSupervoxels is not None:
+                self._objectIndex.remove(name, oldSupervoxels)
+            self._objectIndex.add(name, objectSupervoxels)
         self._mst.object_lut[name] = objectSupervoxels
 
         #save object name with objNr
@@ -510,14 +675,15 @@ class OpCarving(Operator):
         self._mst.bg_priority[name] = self.BackgroundPriority.value
         self._mst.no_bias_below[name] = self.NoBiasBelow.value
 
+        previousObjectName = self._currObjectName
         self._setCurrObjectName("<not saved yet>")
         self.HasSegmentation.setValue(False)
 
         objects = self._mst.object_names.keys()
         self.AllObjectNames.meta.shape = (len(objects),)
         
-        #now that 'name' is no longer part of the set of finished objects, rebuild the done overlay
-        self._buildDone()
+        #now that 'name' is part of the set of finished objects, update the done overlay
+        self._updateDone([(name, oldSupervoxels), (previousObjectName, None)])
         
         self.updatePreprocessing()
 
@@ -581,8 +747,10 @@ class OpCarving(Operator):
         return pos
 
     def execute(self, slot, subindex, roi, result):
-        self._mst = self.MST.value
-        
+        if slot == self.MstOut:
+            result[0] = self._mst
+            return result
+
         if slot == self.AllObjectNames:
             ret = self._mst.object_names.keys()
             return ret
@@ -641,18 +809,20 @@ class OpCarving(Operator):
                 self.opLabelArray.LabelSinkInput[roi.toSlice()] = value
                 print "Writing seeds to label array took {} seconds".format( timer.seconds() )
             
-            assert self._mst is not None
-
             # Important: mst.seeds will requires erased values to be 255 (a.k.a -1)
             value[:] = numpy.where(value == 100, 255, value)
+            if hasattr(key, '__len__'):
+                key = key[1:4]
 
-            with Timer() as timer:
-                print "Writing seeds to MST"
-                if hasattr(key, '__len__'):
-                    self._mst.seeds[key[1:4]] = value
-                else:
-                    self._mst.seeds[key] = value
-            print "Writing seeds to MST took {} seconds".format( timer.seconds() )
+            if self._loadedMst is None:
+                # Don't load the MST just for this, the seeds are written to it when it is loaded.
+                assert self.MST.ready()
+                self._pendingSeeds.append( (key, value.copy()) )
+            else:
+                with Timer() as timer:
+                    print "Writing seeds to MST"
+                    self._loadedMst.seeds[key] = value
+                print "Writing seeds to MST took {} seconds".format( timer.seconds() )
 
             self.has_seeds = True
         else:
@@ -663,7 +833,9 @@ class OpCarving(Operator):
            slot == self.BackgroundPriority or \
            slot == self.NoBiasBelow or \
            slot == self.UncertaintyType:
-            if self._mst is None:
+            # Only a new segmentation request is worth loading the MST for
+            mst = self._mst if slot == self.Trigger else self._loadedMst
+            if mst is None:
                 return
             if not self.BackgroundPriority.ready():
                 return
@@ -689,9 +861,9 @@ class OpCarving(Operator):
             self.HasSegmentation.setValue(hasSeg)
             
         elif slot == self.MST:
-            self._opMstCache.Input.disconnect()
-            self._mst = self.MST.value
-            self._opMstCache.Input.setValue( self._mst )
+            # The new MST is fetched when it is used
+            self._setMst( None )
+            self.MstOut.setDirty()
         elif slot == self.RawData or \
              slot == self.InputData or \
              slot == self.FilteredInputData or \
@@ -1,22 +1,50 @@
 #Python
-import sys
+import logging
+from functools import partial
 
 #SciPy
 import numpy
 import vigra
 
 #lazyflow
-from lazyflow.roi import roiFromShape
+from lazyflow.roi import roiFromShape, roiToSlice, getIntersectingBlocks, getBlockBounds, getIntersection
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.operators import OpArrayCache
+from lazyflow.operators import OpCompressedCache
+from lazyflow.request import Request, RequestPool, RequestLock
 
 from lazyflow.utility.timer import Timer
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.thresholdTwoLevels.opBlockwiseLabelVolume import OpBlockwiseLabelVolume
 
 #carving Cython module
 from cylemon.segmentation import MSTSegmentor
 
+logger = logging.getLogger(__name__)
+
+def padRoi(start, stop, shape, halo):
+    """
+    Enlarge the spatial axes (1,2,3) of a 5D (t,x,y,z,c) roi by halo on
+    each side, clipped to the shape of the volume.
+    """
+    start = list(start)
+    stop = list(stop)
+    for i in range(1,4):
+        start[i] = max(0, start[i] - halo)
+        stop[i] = min(shape[i], stop[i] + halo)
+    return start, stop
+
+def cropToRoi(data, paddedStart, start, stop):
+    """
+    Select the part of data (which was read at paddedStart) that lies within start, stop.
+    """
+    return data[ tuple( slice(a - p, b - p) for a, b, p in zip(start, stop, paddedStart) ) ]
+
 class OpFilter(Operator):
+    """
+    Computes the selected filter on any roi, reading the input with a halo
+    that is large enough for the result to be the same as on the whole volume.
+    Large rois are split into tiles of BlockShape, which are filtered in parallel.
+    """
     HESSIAN_BRIGHT = 0
     HESSIAN_DARK = 1
     STEP_EDGES = 2
@@ -26,13 +54,18 @@ class OpFilter(Operator):
     Input = InputSlot()
     Filter = InputSlot(value=HESSIAN_BRIGHT)
     Sigma = InputSlot(value=1.6)
+    BlockShape = InputSlot(optional=True) # the whole roi is one tile if not given
     
     Output = OutputSlot()
 
     def setupOutputs(self):
         self.Output.meta.assignFrom( self.Input.meta )
         self.Output.meta.dtype = numpy.float32
-    
+
+    def _halo(self):
+        # vigra's gaussian kernels have a radius of 3*sigma + order/2 (at most second order here)
+        return int(numpy.ceil(3.0 * self.Sigma.value)) + 2
+
     def execute(self, slot, subindex, roi, result):
         #make sure raw data is 5D: t,{x,y,z},c 
         ax = self.Input.meta.axistags
@@ -42,132 +75,277 @@ class OpFilter(Operator):
         for i in range(1,4):
             assert ax[i].isSpatial()
         assert ax[4].key == "c" and sh[4] == 1
-        
-        volume5d = self.Input.value
+
+        if not self.BlockShape.ready():
+            self._filterTile( roi.start, roi.stop, result )
+            return result
+
+        def filterTile(tileStart):
+            tileStart, tileStop = getIntersection( getBlockBounds( sh, self.BlockShape.value, tileStart ),
+                                                   (roi.start, roi.stop) )
+            resultSlicing = roiToSlice( numpy.subtract(tileStart, roi.start), numpy.subtract(tileStop, roi.start) )
+            self._filterTile( tileStart, tileStop, result[resultSlicing] )
+
+        pool = RequestPool()
+        for tileStart in getIntersectingBlocks( self.BlockShape.value, (roi.start, roi.stop) ):
+            pool.add( Request( partial(filterTile, tileStart) ) )
+        pool.wait()
+        pool.clean()
+        return result
+
+    def _filterTile(self, start, stop, result):
+        sh = self.Input.meta.shape
+        paddedStart, paddedStop = padRoi( start, stop, sh, self._halo() )
+        volume5d = self.Input( paddedStart, paddedStop ).wait()
         sigma = self.Sigma.value
         volume = volume5d[0,:,:,:,0]
-        result_view = result[0,:,:,:,0]
-        
-        print "input volume shape: ", volume.shape
-        print "input volume size: ", volume.nbytes / 1024**2, "MB"
         fvol = numpy.asarray(volume, numpy.float32)
 
         #Choose filter selected by user
         volume_filter = self.Filter.value
 
-        print "applying filter", fvol.shape
+        # Note: HESSIAN_BRIGHT used to be (max - eigenvalue), which needs the whole volume.
+        #       The output is always normalized (see OpNormalize255), so the negated eigenvalue
+        #       gives exactly the same result.
         with Timer() as filterTimer:        
-            if fvol.shape[2] > 1:
+            if sh[3] > 1:
                 # true 3D volume
                 if volume_filter == OpFilter.HESSIAN_BRIGHT:
-                    print "lowest eigenvalue of Hessian of Gaussian"
-                    result_view[...] = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,:,2]
-                    result_view[:] = numpy.max(result_view) - result_view
+                    volume_feat = -vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,:,2]
                 
                 elif volume_filter == OpFilter.HESSIAN_DARK:
-                    print "greatest eigenvalue of Hessian of Gaussian"
-                    result_view[...] = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,:,0]
+                    volume_feat = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,:,0]
                      
                 elif volume_filter == OpFilter.STEP_EDGES:
-                    print "Gaussian Gradient Magnitude"
-                    result_view[...] = vigra.filters.gaussianGradientMagnitude(fvol,sigma)
+                    volume_feat = vigra.filters.gaussianGradientMagnitude(fvol,sigma)
                     
                 elif volume_filter == OpFilter.RAW:
-                    print "Gaussian Smoothing"
-                    result_view[...] = vigra.filters.gaussianSmoothing(fvol,sigma)
+                    volume_feat = vigra.filters.gaussianSmoothing(fvol,sigma)
                     
                 elif volume_filter == OpFilter.RAW_INVERTED:
-                    print "negative Gaussian Smoothing"
-                    result_view[...] = vigra.filters.gaussianSmoothing(-fvol,sigma)
-
-                print "Filter took {} seconds".format( filterTimer.seconds() )
+                    volume_feat = vigra.filters.gaussianSmoothing(-fvol,sigma)
             else:
                 # 2D Image
                 fvol = fvol[:,:,0]
                 if volume_filter == OpFilter.HESSIAN_BRIGHT:
-                    print "lowest eigenvalue of Hessian of Gaussian"
-                    volume_feat = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,1]
-                    volume_feat[:] = numpy.max(volume_feat) - volume_feat
+                    volume_feat = -vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,1]
                 
                 elif volume_filter == OpFilter.HESSIAN_DARK:
-                    print "greatest eigenvalue of Hessian of Gaussian"
                     volume_feat = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,0]
                      
                 elif volume_filter == OpFilter.STEP_EDGES:
-                    print "Gaussian Gradient Magnitude"
                     volume_feat = vigra.filters.gaussianGradientMagnitude(fvol,sigma)
                     
                 elif volume_filter == OpFilter.RAW:
-                    print "Gaussian Smoothing"
                     volume_feat = vigra.filters.gaussianSmoothing(fvol,sigma)
                     
                 elif volume_filter == OpFilter.RAW_INVERTED:
-                    print "negative Gaussian Smoothing"
                     volume_feat = vigra.filters.gaussianSmoothing(-fvol,sigma)
 
-                result_view[:,:,0] = volume_feat
-                print "Filter took {} seconds".format( filterTimer.seconds() )
-        return result
+                volume_feat = volume_feat[:,:,numpy.newaxis]
+
+        result[0,:,:,:,0] = cropToRoi( volume_feat, paddedStart[1:4], start[1:4], stop[1:4] )
+        logger.debug( "Filter {} on roi {} took {} seconds".format( volume_filter, (start, stop), filterTimer.seconds() ) )
 
     def propagateDirty(self, slot, subindex, roi):
-        self.Output.setDirty(slice(None))
+        if slot != self.BlockShape:
+            self.Output.setDirty(slice(None))
 
 class OpNormalize255(Operator):
+    """
+    Scales the input to the range [0, 255].
+
+    The minimum and maximum of the whole input are determined once,
+    by reading all blocks of BlockShape in parallel. If the input is cached
+    in the same blocks, this single pass also fills the cache.
+    """
     Input = InputSlot()
+    BlockShape = InputSlot(optional=True) # whole volume if not given
     Output = OutputSlot()
 
+    def __init__(self, *args, **kwargs):
+        super(OpNormalize255, self).__init__(*args, **kwargs)
+        self._lock = RequestLock()
+        self._range = None
+
     def setupOutputs(self):
         self.Output.meta.assignFrom( self.Input.meta )
-    
+        self.Output.meta.dtype = numpy.float32
+        with self._lock:
+            self._range = None
+
+    def _getRange(self):
+        with self._lock:
+            if self._range is None:
+                shape = self.Input.meta.shape
+                blockShape = shape
+                if self.BlockShape.ready():
+                    blockShape = self.BlockShape.value
+                blockStarts = getIntersectingBlocks( blockShape, roiFromShape(shape) )
+                blockMins = [None] * len(blockStarts)
+                blockMaxs = [None] * len(blockStarts)
+
+                def blockRange(blockIndex):
+                    block = self.Input( *getBlockBounds( shape, blockShape, blockStarts[blockIndex] ) ).wait()
+                    blockMins[blockIndex] = numpy.min(block)
+                    blockMaxs[blockIndex] = numpy.max(block)
+
+                pool = RequestPool()
+                for blockIndex in range(len(blockStarts)):
+                    pool.add( Request( partial(blockRange, blockIndex) ) )
+                pool.wait()
+                pool.clean()
+                volume_min = min(blockMins)
+                volume_max = max(blockMaxs)
+                self._range = (volume_min, volume_max)
+            return self._range
+
     def execute(self, slot, subindex, roi, result):
+        volume_min, volume_max = self._getRange()
+
         # Save memory: use result as a temporary
         self.Input( roi.start, roi.stop ).writeInto(result).wait()
-        volume_max = numpy.max(result)
-        volume_min = numpy.min(result)
 
         # result[...] = (result - volume_min) * 255.0 / (volume_max-volume_min)
         # Avoid temporaries...
         result[:] -= volume_min
-        result[:] *= 255.0
-        result[:] /= (volume_max - volume_min)
+        if volume_max > volume_min:
+            result[:] *= 255.0
+            result[:] /= (volume_max - volume_min)
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        # Any change may change the range of the whole volume
+        if slot == self.Input:
+            with self._lock:
+                self._range = None
+            self.Output.setDirty(slice(None))
+
+def watershedSource(data, is3d):
+    """
+    The watershed of 3D volumes is computed on the (normalized) input quantized to uint8.
+    """
+    if is3d:
+        return numpy.asarray(data, dtype=numpy.uint8)
+    return numpy.asarray(data, dtype=numpy.float32)
+
+class OpLocalMinima(Operator):
+    """
+    Marks the (extended) local minima of the watershed source with 1.
+    Each roi is computed with a halo, so plateaus that are smaller than
+    the halo are treated as on the whole volume.
+    """
+    Input = InputSlot()
+    Halo = InputSlot(value=8)
+    Output = OutputSlot()
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom( self.Input.meta )
+        self.Output.meta.dtype = numpy.uint8
+        self.Output.meta.drange = (0,1)
+
+    def execute(self, slot, subindex, roi, result):
+        shape = self.Input.meta.shape
+        is3d = shape[3] > 1
+        paddedStart, paddedStop = padRoi( roi.start, roi.stop, shape, self.Halo.value )
+        source = watershedSource( self.Input( paddedStart, paddedStop ).wait()[0,...,0], is3d )
+        source = numpy.asarray(source, dtype=numpy.float32)
+        if is3d:
+            minima = vigra.analysis.extendedLocalMinima3D( source, marker=1.0 )
+        else:
+            minima = vigra.analysis.extendedLocalMinima( source[:,:,0], marker=1.0 )[:,:,numpy.newaxis]
+        minima = cropToRoi( minima, paddedStart[1:4], roi.start[1:4], roi.stop[1:4] )
+        result[0,...,0] = (minima != 0)
         return result
 
     def propagateDirty(self, slot, subindex, roi):
-        self.Output.setDirty(roi.start, roi.stop)
+        if slot == self.Input and self.Halo.ready():
+            start, stop = padRoi( roi.start, roi.stop, self.Input.meta.shape, self.Halo.value )
+            self.Output.setDirty( start, stop )
+        else:
+            self.Output.setDirty( slice(None) )
 
 class OpSimpleWatershed(Operator):
+    """
+    Seeded watershed, computed block by block.
+
+    The seeds are the local minima of the input, labeled by connected
+    components across the whole volume (see OpBlockwiseLabelVolume),
+    so a supervoxel that crosses a block face has the same id on both
+    sides. Each block is flooded with a halo of Halo voxels (more if
+    there are no seeds within the halo); voxels whose basin lies further
+    away than that are given to a neighboring supervoxel instead.
+    """
     Input = InputSlot()
+    BlockShape = InputSlot(optional=True) # dict of { spatial axis key : block size }, whole volume if not given
+    Halo = InputSlot(value=8)
     Output = OutputSlot()
 
+    def __init__(self, *args, **kwargs):
+        super(OpSimpleWatershed, self).__init__(*args, **kwargs)
+        self._opMinima = OpLocalMinima( parent=self )
+        self._opMinima.Input.connect( self.Input )
+        self._opMinima.Halo.connect( self.Halo )
+
+        self._opSeedLabeler = OpBlockwiseLabelVolume( parent=self )
+        self._opSeedLabeler.Input.connect( self._opMinima.Output )
+        self._opSeedLabeler.BlockShape.connect( self.BlockShape )
+
+        self._opSeedCache = OpCompressedCache( parent=self )
+        self._opSeedCache.Input.connect( self._opSeedLabeler.Output )
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.Input.meta)
         
         # Use a SIGNED int32 becacuse that's what cylemon.segmentation expects. (Unfortunately.)
         self.Output.meta.dtype = numpy.int32
 
+        blockShape = {}
+        if self.BlockShape.ready():
+            blockShape = self.BlockShape.value
+        self._opSeedCache.BlockShape.setValue( cacheBlockShape( self.Input, blockShape ) )
+
     def execute(self, slot, subindex, roi, result):
-        assert roi.stop - roi.start == self.Output.meta.shape, "Watershed must be run on the entire volume."
-        input_image = self.Input(roi.start, roi.stop).wait()
-        volume_feat = input_image[0,...,0]
-        result_view = result[0,...,0]
+        shape = self.Input.meta.shape
+        is3d = shape[3] > 1
+        halo = self.Halo.value
         with Timer() as watershedTimer:
-            if self.Input.meta.getTaggedShape()['z'] > 1:
-                sys.stdout.write("Watershed..."); sys.stdout.flush()
-                #result_view[...] = vigra.analysis.watersheds(volume_feat[:,:])[0].astype(numpy.int32)
-                result_view[...] = vigra.analysis.watersheds(volume_feat[:,:].astype(numpy.uint8))[0]
-                print "done" ,numpy.max(result[...])
+            while True:
+                paddedStart, paddedStop = padRoi( roi.start, roi.stop, shape, halo )
+                seeds = self._opSeedCache.Output( paddedStart, paddedStop ).wait()[0,...,0]
+                wholeVolume = ( tuple(paddedStart) == (0,)*5 and tuple(paddedStop) == tuple(shape) )
+                if seeds.any() or wholeVolume:
+                    break
+                # There is no basin near this block: look further
+                halo *= 2
+
+            if not seeds.any():
+                # No minimum anywhere: everything is one supervoxel
+                result[:] = 1
+                return result
+
+            source = watershedSource( self.Input( paddedStart, paddedStop ).wait()[0,...,0], is3d )
+            seeds = numpy.asarray(seeds, dtype=numpy.uint32)
+            if is3d:
+                labels = vigra.analysis.watersheds( source, seeds=seeds )[0]
             else:
-                sys.stdout.write("Watershed..."); sys.stdout.flush()
-                
-                labelVolume = vigra.analysis.watersheds(volume_feat[:,:,0])[0].view(dtype=numpy.int32)
-                result_view[...] = labelVolume[:,:,numpy.newaxis]
-                print "done" ,numpy.max(labelVolume)
+                labels = vigra.analysis.watersheds( source[:,:,0], seeds=seeds[:,:,0] )[0][:,:,numpy.newaxis]
+            result[0,...,0] = cropToRoi( labels, paddedStart[1:4], roi.start[1:4], roi.stop[1:4] )
 
-        print "Watershed took {} seconds".format( watershedTimer.seconds() )
+        logger.debug( "Watershed on roi {} took {} seconds".format( (roi.start, roi.stop), watershedTimer.seconds() ) )
         return result
 
     def propagateDirty(self, slot, subindex, roi):
+        # The seeds are numbered over the whole volume
         self.Output.setDirty(slice(None))
+
+def cacheBlockShape(slot, spatialBlockShape):
+    """
+    Block shape for caching the 5D (t,x,y,z,c) data of slot in blocks of
+    (at most) the given spatial shape (a dict of { axis key : size }).
+    """
+    return tuple( min( spatialBlockShape.get(key, size), size )
+                  for key, size in slot.meta.getTaggedShape().items() )
     
 class OpMstSegmentorProvider(Operator):
     Image = InputSlot()
@@ -188,8 +366,12 @@ class OpMstSegmentorProvider(Operator):
         #first thing, show the user that we are waiting for computations to finish        
         self.applet.progressSignal.emit(0)
         
-        volume_feat = self.Image( *roiFromShape( self.Image.meta.shape ) ).wait()
-        labelVolume = self.LabelImage( *roiFromShape( self.LabelImage.meta.shape ) ).wait()
+        # The MSTSegmentor needs both volumes as a whole.
+        # Collect the (cached) blocks directly into arrays of the types it expects, without any temporary copies.
+        volume_feat = numpy.empty( self.Image.meta.shape, dtype=numpy.float32 )
+        self.Image( *roiFromShape( self.Image.meta.shape ) ).writeInto( volume_feat ).wait()
+        labelVolume = numpy.empty( self.LabelImage.meta.shape, dtype=numpy.int32 )
+        self.LabelImage( *roiFromShape( self.LabelImage.meta.shape ) ).writeInto( labelVolume ).wait()
 
         self.applet.progress = 0
         def updateProgressBar(x):
@@ -199,7 +381,7 @@ class OpMstSegmentorProvider(Operator):
                 self.applet.progress = x
         
         mst= MSTSegmentor(labelVolume[0,...,0], 
-                          numpy.asarray(volume_feat[0,...,0], numpy.float32), 
+                          volume_feat[0,...,0], 
                           edgeWeightFunctor = "minimum",
                           progressCallback = updateProgressBar)
         #mst.raw is not set here in order to avoid redundant data storage 
@@ -226,6 +408,9 @@ class OpPreprocessing(Operator):
     Filter = InputSlot(value = 0)
     WatershedSource = InputSlot(value="filtered") # Choices: "raw", "input", "filtered"
     InvertWatershedSource = InputSlot(value=False)
+
+    # All intermediate images are computed and cached in blocks of this shape.
+    SpatialBlockShape = InputSlot(value={ 'x':128, 'y':128, 'z':128 })
     
     #Image after preprocess as cylemon.MST
     PreprocessedData = OutputSlot()
@@ -235,19 +420,23 @@ class OpPreprocessing(Operator):
     WatershedImage = OutputSlot()
     WatershedSourceImage = OutputSlot()
 
-    # RawData -------- opRawFilter* ---------> opRawNormalize ----------                                                                  --> WatershedImage
-    #                                                                   \                                                                /
-    # InputData --> -- opInputFilter*--------> opInputNormalize -------> (SELECT by WatershedSource) --> opWatershed --> opWatershedCache --> opMstProvider --> [via execute()] --> PreprocessedData
-    #              \                                                    /                                                                    /
-    # Sigma ------> opFilter --> opFilterNormalize --> opFilterCache --> --------------------------------------------------------------------
-    #              /                                                \
-    # Filter ------                                                  --> FilteredImage
+    # RawData -------- opRawFilter* ---                                                                                                                   --> WatershedImage
+    #                                 \                                                                                                                 /
+    # InputData --> -- opInputFilter*--> (SELECT by WatershedSource) --> opWatershedSourceCache --> opWatershedSourceNormalize --> opWatershed --> opWatershedCache --> opMstProvider --> [via execute()] --> PreprocessedData
+    #              \                   /                                                        \                                                                /
+    # Sigma ------> opFilter --> opFilterCache --> opFilterNormalize -------------------------------------------------------------------------------------------
+    #              /                                                \                              \
+    # Filter ------                                                  --> FilteredImage                --> WatershedSourceImage
 
     # *note: Raw/Input filters used for inversion and smoothing only.
+    # The filters are cached before they are normalized, so that the (parallel) pass that finds
+    # the range for the normalization computes each block of the filter only once.
     
     def __init__(self, *args, **kwargs):
         super(OpPreprocessing, self).__init__(*args, **kwargs)
         self._prepData = [None]
+        self._prepDataLoader = None # set by the serializer: loads a stored graph when it is first needed
+        self._graphHash = None      # content hash of the stored graph (None if it has not been saved yet)
         self.applet = self.parent.parent.preprocessingApplet
         
         self._unsavedData = False # set to True if data is not yet saved
@@ -262,40 +451,41 @@ class OpPreprocessing(Operator):
         self._opFilter.Sigma.connect( self.Sigma )
         self._opFilter.Filter.connect( self.Filter )
 
+        self._opFilterCache = OpCompressedCache( parent=self )
+        self._opFilterCache.Input.connect( self._opFilter.Output )
+
         self._opFilterNormalize = OpNormalize255( parent=self )
-        self._opFilterNormalize.Input.connect( self._opFilter.Output )
-        
-        self._opFilterCache = OpArrayCache( parent=self )
-        
-        self._opWatershed = OpSimpleWatershed( parent=self )
-        
-        self._opWatershedCache = OpArrayCache( parent=self )
+        self._opFilterNormalize.Input.connect( self._opFilterCache.Output )
         
         self._opRawFilter = OpFilter( parent=self )
         self._opRawFilter.Input.connect( self.RawData )
         self._opRawFilter.Sigma.connect( self.Sigma )
         
-        self._opRawNormalize = OpNormalize255( parent=self )
-        self._opRawNormalize.Input.connect( self._opRawFilter.Output )
-        
         self._opInputFilter = OpFilter( parent=self )
         self._opInputFilter.Input.connect( self.InputData )
         self._opInputFilter.Sigma.connect( self.Sigma )
 
-        self._opInputNormalize = OpNormalize255( parent=self )
-        self._opInputNormalize.Input.connect( self._opInputFilter.Output )
+        self._opWatershedSourceCache = OpCompressedCache( parent=self )
+
+        self._opWatershedSourceNormalize = OpNormalize255( parent=self )
+
+        self._opWatershed = OpSimpleWatershed( parent=self )
+        self._opWatershed.Input.connect( self._opWatershedSourceNormalize.Output )
+        self._opWatershed.BlockShape.connect( self.SpatialBlockShape )
+        
+        self._opWatershedCache = OpCompressedCache( parent=self )
+        self._opWatershedCache.Input.connect( self._opWatershed.Output )
         
         self._opMstProvider = OpMstSegmentorProvider( self.applet, parent=self )
-        self._opMstProvider.Image.connect( self._opFilterCache.Output )
+        self._opMstProvider.Image.connect( self._opFilterNormalize.Output )
         self._opMstProvider.LabelImage.connect( self._opWatershedCache.Output )
 
-        self._opWatershedSourceCache = OpArrayCache( parent=self )
-
         #self.PreprocessedData.connect( self._opMstProvider.MST )
         
         # Display slots
-        self.FilteredImage.connect( self._opFilterCache.Output )
+        self.FilteredImage.connect( self._opFilterNormalize.Output )
         self.WatershedImage.connect( self._opWatershedCache.Output )
+        self.WatershedSourceImage.connect( self._opWatershedSourceNormalize.Output )
         
         self.InputData.notifyReady( self._checkConstraints )
         
@@ -329,8 +519,11 @@ class OpPreprocessing(Operator):
         self.PreprocessedData.meta.shape = (1,)
         self.PreprocessedData.meta.dtype = object
 
-        self._opFilterCache.blockShape.setValue( self.InputData.meta.shape )
-        self._opFilterCache.Input.connect( self._opFilterNormalize.Output )
+        blockShape = cacheBlockShape( self.InputData, self.SpatialBlockShape.value )
+        for op in ( self._opFilter, self._opRawFilter, self._opInputFilter,
+                    self._opFilterCache, self._opWatershedSourceCache, self._opWatershedCache,
+                    self._opFilterNormalize, self._opWatershedSourceNormalize ):
+            op.BlockShape.setValue( blockShape )
 
         # If the user's boundaries are dark, then invert the special watershed sources
         if self.InvertWatershedSource.value:
@@ -343,27 +536,26 @@ class OpPreprocessing(Operator):
         ws_source = self.WatershedSource.value
         if ws_source == 'raw':
             if self.RawData.ready():
-                self._opWatershed.Input.connect( self._opRawNormalize.Output )
+                self._opWatershedSourceCache.Input.connect( self._opRawFilter.Output )
             else:
-                self._opWatershed.Input.connect( self._opInputNormalize.Output )
+                self._opWatershedSourceCache.Input.connect( self._opInputFilter.Output )
+            self._opWatershedSourceNormalize.Input.connect( self._opWatershedSourceCache.Output )
         elif ws_source == 'input':
-            self._opWatershed.Input.connect( self._opInputNormalize.Output )
+            self._opWatershedSourceCache.Input.connect( self._opInputFilter.Output )
+            self._opWatershedSourceNormalize.Input.connect( self._opWatershedSourceCache.Output )
         elif ws_source == 'filtered':
-            self._opWatershed.Input.connect( self._opFilterCache.Output )
+            # The filter is cached already
+            self._opWatershedSourceNormalize.Input.connect( self._opFilterCache.Output )
         else:
             assert False, "Unknown Watershed source option: {}".format( ws_source )
 
-        self._opWatershedSourceCache.blockShape.setValue( self.InputData.meta.shape )
-        self._opWatershedSourceCache.Input.connect( self._opWatershed.Input )
-
-        self.WatershedSourceImage.connect( self._opWatershedSourceCache.Output )
-
-        self._opWatershedCache.blockShape.setValue( self._opWatershed.Output.meta.shape )
-        self._opWatershedCache.Input.connect( self._opWatershed.Output )
-
 
     def execute(self,slot,subindex,roi,result):
         assert slot == self.PreprocessedData, "Invalid output slot"
+        if self._prepDataLoader is not None:
+            self._prepData = numpy.array([self._prepDataLoader()])
+            self._prepDataLoader = None
+
         if self._prepData[0] is not None and not self._dirty:
             return self._prepData
         
@@ -390,6 +582,7 @@ class OpPreprocessing(Operator):
         
         #Cache result
         self._prepData = result
+        self._graphHash = None
         
         #Wonder why this is set?
         #The preprocess is only called by the run button.
@@ -420,12 +613,14 @@ class OpPreprocessing(Operator):
             self.initialSigma = None
             self.initialFilter = None
             self._prepData = [None]
+            self._prepDataLoader = None
+            self._graphHash = None
         
         ws_source_changed = False
         if slot == self.WatershedSource or \
           (slot == self.Filter and self.WatershedSource.value == 'filtered') or \
            slot == self.InvertWatershedSource:
-            self._opWatershed.Input.setDirty(slice(None))
+            self._opWatershedSourceNormalize.Input.setDirty(slice(None))
             ws_source_changed = True
         
         if not ws_source_changed and self.AreSettingsInitial():
@@ -438,7 +633,7 @@ class OpPreprocessing(Operator):
             self._dirty = True
             self.enableDownstream(False)
             # is there a stored preprocessed graph?
-            if self._prepData[0] is not None:
+            if self._prepData[0] is not None or self._prepDataLoader is not None:
                 self.enableReset(True)
     
     def enableReset(self,er):
@@ -1,22 +1,103 @@
 from ilastik.applets.base.appletSerializer import AppletSerializer, getOrCreateGroup, deleteIfPresent
 from cylemon.segmentation import MSTSegmentor
+import hashlib
 import h5py
 import numpy
 import os
 
+def hashGroup(group, chunkBytes=64*2**20):
+    """
+    Content hash (sha1 hex digest) of all datasets and attributes in an hdf5 group.
+    Large datasets are read in pieces of about chunkBytes.
+    """
+    digest = hashlib.sha1()
+    def update(name, obj):
+        digest.update(name)
+        for key in sorted(obj.attrs.keys()):
+            digest.update(key)
+            digest.update(numpy.asarray(obj.attrs[key]).tostring())
+        if isinstance(obj, h5py.Dataset):
+            digest.update(str(obj.dtype))
+            digest.update(str(obj.shape))
+            if len(obj.shape) == 0:
+                digest.update(numpy.asarray(obj[()]).tostring())
+                return
+            rowBytes = obj.dtype.itemsize * int(numpy.prod(obj.shape[1:]))
+            step = max(1, chunkBytes // max(1, rowBytes))
+            for start in range(0, obj.shape[0], step):
+                digest.update(numpy.ascontiguousarray(obj[start:start+step]).tostring())
+    update("", group)
+    # visititems() returns a non-None value to stop, update() always returns None
+    group.visititems(update)
+    return digest.hexdigest()
+
+class StoredGraph(object):
+    """
+    A graph in an hdf5 group, which is loaded when it is first needed.
+    Lanes with the same graph share the StoredGraph, but each call loads a new MSTSegmentor:
+    the carving operators keep per-lane state (seeds, objects) in it.
+    """
+    def __init__(self, group, graphHash=None):
+        self.group = group
+        self.graphHash = graphHash
+
+    def __call__(self):
+        return MSTSegmentor.loadH5G(self.group)
+
 class PreprocessingSerializer( AppletSerializer ):
+    """
+    The graphs are stored in the group 'graphs', named by the hash of their content,
+    and 'lane_graphs' lists the graph of each lane.
+    For older versions of ilastik, 'graph' is a link to the graph of the first lane.
+    """
     def __init__(self, preprocessingTopLevelOperator, *args, **kwargs):
         super(PreprocessingSerializer, self).__init__(*args, **kwargs)
         self._o = preprocessingTopLevelOperator 
         self.caresOfHeadless = True
         
+    def _storeGraph(self, opPre, graphsGroup, storedHashes):
+        """
+        Write the graph of opPre into graphsGroup (unless it is there already),
+        and return its hash. storedHashes maps the graphs that have been stored
+        during this save (by id) to their hashes.
+        """
+        loader = opPre._prepDataLoader
+        graph = loader if loader is not None else opPre._prepData[0]
+        if id(graph) in storedHashes:
+            opPre._graphHash = storedHashes[id(graph)]
+            return opPre._graphHash
+
+        if opPre._graphHash is None or opPre._graphHash not in graphsGroup:
+            tmpName = "incomplete"
+            deleteIfPresent(graphsGroup, tmpName)
+            if loader is not None:
+                # Copy the stored graph without loading it
+                graphsGroup.copy(loader.group, tmpName)
+            else:
+                graph.saveH5G(getOrCreateGroup(graphsGroup, tmpName))
+
+            graphHash = hashGroup(graphsGroup[tmpName])
+            if graphHash in graphsGroup:
+                # An identical graph has been saved before
+                del graphsGroup[tmpName]
+            else:
+                graphsGroup.move(tmpName, graphHash)
+            opPre._graphHash = graphHash
+
+        if loader is not None:
+            loader.group = graphsGroup[opPre._graphHash]
+            loader.graphHash = opPre._graphHash
+        storedHashes[id(graph)] = opPre._graphHash
+        return opPre._graphHash
+
     def _serializeToHdf5(self, topGroup, hdf5File, projectFilePath):
         preproc = topGroup
+        graphsGroup = getOrCreateGroup(preproc, "graphs")
         
+        laneHashes = []
+        storedHashes = {}
         for opPre in self._o.innerOperators:
-            mst = opPre._prepData[0]
-            
-            if mst is not None:
+            if opPre._prepData[0] is not None or opPre._prepDataLoader is not None:
                 
                 #The values to be saved for sigma and filter are the
                 #values of the last valid preprocess
@@ -26,7 +107,6 @@ class PreprocessingSerializer( AppletSerializer ):
                 deleteIfPresent(preproc, "filter")
                 deleteIfPresent(preproc, "watershed_source")
                 deleteIfPresent(preproc, "invert_watershed_source")
-                deleteIfPresent(preproc, "graph")
                 
                 preproc.create_dataset("sigma",data= opPre.initialSigma)
                 preproc.create_dataset("filter",data= opPre.initialFilter)
@@ -35,10 +115,22 @@ class PreprocessingSerializer( AppletSerializer ):
                 preproc.create_dataset("watershed_source", data=ws_source)                 
                 preproc.create_dataset("invert_watershed_source", data=opPre.InvertWatershedSource.value)
                 
-                preprocgraph = getOrCreateGroup(preproc, "graph")
-                mst.saveH5G(preprocgraph)
+                laneHashes.append( self._storeGraph(opPre, graphsGroup, storedHashes) )
+            else:
+                laneHashes.append( "" )
             
             opPre._unsavedData = False
+
+        if any(laneHashes):
+            deleteIfPresent(preproc, "lane_graphs")
+            preproc.create_dataset("lane_graphs", data=laneHashes)
+            deleteIfPresent(preproc, "graph")
+            preproc["graph"] = h5py.SoftLink( graphsGroup[filter(None, laneHashes)[0]].name )
+
+            # Remove the graphs that are not used anymore
+            for name in graphsGroup.keys():
+                if name not in laneHashes:
+                    del graphsGroup[name]
             
     def _deserializeFromHdf5(self, topGroup, groupVersion, hdf5File, projectFilePath,headless = False):
         
@@ -54,7 +146,10 @@ class PreprocessingSerializer( AppletSerializer ):
             watershed_source = None
             invert_watershed_source = False
         
-        if "graph" in topGroup.keys():
+        laneHashes = None
+        if "lane_graphs" in topGroup.keys():
+            laneHashes = list(topGroup["lane_graphs"].value)
+        elif "graph" in topGroup.keys():
             graphgroup = topGroup["graph"]
         else:
             assert "graphfile" in topGroup.keys()
@@ -66,7 +161,20 @@ class PreprocessingSerializer( AppletSerializer ):
                 filePath = self.repairFile(filePath,"*.h5")
             graphgroup = h5py.File(filePath,"r")["graph"]
             
-        for opPre in self._o.innerOperators:
+        # The graphs are only loaded when they are needed
+        storedGraphs = {}
+        for laneIndex, opPre in enumerate(self._o.innerOperators):
+            if laneHashes is None:
+                # Older projects have one graph for all lanes
+                graphHash = None
+                storedGraph = storedGraphs.setdefault( None, StoredGraph(graphgroup) )
+            else:
+                graphHash = laneHashes[laneIndex] if laneIndex < len(laneHashes) else ""
+                if not graphHash:
+                    continue
+                if graphHash not in storedGraphs:
+                    storedGraphs[graphHash] = StoredGraph( topGroup["graphs"][graphHash], graphHash )
+                storedGraph = storedGraphs[graphHash]
             
             opPre.initialSigma = sigma
             opPre.Sigma.setValue(sigma)
@@ -76,8 +184,9 @@ class PreprocessingSerializer( AppletSerializer ):
             opPre.initialFilter = sfilter
             opPre.Filter.setValue(sfilter)
             
-            mst = MSTSegmentor.loadH5G(graphgroup)
-            opPre._prepData = numpy.array([mst])
+            opPre._prepData = numpy.array([None])
+            opPre._prepDataLoader = storedGraph
+            opPre._graphHash = graphHash
         
             
             opPre._dirty = False
@@ -0,0 +1,61 @@
+import collections
+import numpy
+
+class SupervoxelObjectIndex(object):
+    """
+    Inverted index from supervoxel id to the names of the carving objects
+    that contain this supervoxel.
+    """
+    def __init__(self):
+        self._names = collections.defaultdict(set)
+        self._objectNames = set()
+
+    @classmethod
+    def fromObjects(cls, object_lut):
+        """Build the index from a dict of { name : supervoxels }."""
+        index = cls()
+        for name, supervoxels in object_lut.iteritems():
+            index.add(name, supervoxels)
+        return index
+
+    def objectNames(self):
+        """The names of all indexed objects."""
+        return set(self._objectNames)
+
+    def add(self, name, supervoxels):
+        self._objectNames.add(name)
+        for sv in numpy.unique(numpy.asarray(supervoxels).ravel()):
+            self._names[int(sv)].add(name)
+
+    def remove(self, name, supervoxels):
+        self._objectNames.discard(name)
+        for sv in numpy.unique(numpy.asarray(supervoxels).ravel()):
+            names = self._names.get(int(sv))
+            if names is None:
+                continue
+            names.discard(name)
+            if not names:
+                del self._names[int(sv)]
+
+    def namesAt(self, sv):
+        """Sorted list of the names of all objects containing supervoxel sv."""
+        return sorted(self._names.get(int(sv), ()))
+
+    def toArrays(self):
+        """
+        Returns (supervoxels, names, objectNames): two parallel arrays with one entry
+        per (supervoxel, object) pair, and the names of all indexed objects.
+        """
+        pairs = [(sv, name) for sv, names in self._names.iteritems() for name in names]
+        pairs.sort()
+        supervoxels = numpy.array([sv for sv, _ in pairs], dtype=numpy.uint32)
+        names = numpy.array([name for _, name in pairs], dtype=object)
+        return supervoxels, names, numpy.array(sorted(self._objectNames), dtype=object)
+
+    @classmethod
+    def fromArrays(cls, supervoxels, names, objectNames):
+        index = cls()
+        index._objectNames = set(objectNames)
+        for sv, name in zip(supervoxels, names):
+            index._names[int(sv)].add(name)
+        return index
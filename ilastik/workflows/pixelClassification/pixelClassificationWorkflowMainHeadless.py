@@ -11,11 +11,15 @@ import glob
 import pickle
 import functools
 import tempfile
+import time
+import multiprocessing
+import copy
 
 # Third-party
 import h5py
 
 # HCI
+import lazyflow.request
 from lazyflow.graph import Graph
 from lazyflow.operators.ioOperators import OpStackToH5Writer
 
@@ -59,6 +63,7 @@ def getArgParser():
     parser.add_argument('--batch_output_dataset_name', default='/volume/prediction', help='HDF5 internal dataset path')
     parser.add_argument('--assume_old_ilp_axes', action='store_true', help='When importing 0.5 project files, assume axes are in the wrong order and need to be transposed.')
     parser.add_argument('--stack_volume_cache_dir', help='The preprocessing step converts image stacks to hdf5 volumes.  The volumes will be saved to this directory.', required=False)
+    parser.add_argument('--batch_workers', type=int, default=1, help='Number of processes to distribute the batch inputs across.  Each process opens the project read-only.')
     parser.add_argument('batch_inputs', nargs='*', help='List of input files to process. Supported filenames: .h5, .npy, or globstring for stacks (e.g. *.png)')
     return parser
 
@@ -88,20 +93,26 @@ def runWorkflow(parsed_args):
         if error:
             raise RuntimeError("Could not find one or more batch inputs.  See logged errors.")
 
-    # Instantiate 'shell'
-    shell = HeadlessShell( functools.partial(PixelClassificationWorkflow, appendBatchOperators=True) )
-    
-    if args.assume_old_ilp_axes:
-        # Special hack for Janelia: 
-        # In some old versions of 0.5, the data was stored in tyxzc order.
-        # We have no way of inspecting the data to determine this, so we allow 
-        #  users to specify that their ilp is very old using the 
-        #  assume_old_ilp_axes command-line flag
-        ilastik.utility.globals.ImportOptions.default_axis_order = 'tyxzc'
+    if args.batch_workers > 1 and len(args.batch_inputs) > 0:
+        # The workers only read the project, so it is opened here first:
+        # Old projects are imported (once) and any project predictions are saved.
+        shell = openProject(args)
+        try:
+            if args.generate_project_predictions:
+                generateProjectPredictions(shell)
+            projectPath = shell.projectManager.currentProjectPath
+        finally:
+            logger.info("Closing project...")
+            shell.closeCurrentProject()
 
-    # Load project (auto-import it if necessary)
-    logger.info("Opening project: '" + args.project + "'")
-    shell.openProjectFile(args.project)
+        workerArgs = copy.copy(args)
+        workerArgs.project = projectPath
+        timings = generateBatchPredictionsMultiprocess(workerArgs)
+        logTimingSummary(timings)
+        logger.info("FINISHED.")
+        return
+
+    shell = openProject(args)
 
     try:
         if not args.generate_project_predictions and len(args.batch_inputs) == 0:
@@ -126,6 +137,92 @@ def runWorkflow(parsed_args):
         shell.closeCurrentProject()
 
     logger.info("FINISHED.")
+
+def openProject(args, readOnly=False):
+    """
+    Instantiate a headless shell and load the project (auto-import it if necessary).
+    """
+    shell = HeadlessShell( functools.partial(PixelClassificationWorkflow, appendBatchOperators=True) )
+    
+    if args.assume_old_ilp_axes:
+        # Special hack for Janelia: 
+        # In some old versions of 0.5, the data was stored in tyxzc order.
+        # We have no way of inspecting the data to determine this, so we allow 
+        #  users to specify that their ilp is very old using the 
+        #  assume_old_ilp_axes command-line flag
+        ilastik.utility.globals.ImportOptions.default_axis_order = 'tyxzc'
+
+    logger.info("Opening project: '" + args.project + "'")
+    shell.openProjectFile(args.project, readOnly)
+    return shell
+
+def generateBatchPredictionsMultiprocess(args):
+    """
+    Distribute the batch inputs across args.batch_workers processes.
+    Each process loads the project once and exports the predictions for its share of the inputs.
+    Returns a list of (input path, seconds) for all inputs.
+    """
+    nworkers = min(args.batch_workers, len(args.batch_inputs))
+    # Round-robin shards, so files of similar size that are listed together end up on different workers.
+    shards = [ args.batch_inputs[i::nworkers] for i in range(nworkers) ]
+    logger.info("Distributing {} batch inputs across {} worker processes".format( len(args.batch_inputs), nworkers ))
+
+    pool = multiprocessing.Pool(nworkers, initializer=_initBatchWorker)
+    try:
+        shard_timings = pool.map( functools.partial(_batchWorker, args), shards )
+    finally:
+        pool.close()
+        pool.join()
+
+    timings = []
+    for t in shard_timings:
+        timings += t
+    return timings
+
+def _initBatchWorker():
+    """
+    Runs once in each new worker process.
+    The forked process inherits the request thread pool object, but not its threads.
+    """
+    lazyflow.request.Request.reset_thread_pool()
+
+def _batchWorker(args, batchInputPaths):
+    """
+    Runs in a worker process: open the project read-only and export the predictions for each input.
+    The classifier is loaded (frozen) from the project once and re-used for all inputs.
+    """
+    shell = openProject(args, readOnly=True)
+    try:
+        opPixelClassification = shell.workflow.pcApplet.topLevelOperator
+        opPixelClassification.FreezePredictions.setValue(True)
+
+        timings = []
+        for path in batchInputPaths:
+            start = time.time()
+            result = generateBatchPredictions(shell.workflow,
+                                              [path],
+                                              args.batch_export_dir,
+                                              args.batch_output_suffix,
+                                              args.batch_output_dataset_name,
+                                              args.stack_volume_cache_dir)
+            assert result
+            timings.append( (path, time.time() - start) )
+            logger.info("Exported predictions for {} in {:.1f} seconds".format( path, timings[-1][1] ))
+        return timings
+    finally:
+        shell.closeCurrentProject()
+
+def logTimingSummary(timings):
+    """
+    Log the time spent on each batch input, slowest first.
+    """
+    if len(timings) == 0:
+        return
+    logger.info("Batch prediction timing summary:")
+    for path, seconds in sorted( timings, key=lambda (path, seconds): -seconds ):
+        logger.info("  {:>10.1f}s  {}".format( seconds, path ))
+    total = sum( seconds for path, seconds in timings )
+    logger.info("  {:>10.1f}s  total ({} files, {:.1f}s mean)".format( total, len(timings), total / len(timings) ))
         
 def generateProjectPredictions(shell):
     """
@@ -256,7 +256,7 @@ class TestSerialDictSlot(unittest.TestCase):
 
 class TestSerialBlockSlot(unittest.TestCase):
     
-    def _init_objects(self):
+    def _init_objects(self, **kwargs):
         raw_data = numpy.zeros((100,100,100), dtype=numpy.uint32)
         raw_data = vigra.taggedView(raw_data, 'zyx')
     
@@ -269,7 +269,7 @@ class TestSerialBlockSlot(unittest.TestCase):
         opLabelArrays.blockShape.setValue( (10,10,10) )
         
         # This will serialize/deserialize data to the h5 file.
-        slotSerializer = SerialBlockSlot( opLabelArrays.Output, opLabelArrays.Input, opLabelArrays.nonzeroBlocks )
+        slotSerializer = SerialBlockSlot( opLabelArrays.Output, opLabelArrays.Input, opLabelArrays.nonzeroBlocks, **kwargs )
         return opLabelArrays, slotSerializer
 
     def testBasic(self):
@@ -298,5 +298,28 @@ class TestSerialBlockSlot(unittest.TestCase):
         assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20].wait() == 1 ).all()
         assert ( opLabelArrays.Output[0][11:12, 10:20, 10:20].wait() == 2 ).all()
 
+    def testCompressedManyBlocks(self):
+        h5_filepath = os.path.join( tempfile.mkdtemp(), 'serial_blockslot_compressed_test.h5' )
+
+        # More blocks than are fetched in parallel, so the request window has to advance.
+        opLabelArrays, slotSerializer = self._init_objects(compression='gzip', shrink_to_bb=True)
+        expected = numpy.zeros((100,100,100), dtype=numpy.uint8)
+        for i in range(SerialBlockSlot.ParallelBlocks * 2 + 1):
+            z, x = 10*(i % 10), 10*(i // 10)
+            expected[z:z+3, 20:25, x+2:x+4] = i+1
+        opLabelArrays.Input[0][:] = expected
+
+        with h5py.File(h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+            for dataset in label_group.values()[0].values()[0].values():
+                assert dataset.compression == 'gzip'
+    
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(h5_filepath, 'r') as f:
+            slotSerializer.deserialize( f['label_data'] )
+
+        assert ( opLabelArrays.Output[0][:].wait() == expected ).all()
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,78 @@
+import numpy
+
+from ilastik.applets.blockwiseObjectClassification.objectStitching import \
+    UnionFind, BlockObjects, stitchBlocks, labelBlock
+from ilastik.applets.objectExtraction.regionStatistics import RegionStatistics
+
+def labelBlocks(raw, binary, block_shape):
+    blocks = []
+    for x in range(0, binary.shape[0], block_shape[0]):
+        for y in range(0, binary.shape[1], block_shape[1]):
+            for z in range(0, binary.shape[2], block_shape[2]):
+                start = (x, y, z)
+                stop = tuple(numpy.minimum(numpy.add(start, block_shape), binary.shape))
+                slicing = tuple(slice(a, b) for a, b in zip(start, stop))
+                blocks.append( BlockObjects(start, stop, raw[slicing], labelBlock(binary[slicing])) )
+    return blocks
+
+class TestUnionFind(object):
+    def test(self):
+        union_find = UnionFind(6)
+        union_find.union(4, 2)
+        union_find.union(5, 4)
+        union_find.union(1, 3)
+        assert list(union_find.consecutiveLabels()) == [0, 1, 2, 1, 2, 2]
+
+class TestStitchBlocks(object):
+    def setUp(self):
+        binary = numpy.zeros((30, 30, 10), dtype=numpy.uint8)
+        binary[2:25, 3:6, 2:5] = 1 # crosses two blocks along x
+        binary[12:18, 12:28, 1:9] = 1 # crosses four blocks
+        binary[22:24, 22:24, 5:7] = 1 # inside one block
+        # a U-shape: two separate pieces within one block, connected through the next block
+        binary[1:13, 20:21, 0:2] = 1
+        binary[1:13, 24:25, 0:2] = 1
+        binary[12:14, 20:25, 0:2] = 1
+        self.binary = binary
+        self.raw = numpy.random.RandomState(0).rand(30, 30, 10, 1)
+
+    def test_against_whole_volume(self):
+        labels = labelBlock(self.binary)
+        expected = RegionStatistics.fromBlock(self.raw, labels, (0, 0, 0)).features()
+
+        blocks = labelBlocks(self.raw, self.binary, (12, 12, 10))
+        objects = stitchBlocks(blocks, 1, 3)
+        assert objects.nobjects == labels.max()
+        actual = objects.stats.features()
+
+        # Match the objects by their bounding boxes
+        order_expected = numpy.lexsort(expected['Coord<Minimum>'].T)
+        order_actual = numpy.lexsort(actual['Coord<Minimum>'].T)
+        for key in expected:
+            assert numpy.allclose(expected[key][order_expected], actual[key][order_actual]), key
+
+    def test_block_luts(self):
+        blocks = labelBlocks(self.raw, self.binary, (12, 12, 10))
+        objects = stitchBlocks(blocks, 1, 3)
+
+        # Relabel every block with the stitched ids and compare with the whole volume
+        stitched = numpy.zeros(self.binary.shape, dtype=numpy.int64)
+        for block in blocks:
+            slicing = tuple(slice(a, b) for a, b in zip(block.start, block.stop))
+            stitched[slicing] = objects.block_luts[block.start][labelBlock(self.binary[slicing])]
+        labels = labelBlock(self.binary)
+        pairs = set(zip(labels.flat, stitched.flat))
+        assert len(pairs) == labels.max() + 1, "Stitched objects do not match the whole-volume objects"
+
+
+if __name__ == '__main__':
+    import sys
+    import nose
+
+    # Don't steal stdout. Show it on the console as usual.
+    sys.argv.append("--nocapture")
+
+    # Don't set the logging level to DEBUG. Leave it alone.
+    sys.argv.append("--nologcapture")
+
+    nose.run(defaultTest=__file__)
@@ -73,6 +73,22 @@ class TestOpBlockwiseObjectClassification(object):
                 "Blockwise prediction operator did not produce the same prediction image" \
                 "as the non-blockwise prediction operator!"
 
+    def testBoundedPipelines(self):
+        # Same as testTinyBlocks, but only a few block pipelines may exist at the same time.
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+        self.op.MaxConcurrentBlocks.setValue( 2 )
+        self.op.MaxBlockPipelines.setValue( 3 )
+
+        pred = self.op.PredictionImage[:].wait()
+        assert len(self.op._blockPipelines) <= 3, \
+            "Expected at most 3 block pipelines, but found {}".format( len(self.op._blockPipelines) )
+        if not (pred == self.prediction_volume).all():
+            self.logImage(pred, "bounded_pipelines_failed_prediction_")
+            assert False, \
+                "Blockwise prediction operator did not produce the same prediction image" \
+                "as the non-blockwise prediction operator!"
+
     def testZeroHalo(self):
         # If we shrink the halo down to zero, then we get different predictions...
         # This block shape/halo combination will slice through some of the big blocks, causing mis-classification.
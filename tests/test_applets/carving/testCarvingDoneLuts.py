@@ -0,0 +1,106 @@
+import sys
+import numpy
+import vigra
+from lazyflow.graph import Graph
+from cylemon.segmentation import MSTSegmentor
+from ilastik.workflows.carving.opCarving import OpCarving
+
+def supervoxelVolume():
+    """
+    A 20x20x5 volume of 16 supervoxels (5x5x5 cubes), numbered 1..16 along y first.
+    """
+    x, y, z = numpy.mgrid[0:20, 0:20, 0:5]
+    return (1 + (x // 5) * 4 + (y // 5)).astype(numpy.int32)
+
+def supervoxelBox(sv):
+    """Bounding box (start, stop) of supervoxel sv in supervoxelVolume()"""
+    start = numpy.array( [ ((sv-1) // 4) * 5, ((sv-1) % 4) * 5, 0 ] )
+    return start, start + (5, 5, 5)
+
+class TestCarvingDoneLuts(object):
+    """
+    Saving, changing and deleting objects updates the done luts incrementally.
+    The result must match a full rebuild, and only the changed region may be marked dirty.
+    """
+    def setUp(self):
+        numpy.random.seed(0)
+        labels = supervoxelVolume()
+        features = numpy.random.random(labels.shape).astype(numpy.float32)
+        mst = MSTSegmentor( labels, features, edgeWeightFunctor="minimum" )
+
+        data = vigra.taggedView( features[numpy.newaxis, ..., numpy.newaxis], 'txyzc' )
+        self.op = OpCarving( graph=Graph() )
+        self.op.InputData.setValue( data )
+        self.op.FilteredInputData.setValue( data )
+        # As in the carving workflow: WriteSeeds metadata must mirror the input data
+        self.op.WriteSeeds.connect( self.op.InputData )
+        self.op.UncertaintyType.setValue( "none" )
+        self.op.MST.setValue( mst )
+        self.op._mst = mst
+        self.op._buildDone()
+
+        self.dirtyRois = []
+        def handleDirty(slot, roi):
+            self.dirtyRois.append( ( tuple(roi.start[1:4]), tuple(roi.stop[1:4]) ) )
+        self.op.DoneObjects.notifyDirty( handleDirty )
+
+    def _saveObject(self, name, supervoxels):
+        # Pretend the carving result consists of the given supervoxels
+        lut_segmentation = self.op._mst.segmentation.lut[:]
+        lut_segmentation[:] = 1
+        lut_segmentation[supervoxels] = 2
+        self.op.saveCurrentObjectAs( name )
+
+    def _checkDirty(self, supervoxels):
+        starts, stops = zip( *map( supervoxelBox, supervoxels ) )
+        expected = ( tuple( numpy.min(starts, axis=0) ), tuple( numpy.max(stops, axis=0) ) )
+        assert self.dirtyRois == [expected], "Dirty rois {}, expected {}".format( self.dirtyRois, expected )
+        self.dirtyRois = []
+
+    def _checkLuts(self):
+        done_lut = self.op._done_lut.copy()
+        done_seg_lut = self.op._done_seg_lut.copy()
+        self.op._buildDone()
+        assert (done_lut == self.op._done_lut).all()
+
+        # Where objects overlap, any one of their numbers is a valid label
+        single = done_lut <= 1
+        assert (done_seg_lut[single] == self.op._done_seg_lut[single]).all()
+        objectIndex = self.op.getObjectIndex()
+        for sv in numpy.where(~single)[0]:
+            numbers = [ self.op._mst.object_names[name] for name in objectIndex.namesAt(sv) ]
+            assert done_seg_lut[sv] in numbers
+
+    def testUpdates(self):
+        self._saveObject( 'a', [1, 2] )
+        self._checkDirty( [1, 2] )
+        self._checkLuts()
+
+        self._saveObject( 'b', [2, 3] )
+        self._checkDirty( [2, 3] )
+        self._checkLuts()
+
+        self._saveObject( 'c', [16] )
+        self._checkDirty( [16] )
+        self._checkLuts()
+
+        # Change 'a': it leaves the done luts while it is edited, and comes back with new supervoxels
+        self.op.loadObject_impl( 'a' )
+        self._checkDirty( [1, 2] )
+        self._checkLuts()
+        self._saveObject( 'a', [5, 6] )
+        self._checkDirty( [5, 6] )
+        self._checkLuts()
+
+        self.op.deleteObject_impl( 'b' )
+        self._checkDirty( [2, 3] )
+        self._checkLuts()
+
+        assert (self.op._done_lut[[5, 6, 16]] == 1).all()
+        assert self.op._done_lut.sum() == 3
+
+if __name__ == "__main__":
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
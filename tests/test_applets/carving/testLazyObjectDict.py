@@ -0,0 +1,53 @@
+from ilastik.workflows.carving.lazyObjectDict import LazyObjectDict
+
+class TestLazyObjectDict(object):
+    def setUp(self):
+        self.loads = []
+        self.d = LazyObjectDict(maxResident=2)
+        for name in ['a', 'b', 'c']:
+            self.d.setLazy(name, self._loader(name))
+
+    def _loader(self, name):
+        def load():
+            self.loads.append(name)
+            return name.upper()
+        return load
+
+    def testLoadOnAccess(self):
+        assert 'a' in self.d
+        assert self.loads == []
+        assert self.d['a'] == 'A'
+        assert self.d['a'] == 'A'
+        assert self.loads == ['a']
+
+    def testLeastRecentlyUsedIsDropped(self):
+        self.d['a']
+        self.d['b']
+        self.d['a'] # 'b' is now the least recently used
+        self.d['c']
+        assert self.d.isLoaded('a')
+        assert not self.d.isLoaded('b')
+        assert self.d['b'] == 'B'
+        assert self.loads == ['a', 'b', 'c', 'b']
+
+    def testAssignedValuesAreKept(self):
+        self.d['new'] = 'NEW'
+        for name in ['a', 'b', 'c']:
+            self.d[name]
+        assert self.d.isLoaded('new')
+        assert sorted(self.d.items()) == [('a', 'A'), ('b', 'B'), ('c', 'C'), ('new', 'NEW')]
+        del self.d['a']
+        assert 'a' not in self.d
+
+
+if __name__ == '__main__':
+    import sys
+    import nose
+
+    # Don't steal stdout. Show it on the console as usual.
+    sys.argv.append("--nocapture")
+
+    # Don't set the logging level to DEBUG. Leave it alone.
+    sys.argv.append("--nologcapture")
+
+    nose.run(defaultTest=__file__)
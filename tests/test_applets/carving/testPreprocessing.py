@@ -0,0 +1,76 @@
+import numpy
+import vigra
+from lazyflow.graph import Graph
+from lazyflow.operators import OpCompressedCache
+from ilastik.workflows.carving.opPreprocessing import OpFilter, OpNormalize255, OpSimpleWatershed
+
+def testImage():
+    numpy.random.seed(0)
+    data = vigra.filters.gaussianSmoothing( numpy.random.random((60, 50, 40)).astype(numpy.float32), 2.0 )
+    data = data[numpy.newaxis, ..., numpy.newaxis]
+    return vigra.taggedView( data, 'txyzc' )
+
+class TestBlockwisePreprocessing(object):
+    def setUp(self):
+        self.graph = Graph()
+        self.data = testImage()
+
+        self.opFilter = OpFilter( graph=self.graph )
+        self.opFilter.Input.setValue( self.data )
+        self.opFilter.Sigma.setValue( 1.6 )
+
+        self.opNormalize = OpNormalize255( graph=self.graph )
+        self.opNormalize.Input.connect( self.opFilter.Output )
+        self.opNormalize.BlockShape.setValue( (1, 20, 20, 20, 1) )
+
+    def testFilter(self):
+        for volume_filter in [ OpFilter.HESSIAN_BRIGHT, OpFilter.STEP_EDGES, OpFilter.RAW ]:
+            self.opFilter.Filter.setValue( volume_filter )
+            whole = self.opNormalize.Output[:].wait()
+            assert whole.min() == 0 and abs(whole.max() - 255) < 1e-3
+
+            # Each block gives the same result as the whole volume
+            block = self.opNormalize.Output[:, 20:40, 10:30, 30:40, :].wait()
+            assert numpy.allclose( block, whole[:, 20:40, 10:30, 30:40, :], atol=1e-3 )
+
+    def testParallelTiles(self):
+        self.opFilter.Filter.setValue( OpFilter.HESSIAN_DARK )
+        whole = self.opFilter.Output[:].wait()
+
+        # The tiles are filtered in parallel and stitched into the result
+        self.opFilter.BlockShape.setValue( (1, 16, 16, 16, 1) )
+        tiled = self.opFilter.Output[:].wait()
+        assert numpy.allclose( tiled, whole, atol=1e-4 )
+        tiled = self.opFilter.Output[:, 5:37, 10:30, 0:40, :].wait()
+        assert numpy.allclose( tiled, whole[:, 5:37, 10:30, 0:40, :], atol=1e-4 )
+
+    def testWatershed(self):
+        self.opFilter.Filter.setValue( OpFilter.STEP_EDGES )
+        opWatershed = OpSimpleWatershed( graph=self.graph )
+        opWatershed.Input.connect( self.opNormalize.Output )
+        opWatershed.BlockShape.setValue( { 'x':20, 'y':20, 'z':20 } )
+
+        opCache = OpCompressedCache( graph=self.graph )
+        opCache.Input.connect( opWatershed.Output )
+        opCache.BlockShape.setValue( (1, 20, 20, 20, 1) )
+
+        labels = opCache.Output[:].wait()
+        assert labels.dtype == numpy.int32
+        # Every voxel belongs to a supervoxel, and the supervoxel ids are consecutive
+        assert labels.min() == 1
+        assert len(numpy.unique(labels)) == labels.max()
+        # Most supervoxels cross the block faces without being split
+        assert labels.max() < 2 * len(numpy.unique(vigra.analysis.watersheds(
+            numpy.asarray(self.opNormalize.Output[:].wait()[0,...,0], dtype=numpy.uint8) )[0]))
+
+if __name__ == '__main__':
+    import sys
+    import nose
+
+    # Don't steal stdout. Show it on the console as usual.
+    sys.argv.append("--nocapture")
+
+    # Don't set the logging level to DEBUG. Leave it alone.
+    sys.argv.append("--nologcapture")
+
+    nose.run(defaultTest=__file__)
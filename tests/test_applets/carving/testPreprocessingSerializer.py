@@ -0,0 +1,306 @@
+import os
+import shutil
+import tempfile
+
+import numpy
+import h5py
+import vigra
+
+import ilastik
+from lazyflow.graph import Graph, Operator
+from cylemon.segmentation import MSTSegmentor
+from ilastik.workflows.carving.preprocessingSerializer import hashGroup, PreprocessingSerializer
+from ilastik.workflows.carving.carvingSerializer import CarvingSerializer
+from ilastik.workflows.carving.opPreprocessing import OpPreprocessing
+from ilastik.workflows.carving.opCarving import OpCarving
+
+class TestHashGroup(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.f = h5py.File(os.path.join(self.tmpdir, "graphs.h5"), 'w')
+        for name in ['a', 'b']:
+            g = self.f.create_group(name)
+            g.create_dataset('edges', data=numpy.arange(1000).reshape(100, 10))
+            g.create_dataset('count', data=5)
+            g.attrs['nodes'] = 7
+
+    def tearDown(self):
+        self.f.close()
+        shutil.rmtree(self.tmpdir)
+
+    def testIdenticalContent(self):
+        assert hashGroup(self.f['a']) == hashGroup(self.f['b'])
+        # Reading in small pieces gives the same hash
+        assert hashGroup(self.f['a'], chunkBytes=100) == hashGroup(self.f['a'])
+
+    def testChangedContent(self):
+        reference = hashGroup(self.f['a'])
+        self.f['b/edges'][3, 3] = -1
+        assert hashGroup(self.f['b']) != reference
+        self.f['a'].attrs['nodes'] = 8
+        assert hashGroup(self.f['a']) != reference
+
+def makeGraph(seed):
+    """
+    An MSTSegmentor for a 20x20x5 volume of 16 supervoxels, with random edge weights.
+    """
+    x, y, z = numpy.mgrid[0:20, 0:20, 0:5]
+    labels = (1 + (x // 5) * 4 + (y // 5)).astype(numpy.int32)
+    features = numpy.random.RandomState(seed).random_sample(labels.shape).astype(numpy.float32)
+    return MSTSegmentor( labels, features, edgeWeightFunctor="minimum" )
+
+class SlotStub(object):
+    def __init__(self, value=None):
+        self.value = value
+
+    def setValue(self, value):
+        self.value = value
+
+    def setDirty(self, *args):
+        pass
+
+class AppletStub(object):
+    writeprotected = False
+
+class PreprocessingAppletStub(AppletStub):
+    def enableReset(self, er):
+        pass
+
+    def enableDownstream(self, ed):
+        pass
+
+class OpWorkflowStub(Operator):
+    def __init__(self, *args, **kwargs):
+        super(OpWorkflowStub, self).__init__(*args, **kwargs)
+        self.preprocessingApplet = PreprocessingAppletStub()
+
+class OpLaneStub(Operator):
+    pass
+
+class OpPreprocessingStub(object):
+    """
+    The parts of OpPreprocessing that the serializer uses.
+    """
+    def __init__(self, graph=None):
+        self._prepData = numpy.array([graph])
+        self._prepDataLoader = None
+        self._graphHash = None
+        self._unsavedData = graph is not None
+        self._dirty = False
+        self.initialSigma = 1.6
+        self.initialFilter = 0
+        self.Sigma = SlotStub(1.6)
+        self.Filter = SlotStub(0)
+        self.WatershedSource = SlotStub('filtered')
+        self.InvertWatershedSource = SlotStub(False)
+        self.PreprocessedData = SlotStub()
+        self.applet = AppletStub()
+
+    def enableDownstream(self, ed):
+        pass
+
+    def graph(self):
+        """Load the graph like OpPreprocessing.execute() does."""
+        if self._prepDataLoader is not None:
+            self._prepData = numpy.array([self._prepDataLoader()])
+            self._prepDataLoader = None
+        return self._prepData[0]
+
+class TopLevelOperatorStub(object):
+    def __init__(self, innerOperators):
+        self.innerOperators = innerOperators
+
+class TestPreprocessingSerializer(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.f = h5py.File(os.path.join(self.tmpdir, "project.ilp"), 'w')
+        self.f.create_dataset("ilastikVersion", data=ilastik.__version__)
+
+    def tearDown(self):
+        self.f.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _save(self, ops):
+        PreprocessingSerializer( TopLevelOperatorStub(ops), "preprocessing" ).serializeToHdf5( self.f, None )
+
+    def _load(self, numLanes):
+        ops = [ OpPreprocessingStub() for i in range(numLanes) ]
+        PreprocessingSerializer( TopLevelOperatorStub(ops), "preprocessing" ).deserializeFromHdf5( self.f, None, headless=True )
+        return ops
+
+    def _checkGraphLink(self, graphHash):
+        link = self.f["preprocessing"].get("graph", getlink=True)
+        assert isinstance(link, h5py.SoftLink)
+        assert link.path == "/preprocessing/graphs/" + graphHash
+
+    def testRoundTrip(self):
+        graphA = makeGraph(0)
+        graphB = makeGraph(1)
+        # Lanes 0 and 1 use the same graph, lane 2 an identical copy of it, lane 3 has no graph.
+        self._save( [ OpPreprocessingStub(graphA), OpPreprocessingStub(graphA), OpPreprocessingStub(makeGraph(0)),
+                      OpPreprocessingStub(), OpPreprocessingStub(graphB) ] )
+
+        laneHashes = list( self.f["preprocessing/lane_graphs"].value )
+        hashA, hashB = laneHashes[0], laneHashes[4]
+        assert laneHashes == [hashA, hashA, hashA, "", hashB]
+        assert hashA != hashB
+        assert sorted( self.f["preprocessing/graphs"].keys() ) == sorted( [hashA, hashB] )
+        self._checkGraphLink(hashA)
+
+        ops = self._load(5)
+        assert [ op._graphHash for op in ops ] == [hashA, hashA, hashA, None, hashB]
+        assert ops[3]._prepDataLoader is None and ops[3]._prepData[0] is None
+
+        # Lanes with the same graph don't share the per-lane state
+        graph0, graph1 = ops[0].graph(), ops[1].graph()
+        assert graph0 is not graph1
+        graph0.object_names["a"] = 1
+        assert "a" not in graph1.object_names
+
+        # Graphs that are stored already aren't written again, whether they have been loaded or not
+        self.f["preprocessing/graphs"][hashA].attrs["marker"] = 1
+        self._save( ops )
+        assert self.f["preprocessing/graphs"][hashA].attrs["marker"] == 1
+        assert list( self.f["preprocessing/lane_graphs"].value ) == laneHashes
+        assert sorted( self.f["preprocessing/graphs"].keys() ) == sorted( [hashA, hashB] )
+        self._checkGraphLink(hashA)
+
+        # Graphs that are used by no lane anymore are removed
+        for op in ops[:3]:
+            op._prepData = numpy.array([None])
+            op._prepDataLoader = None
+        self._save( ops )
+        assert list( self.f["preprocessing/lane_graphs"].value ) == ["", "", "", "", hashB]
+        assert self.f["preprocessing/graphs"].keys() == [hashB]
+        self._checkGraphLink(hashB)
+
+    def _checkMigration(self):
+        ops = self._load(2)
+        assert ops[0]._graphHash is None and ops[1]._graphHash is None
+        self._save( ops )
+
+        laneHashes = list( self.f["preprocessing/lane_graphs"].value )
+        assert laneHashes[0] != "" and laneHashes == [laneHashes[0]] * 2
+        assert self.f["preprocessing/graphs"].keys() == [laneHashes[0]]
+        self._checkGraphLink(laneHashes[0])
+
+        ops = self._load(2)
+        assert ops[0].graph() is not ops[1].graph()
+
+    def _createLegacyGroup(self):
+        preproc = self.f.create_group("preprocessing")
+        preproc.create_dataset("StorageVersion", data="0.1")
+        preproc.create_dataset("sigma", data=1.6)
+        preproc.create_dataset("filter", data=0)
+        return preproc
+
+    def testLegacyGraph(self):
+        preproc = self._createLegacyGroup()
+        makeGraph(0).saveH5G( preproc.create_group("graph") )
+        self._checkMigration()
+
+    def testLegacyGraphfile(self):
+        preproc = self._createLegacyGroup()
+        graphFilePath = os.path.join(self.tmpdir, "graph.h5")
+        with h5py.File(graphFilePath, 'w') as graphFile:
+            makeGraph(0).saveH5G( graphFile.create_group("graph") )
+        preproc.create_dataset("graphfile", data=graphFilePath)
+        self._checkMigration()
+
+class TestCarvingLane(object):
+    """
+    Opening a project doesn't load the graph of a carving lane.  The lane loads it when it is first used,
+    and then gets the saved objects and the current seeds.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.projectFilePath = os.path.join(self.tmpdir, "project.ilp")
+        self.f = h5py.File(self.projectFilePath, 'w')
+        self.f.create_dataset("ilastikVersion", data=ilastik.__version__)
+
+        x, y, z = numpy.mgrid[0:20, 0:20, 0:5]
+        self.labels = 1 + (x // 5) * 4 + (y // 5)
+        data = numpy.random.RandomState(0).random_sample(self.labels.shape).astype(numpy.float32)
+        self.data = vigra.taggedView( data[numpy.newaxis, ..., numpy.newaxis], 'txyzc' )
+
+    def tearDown(self):
+        self.f.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _connectCarving(self, opCarving):
+        opCarving.InputData.setValue( self.data )
+        opCarving.FilteredInputData.setValue( self.data )
+        opCarving.WriteSeeds.connect( opCarving.InputData )
+        opCarving.UncertaintyType.setValue( "none" )
+
+    def _writeSeeds(self, opCarving, fg, bg):
+        seeds = numpy.zeros( (1,) + self.labels.shape + (1,), dtype=numpy.uint8 )
+        seeds[(0,) + fg + (0,)] = 2
+        seeds[(0,) + bg + (0,)] = 1
+        opCarving.WriteSeeds[:] = seeds
+
+    def _saveProject(self):
+        graph = makeGraph(0)
+        opCarving = OpCarving( graph=Graph() )
+        self._connectCarving( opCarving )
+        opCarving.MST.setValue( graph )
+
+        # Save supervoxels 1 and 2 as object "a", and leave some seeds for the next one
+        self._writeSeeds( opCarving, (2, 2, 2), (12, 12, 2) )
+        lut_segmentation = graph.segmentation.lut[:]
+        lut_segmentation[:] = 1
+        lut_segmentation[[1, 2]] = 2
+        opCarving.saveObjectAs( "a" )
+        self._writeSeeds( opCarving, (7, 2, 2), (17, 17, 2) )
+
+        CarvingSerializer( TopLevelOperatorStub([opCarving]), "carving" ).serializeToHdf5( self.f, self.projectFilePath )
+        # The seeds are restored from the carving group, not from the graph
+        graph.seeds.lut[:] = 0
+        PreprocessingSerializer( TopLevelOperatorStub([OpPreprocessingStub(graph)]), "preprocessing" ).serializeToHdf5( self.f, self.projectFilePath )
+
+    def testLoadOnFirstUse(self):
+        self._saveProject()
+
+        # A lane wired like in the carving workflow
+        opLane = OpLaneStub( parent=OpWorkflowStub( graph=Graph() ) )
+        opPreprocessing = OpPreprocessing( parent=opLane )
+        opPreprocessing.InputData.setValue( self.data )
+        opCarving = OpCarving( parent=opLane )
+        self._connectCarving( opCarving )
+        opCarving.MST.connect( opPreprocessing.PreprocessedData )
+
+        PreprocessingSerializer( TopLevelOperatorStub([opPreprocessing]), "preprocessing" ).deserializeFromHdf5( self.f, self.projectFilePath, headless=True )
+        CarvingSerializer( TopLevelOperatorStub([opCarving]), "carving" ).deserializeFromHdf5( self.f, self.projectFilePath )
+        assert opPreprocessing._prepDataLoader is not None, "The graph was loaded with the project"
+        assert opCarving._loadedMst is None
+        assert len( opCarving._mstCallbacks ) == 1
+
+        # Changing the carving parameters doesn't need the graph either
+        opCarving.BackgroundPriority.setValue( 0.9 )
+        assert opPreprocessing._prepDataLoader is not None
+
+        # The first use loads the graph, with the objects and seeds of the project
+        assert opCarving.dataIsStorable()
+        assert opPreprocessing._prepDataLoader is None
+        mst = opCarving._mst
+        assert mst.object_names.keys() == ["a"]
+        assert sorted( numpy.asarray(mst.object_lut["a"]).ravel() ) == [1, 2]
+
+        done = opCarving.DoneObjects[:].wait()[0, ..., 0]
+        assert ( (done != 0) == numpy.in1d(self.labels, [1, 2]).reshape(self.labels.shape) ).all()
+
+        # Nothing is loaded again
+        assert opCarving._mst is mst
+        assert opCarving.MstOut.value is mst
+
+if __name__ == '__main__':
+    import sys
+    import nose
+
+    # Don't steal stdout. Show it on the console as usual.
+    sys.argv.append("--nocapture")
+
+    # Don't set the logging level to DEBUG. Leave it alone.
+    sys.argv.append("--nologcapture")
+
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,42 @@
+import numpy
+from ilastik.workflows.carving.supervoxelObjectIndex import SupervoxelObjectIndex
+
+class TestSupervoxelObjectIndex(object):
+    def setUp(self):
+        # Object supervoxels are stored as returned by numpy.where()
+        self.object_lut = { 'a' : numpy.where(numpy.array([0, 1, 1, 0, 0]) > 0),
+                            'b' : numpy.where(numpy.array([0, 0, 1, 1, 0]) > 0) }
+        self.index = SupervoxelObjectIndex.fromObjects(self.object_lut)
+
+    def testLookup(self):
+        assert self.index.namesAt(0) == []
+        assert self.index.namesAt(1) == ['a']
+        assert self.index.namesAt(2) == ['a', 'b']
+        assert self.index.namesAt(numpy.uint32(3)) == ['b']
+
+    def testUpdate(self):
+        self.index.remove('a', self.object_lut['a'])
+        self.index.add('c', numpy.array([[3, 4]]))
+        assert self.index.namesAt(1) == []
+        assert self.index.namesAt(2) == ['b']
+        assert self.index.namesAt(3) == ['b', 'c']
+        assert self.index.objectNames() == set(['b', 'c'])
+
+    def testArrays(self):
+        restored = SupervoxelObjectIndex.fromArrays( *self.index.toArrays() )
+        assert restored.objectNames() == set(['a', 'b'])
+        for sv in range(5):
+            assert restored.namesAt(sv) == self.index.namesAt(sv)
+
+
+if __name__ == '__main__':
+    import sys
+    import nose
+
+    # Don't steal stdout. Show it on the console as usual.
+    sys.argv.append("--nocapture")
+
+    # Don't set the logging level to DEBUG. Leave it alone.
+    sys.argv.append("--nologcapture")
+
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,139 @@
+import sys
+import numpy
+from lazyflow.graph import Graph, Operator, OutputSlot
+from lazyflow.roi import roiToSlice
+from ilastik.applets.deviationFromMean.opDeviationFromMean import OpDeviationFromMean
+
+class OpDataProvider(Operator):
+    """
+    Provides an array and records the rois that were requested from it.
+    """
+    Output = OutputSlot()
+
+    def __init__(self, data, *args, **kwargs):
+        super(OpDataProvider, self).__init__(*args, **kwargs)
+        self.data = data
+        self.requestedRois = []
+        self.duringRead = None # Called (once) while a request is being served
+
+    def setupOutputs(self):
+        self.Output.meta.shape = self.data.shape
+        self.Output.meta.dtype = self.data.dtype
+
+    def execute(self, slot, subindex, roi, result):
+        self.requestedRois.append( (tuple(roi.start), tuple(roi.stop)) )
+        result[:] = self.data[roiToSlice(roi.start, roi.stop)]
+        if self.duringRead is not None:
+            callback, self.duringRead = self.duringRead, None
+            callback()
+        return result
+
+    def setData(self, slicing, value):
+        self.data[slicing] = value
+        self.Output.setDirty(slicing)
+
+    def propagateDirty(self, slot, subindex, roi):
+        pass
+
+class TestOpDeviationFromMean(object):
+    """
+    The cached block sums must always give the same result as averaging all inputs from scratch,
+    while lanes are changed, inserted and removed.
+    """
+    SHAPE = (10, 9)
+    SCALE = 3.0
+    OFFSET = 10.0
+
+    def setUp(self):
+        numpy.random.seed(0)
+        self._setupOperator( blockSize=4, numLanes=3 ) # 3x3 blocks, the last ones are partial
+
+    def _setupOperator(self, blockSize, numLanes):
+        self.graph = Graph()
+        self.op = OpDeviationFromMean( graph=self.graph )
+        self.op.BlockSize = blockSize
+        self.op.ScalingFactor.setValue( self.SCALE )
+        self.op.Offset.setValue( self.OFFSET )
+
+        self.providers = []
+        for i in range(numLanes):
+            self._appendLane()
+
+    def _appendLane(self):
+        provider = OpDataProvider( numpy.random.random( self.SHAPE ), graph=self.graph )
+        self.providers.append( provider )
+        self.op.Input.resize( len(self.providers) )
+        self.op.Input[-1].connect( provider.Output )
+        return provider
+
+    def _resetRequestedRois(self):
+        for provider in self.providers:
+            provider.requestedRois = []
+
+    def _checkMean(self):
+        expectedMean = numpy.mean( [p.data for p in self.providers], axis=0 )
+        assert numpy.allclose( self.op.Mean[:].wait(), expectedMean )
+        # Also a roi that isn't aligned to the blocks
+        assert numpy.allclose( self.op.Mean[2:7, 3:5].wait(), expectedMean[2:7, 3:5] )
+        for i, provider in enumerate(self.providers):
+            expected = self.OFFSET + self.SCALE * (provider.data - expectedMean)
+            assert numpy.allclose( self.op.Output[i][:].wait(), expected )
+
+    def testMean(self):
+        self._checkMean()
+
+    def testChangeLane(self):
+        self._checkMean()
+        self._resetRequestedRois()
+
+        # Only the blocks in the dirty region are summed up again
+        self.providers[1].setData( numpy.s_[1:3, 5:7], 5.0 )
+        self.op.Mean[:].wait()
+        for provider in self.providers:
+            assert sorted( provider.requestedRois ) == [ ((0,4), (4,8)) ]
+        self._checkMean()
+
+    def testInsertLane(self):
+        self._checkMean()
+        self._resetRequestedRois()
+
+        # The new lane is added to the cached sums: the other lanes aren't read again
+        provider = self._appendLane()
+        self.op.Mean[:].wait()
+        assert len( provider.requestedRois ) == 9
+        for provider in self.providers[:-1]:
+            assert provider.requestedRois == []
+        self._checkMean()
+
+    def testRemoveLane(self):
+        self._checkMean()
+
+        # The sums contain the removed lane, so they are rebuilt from the remaining ones
+        self.op.Input.removeSlot( 1, 2 )
+        del self.providers[1]
+        self._resetRequestedRois()
+        self.op.Mean[:].wait()
+        for provider in self.providers:
+            assert len( provider.requestedRois ) == 9
+        self._checkMean()
+
+    def testDirtyWhileReading(self):
+        self._setupOperator( blockSize=64, numLanes=2 ) # A single block
+
+        # Lane 0 changes after its data was read, but before the block sum is stored
+        def changeData():
+            self.providers[0].setData( numpy.s_[:], 1.0 )
+        self.providers[0].duringRead = changeData
+        self.op.Mean[:].wait()
+
+        # The sum with the old data must not have been kept
+        self._resetRequestedRois()
+        self.op.Mean[:].wait()
+        assert len( self.providers[0].requestedRois ) == 1
+        self._checkMean()
+
+if __name__ == "__main__":
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -5,6 +5,7 @@ import unittest
 import numpy as np
 import vigra
 from lazyflow.graph import Graph
+from lazyflow.rtype import List
 from ilastik.applets.objectClassification.opObjectClassification import \
     OpRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
     OpBadObjectsToWarningMessage, OpMaxLabel
@@ -41,6 +42,14 @@ def emptyImage():
     img.axistags = vigra.defaultAxistags('txyzc')    
     return img
 
+class OpAdaptDirtyWhileComputing(OpAdaptTimeListRoi):
+    """Marks the requested time slices dirty after computing them,
+    as if their features had changed in the meantime."""
+    def execute(self, slot, subindex, roi, destination):
+        result = super(OpAdaptDirtyWhileComputing, self).execute(slot, subindex, roi, destination)
+        self.Output.setDirty(List(self.Output, sorted(result.keys())))
+        return result
+
 class TestOpRelabelSegmentation(object):
     def setUp(self):
         g = Graph()
@@ -113,6 +122,37 @@ class TestOpObjectTrain(unittest.TestCase):
         for randomForest in results:
             self.assertIsInstance(randomForest, vigra.learning.RandomForest)
 
+    def test_incremental(self):
+        self.op.Features.resize(2)
+        self.op.Features[1].connect(self._opRegFeatsAdaptOutput.Output)
+        self.op.Labels.resize(2)
+        self.op.Labels[0].setValue({0 : np.array([0, 1, 2]),
+                                    1 : np.array([0, 0, 0, 0])})
+        self.op.Labels[1].setValue({0 : np.array([0, 0, 0]),
+                                    1 : np.array([0, 0, 0, 0])})
+        self.op.Classifier[:].wait()
+
+        # Lanes without labels don't contribute to the training set
+        trainingSet0 = self.op._trainingSets[self.op.Labels[0]]
+        self.assertEquals(trainingSet0.featMatrix.shape[0], 2)
+        self.assertIsNone(self.op._trainingSets[self.op.Labels[1]])
+
+        # Only the lane with new labels is gathered again
+        self.op.Labels[1].setValue({0 : np.array([0, 0, 0]),
+                                    1 : np.array([0, 1, 1, 2])})
+        self.assertNotIn(self.op.Labels[1], self.op._trainingSets)
+        results = self.op.Classifier[:].wait()
+        self.assertIs(self.op._trainingSets[self.op.Labels[0]], trainingSet0)
+        self.assertEquals(self.op._trainingSets[self.op.Labels[1]].featMatrix.shape[0], 3)
+        for randomForest in results:
+            self.assertIsInstance(randomForest, vigra.learning.RandomForest)
+
+        # Changing the selected features invalidates all lanes
+        self.op.SelectedFeatures.setValue({"Standard Object Features" : {"Count":{}}})
+        self.assertEquals(len(self.op._trainingSets), 0)
+        self.op.Classifier[:].wait()
+        self.assertEquals(self.op._trainingSets[self.op.Labels[1]].featMatrix.shape, (3, 1))
+
 
 class TestOpObjectPredict(unittest.TestCase):
     def setUp(self):
@@ -184,6 +224,43 @@ class TestOpObjectPredict(unittest.TestCase):
         
         self.assertTrue( np.all(probChannel0Time01[0]==probs[0][:, 0]) )
         self.assertTrue( np.all(probChannel0Time01[1]==probs[1][:, 0]) )
+
+    def test_invalidate_time_slice(self):
+        ###
+        # dirty features of one time slice must only invalidate that time slice
+        ###
+        opAdapt = OpAdaptTimeListRoi(graph=self.op.graph)
+        opAdapt.Input.connect(self.featsop.Output)
+        self.op.Features.connect(opAdapt.Output)
+
+        probs = self.op.Probabilities([0, 1]).wait()
+        cached = self.op.CachedProbabilities([0, 1]).wait()
+        self.assertEqual(set(cached.keys()), set([0, 1]))
+
+        opAdapt.Output.setDirty(List(opAdapt.Output, [1]))
+        cached = self.op.CachedProbabilities([0, 1]).wait()
+        self.assertEqual(set(cached.keys()), set([0]))
+
+        newprobs = self.op.Probabilities([0, 1]).wait()
+        self.assertTrue( np.all(newprobs[1]==probs[1]) )
+
+    def test_features_dirty_while_computing(self):
+        ###
+        # results computed from features that went dirty meanwhile are returned, but not cached
+        ###
+        opAdapt = OpAdaptDirtyWhileComputing(graph=self.op.graph)
+        opAdapt.Input.connect(self.featsop.Output)
+        self.op.Features.connect(opAdapt.Output)
+
+        bad_objects = self.op.BadObjects([0, 1]).wait()
+        self.assertEqual(set(bad_objects.keys()), set([0, 1]))
+        self.assertEqual(len(bad_objects[0]), 3)
+        self.assertEqual(len(bad_objects[1]), 4)
+
+        preds = self.op.Predictions([0, 1]).wait()
+        self.assertTrue(np.all(preds[0] == np.array([0, 1, 2])))
+        self.assertTrue(np.all(preds[1] == np.array([0, 1, 1, 2])))
+        self.assertEqual(self.op.CachedProbabilities([0, 1]).wait(), {})
         
 
  
@@ -8,7 +8,8 @@ ilastik.ilastik_logging.default_config.init()
 import unittest
 import numpy as np
 import vigra
-from lazyflow.graph import Graph
+from lazyflow.graph import Graph, Operator, OutputSlot
+from lazyflow.roi import roiToSlice
 from ilastik.applets.objectClassification.opObjectClassification import \
     OpRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
     OpBadObjectsToWarningMessage, OpMaxLabel
@@ -18,6 +19,7 @@ from ilastik.applets.counting.opCounting import \
     OpPredictionPipelineNoCache,OpPredictionPipeline
 
 from ilastik.applets.counting.countingOperators import OpTrainCounter, OpPredictCounter, OpLabelPreviewer
+from ilastik.applets.counting.countingsvr import SVR
 
  
 # def segImage():
@@ -69,6 +71,186 @@ class TestOpMean(object):
         #FIXME: why is it this the region ?
         np.testing.assert_allclose(np.mean(rimg.view(np.ndarray),axis=2),mean.view(np.ndarray)[...,0:1,0])
 
+
+
+class OpLabelProvider(Operator):
+    """
+    Provides a label image and records the rois that were requested from it.
+    """
+    Output = OutputSlot()
+
+    def __init__(self, labels, *args, **kwargs):
+        super(OpLabelProvider, self).__init__(*args, **kwargs)
+        self.labels = labels
+        self.requestedRois = []
+
+    def setupOutputs(self):
+        self.Output.meta.shape = self.labels.shape
+        self.Output.meta.dtype = self.labels.dtype
+        self.Output.meta.axistags = vigra.defaultAxistags('xyc')
+
+    def execute(self, slot, subindex, roi, result):
+        self.requestedRois.append( (tuple(roi.start), tuple(roi.stop)) )
+        result[:] = self.labels[roiToSlice(roi.start, roi.stop)]
+        return result
+
+    def setLabels(self, slicing, value):
+        self.labels[slicing] = value
+        self.Output.setDirty(slicing)
+
+    def propagateDirty(self, slot, subindex, roi):
+        pass
+
+class TestOpTrainCounter(object):
+    def setUp(self):
+        np.random.seed(0)
+        g = Graph()
+        shape = (100, 100)
+        features = vigra.taggedView( np.random.random( shape + (2,) ).astype(np.float32), 'xyc' )
+
+        foreground = np.zeros( shape + (1,), dtype=np.uint8 )
+        foreground[10, 10] = foreground[30, 80] = foreground[70, 20] = foreground[90, 90] = 1
+        background = np.zeros( shape + (1,), dtype=np.uint8 )
+        background[40:50, 40:50] = background[70:80, 70:80] = 2
+
+        # The label blocks (like the smoothing cache blocks) are 64x64
+        blocks = np.empty( (1,), dtype=object )
+        blocks[0] = [ (slice(x, min(x+64, 100)), slice(y, min(y+64, 100)), slice(0,1)) for x in (0, 64) for y in (0, 64) ]
+
+        self.opLabels = OpLabelProvider( foreground, graph=g )
+        self.op = OpTrainCounter( graph=g )
+        self.op.Images.setValues( [features] )
+        self.op.ForegroundLabels.resize( 1 )
+        self.op.ForegroundLabels[0].connect( self.opLabels.Output )
+        self.op.BackgroundLabels.setValues( [vigra.taggedView( background, 'xyc' )] )
+        self.op.nonzeroLabelBlocks.setValues( [blocks] )
+        self.op.UpperBound.setValue( 100 )
+        self.op.SelectedOption.setValue( "RandomForest" )
+        self.op.fixClassifier.setValue( False )
+
+    def _checkTrained(self):
+        regressors = self.op.Classifier[:].wait()
+        assert len(regressors) == OpTrainCounter.numRegressors
+        for regressor in regressors:
+            assert isinstance( regressor, SVR )
+
+    def testLabelEdit(self):
+        self._checkTrained()
+        assert len( self.opLabels.requestedRois ) > 0
+
+        # Only the smoothing of the block with the new label is computed again
+        self.opLabels.requestedRois = []
+        self.opLabels.setLabels( np.s_[20:21, 20:21, 0:1], 1 )
+        self._checkTrained()
+        assert len( self.opLabels.requestedRois ) > 0
+        for start, stop in self.opLabels.requestedRois:
+            # (with the halo of the smoothing, the roi may reach into the neighbouring blocks)
+            assert start[:2] == (0, 0), "Smoothing was recomputed for roi {}".format( (start, stop) )
+
+        # Without a label change, nothing is smoothed again
+        self.opLabels.requestedRois = []
+        self._checkTrained()
+        assert self.opLabels.requestedRois == []
+
+
+class LinearRegressor(object):
+    """
+    A regressor with a fixed linear prediction (which can be negative).
+    """
+    def __init__(self, w, b):
+        self.w = w
+        self.b = b
+
+    def predict(self, X):
+        return np.dot(X, self.w) + self.b
+
+def makeSVR(seed, numFeatures, normalize):
+    rs = np.random.RandomState(seed)
+    if normalize:
+        svr = SVR(method="BoxedRegressionGurobi", minmax=(np.zeros(numFeatures), rs.random_sample(numFeatures) + 1))
+    else:
+        svr = SVR(method="RandomForest")
+    # Predicts zero (after clipping) for some of the pixels with features in [0,1)
+    w = rs.random_sample(numFeatures) + 0.5
+    svr._regressor = [LinearRegressor(w, -0.3 * w.sum())]
+    return svr
+
+def predictWholeImage(svr, oldImage):
+    """
+    SVR.predict() as it was before it worked in chunks (the reference for the results).
+    """
+    oldShape = oldImage.shape
+    image = np.copy(oldImage.reshape((-1, oldImage.shape[-1])))
+    image = svr.normalize(image)
+    reslist = []
+    for r in svr._regressor:
+        reslist.append(r.predict(image))
+    res = np.dstack(reslist).view(np.ndarray)
+    res[res < 0] = 0
+    return res.reshape(oldShape[:-1] + (len(svr._regressor),))
+
+class TestSVRPredict(object):
+    def setUp(self):
+        self.features = np.random.RandomState(0).random_sample((6, 7, 3)).astype(np.float32)
+
+    def _check(self, svr):
+        expected = predictWholeImage(svr, self.features)
+        assert (expected == 0).any() and (expected > 0).any()
+        np.testing.assert_allclose(svr.predict(self.features), expected, rtol=1e-5)
+        np.testing.assert_allclose(svr.predict(self.features, chunkSize=5), expected, rtol=1e-5)
+
+        # A contiguous out is written directly
+        out = np.zeros((6, 7, 1), dtype=np.float32)
+        assert svr.predict(self.features, out=out, chunkSize=5) is out
+        np.testing.assert_allclose(out, expected, rtol=1e-5)
+
+        # A non-contiguous out is written through a copy
+        outs = np.zeros((6, 7, 3), dtype=np.float32)
+        svr.predict(self.features, out=outs[..., 1:2], chunkSize=5)
+        np.testing.assert_allclose(outs[..., 1:2], expected, rtol=1e-5)
+        assert (outs[..., 0] == 0).all() and (outs[..., 2] == 0).all()
+
+    def testPredict(self):
+        self._check(makeSVR(1, 3, normalize=False))
+
+    def testPredictNormalized(self):
+        features = self.features.copy()
+        self._check(makeSVR(2, 3, normalize=True))
+        # normalize() works in place, but the features must not be changed
+        assert (self.features == features).all()
+
+class TestOpPredictCounter(object):
+    def setUp(self):
+        g = Graph()
+        self.features = np.random.RandomState(0).random_sample((2, 20, 17, 3))
+        forests = np.empty((OpTrainCounter.numRegressors,), dtype=object)
+        for i in range(len(forests)):
+            forests[i] = makeSVR(i, 3, normalize=(i % 2 == 0))
+
+        self.op = OpPredictCounter(graph=g)
+        self.op.TileDims = { 't' : 1, 'x' : 7, 'y' : 5 }
+        self.op.Image.setValue(vigra.taggedView(self.features, 'txyc'))
+        self.op.Classifier.setValue(forests)
+        self.op.LabelsCount.setValue(OpTrainCounter.numRegressors)
+        self.forests = forests
+
+    def _check(self, slicing):
+        """
+        Compare the tiled prediction with the prediction of the whole roi at once.
+        """
+        features = np.asarray(self.features[slicing[:-1]], dtype=np.float32)
+        channels = range(*slicing[-1].indices(OpTrainCounter.numRegressors))
+        expected = np.concatenate([predictWholeImage(self.forests[c], features) for c in channels], axis=-1)
+        np.testing.assert_allclose(self.op.PMaps[slicing].wait(), expected, rtol=1e-5)
+
+    def testNotTileAligned(self):
+        # Several tiles per channel: the result of each tile is written through a copy
+        self._check(np.s_[0:2, 3:18, 2:15, 1:3])
+        self._check(np.s_[:, :, :, :])
+
+    def testContiguousTiles(self):
+        # A single timestep and channel, and one tile in y: each tile is a contiguous part of the result
+        self._check(np.s_[1:2, 2:19, 6:9, 2:3])
         
 # class TestOpObjectTrain(unittest.TestCase):
 #     
@@ -3,7 +3,7 @@ import numpy as np
 import vigra
 from lazyflow.graph import Graph
 from lazyflow.operators import OpLabelImage
-from ilastik.applets.objectExtraction.opObjectExtraction import OpAdaptTimeListRoi, OpRegionFeatures
+from ilastik.applets.objectExtraction.opObjectExtraction import OpAdaptTimeListRoi, OpRegionFeatures, OpRegionFeatures3d
 from ilastik.plugins import pluginManager
 
 NAME = "Standard Object Features"
@@ -171,6 +171,94 @@ class testOpRegionFeaturesAgainstNumpy(object):
                     center_good = mins[iobj][icoord] + (maxs[iobj][icoord]-mins[iobj][icoord])/2.
                     assert abs(coord-center_good)<0.01
 
+class TestComputeExtents(object):
+    def test_matches_compute_extent(self):
+        class Axes(object):
+            x = 0
+            y = 1
+            z = 2
+            c = 3
+        axes = Axes()
+        image = np.zeros((50, 40, 30, 1), dtype=np.float32)
+        mincoords = np.array([[0, 0, 0], [10, 20, 5], [45, 35, 28]], dtype=np.float32)
+        maxcoords = np.array([[4, 4, 4], [15, 25, 10], [49, 39, 29]], dtype=np.float32)
+        margin = [5, 3, 2]
+
+        op = OpRegionFeatures3d(graph=Graph())
+        starts, stops = op.compute_extents(image, mincoords, maxcoords, axes, margin)
+        for i in range(mincoords.shape[0]):
+            extent = op.compute_extent(i, image, mincoords, maxcoords, axes, margin)
+            assert [s.start for s in extent] == list(starts[i])
+            assert [s.stop for s in extent] == list(stops[i])
+
+    def test_2d(self):
+        class Axes(object):
+            x = 0
+            y = 1
+            z = 2
+            c = 3
+        axes = Axes()
+        image = np.zeros((50, 40, 1, 1), dtype=np.float32)
+        mincoords = np.array([[3, 4]], dtype=np.float32)
+        maxcoords = np.array([[10, 12]], dtype=np.float32)
+
+        op = OpRegionFeatures3d(graph=Graph())
+        starts, stops = op.compute_extents(image, mincoords, maxcoords, axes, [5, 5, 0])
+        assert list(starts[0]) == [0, 0, 0]
+        assert list(stops[0]) == [16, 18, 1]
+
+
+class TestOpRegionFeaturesBatched(testOpRegionFeaturesAgainstNumpy):
+    """Run the numpy comparison with many small local feature batches."""
+    def setUp(self):
+        self._old_batch_size = OpRegionFeatures3d.LocalFeaturesBatchSize
+        OpRegionFeatures3d.LocalFeaturesBatchSize = 1
+        super(TestOpRegionFeaturesBatched, self).setUp()
+
+    def tearDown(self):
+        OpRegionFeatures3d.LocalFeaturesBatchSize = self._old_batch_size
+
+class TestOpRegionFeaturesBlockwise(object):
+    def setUp(self):
+        g = Graph()
+        self.features = {
+            NAME : {
+                "Count" : {},
+                "RegionCenter" : {},
+                "Mean" : {},
+                "Variance" : {},
+                "Minimum" : {},
+                "Maximum" : {},
+                "Coord<Minimum>" : {},
+                "Coord<Maximum>" : {},
+            }
+        }
+        self.labelop = OpLabelImage(graph=g)
+        self.labelop.Input.setValue(binaryImage())
+
+        self.opFull = OpRegionFeatures(graph=g)
+        self.opBlockwise = OpRegionFeatures(graph=g)
+        for op in (self.opFull, self.opBlockwise):
+            op.LabelImage.connect(self.labelop.Output)
+            op.RawImage.setValue(rawImage())
+            op.Features.setValue(self.features)
+        self.opBlockwise.BlockShape.setValue((16, 16, 16))
+
+    def test(self):
+        full = OpAdaptTimeListRoi(graph=self.opFull.graph)
+        full.Input.connect(self.opFull.Output)
+        blockwise = OpAdaptTimeListRoi(graph=self.opBlockwise.graph)
+        blockwise.Input.connect(self.opBlockwise.Output)
+
+        feats_full = full.Output([0, 1]).wait()
+        feats_blockwise = blockwise.Output([0, 1]).wait()
+        for t in (0, 1):
+            for key in self.features[NAME]:
+                expected = feats_full[t][NAME][key]
+                actual = feats_blockwise[t][NAME][key]
+                assert expected.shape == actual.shape, key
+                assert np.allclose(expected, actual, atol=1e-4), key
+
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,70 @@
+import numpy as np
+from ilastik.applets.objectExtraction.regionStatistics import RegionStatistics
+
+def randomVolume(seed=0):
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(0, 6, size=(20, 17, 9)).astype(np.uint32)
+    raw = rng.rand(20, 17, 9, 2) * 100
+    return raw, labels
+
+def blockwiseStatistics(raw, labels, block_shape):
+    stats = RegionStatistics(raw.shape[-1], labels.ndim)
+    for x in range(0, labels.shape[0], block_shape[0]):
+        for y in range(0, labels.shape[1], block_shape[1]):
+            for z in range(0, labels.shape[2], block_shape[2]):
+                slicing = (slice(x, x + block_shape[0]),
+                           slice(y, y + block_shape[1]),
+                           slice(z, z + block_shape[2]))
+                block = RegionStatistics.fromBlock(raw[slicing], labels[slicing], (x, y, z))
+                stats.merge(block)
+    return stats
+
+class TestRegionStatistics(object):
+    def test_against_numpy(self):
+        raw, labels = randomVolume()
+        feats = RegionStatistics.fromBlock(raw, labels, (0, 0, 0)).features()
+        for label in range(1, labels.max() + 1):
+            mask = labels == label
+            values = raw[mask]
+            coords = np.column_stack(np.nonzero(mask))
+            row = label - 1
+            assert feats['Count'][row, 0] == mask.sum()
+            assert np.allclose(feats['Sum'][row], values.sum(axis=0))
+            assert np.allclose(feats['Mean'][row], values.mean(axis=0))
+            assert np.allclose(feats['Variance'][row], values.var(axis=0))
+            assert np.allclose(feats['Minimum'][row], values.min(axis=0))
+            assert np.allclose(feats['Maximum'][row], values.max(axis=0))
+            assert np.all(feats['Coord<Minimum>'][row] == coords.min(axis=0))
+            assert np.all(feats['Coord<Maximum>'][row] == coords.max(axis=0))
+            assert np.allclose(feats['RegionCenter'][row], coords.mean(axis=0))
+
+    def test_merged_blocks_equal_whole_volume(self):
+        raw, labels = randomVolume(1)
+        whole = RegionStatistics.fromBlock(raw, labels, (0, 0, 0)).features()
+        merged = blockwiseStatistics(raw, labels, (7, 5, 4)).features()
+        assert set(whole.keys()) == set(merged.keys())
+        for key in whole:
+            assert whole[key].shape == merged[key].shape, key
+            assert np.allclose(whole[key], merged[key]), key
+
+    def test_missing_labels(self):
+        raw, labels = randomVolume(2)
+        labels[labels == 3] = 0
+        merged = blockwiseStatistics(raw, labels, (10, 10, 10)).features()
+        assert merged['Count'].shape[0] == labels.max()
+        assert merged['Count'][2, 0] == 0
+        assert np.all(merged['Mean'][2] == 0)
+        assert np.all(np.isfinite(merged['Minimum']))
+
+
+if __name__ == '__main__':
+    import sys
+    import nose
+
+    # Don't steal stdout. Show it on the console as usual.
+    sys.argv.append("--nocapture")
+
+    # Don't set the logging level to DEBUG. Leave it alone.
+    sys.argv.append("--nologcapture")
+
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,90 @@
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import numpy
+import h5py
+
+from ilastik.utility.slicingtools import sl, slicing2shape
+from ilastik.shell.projectManager import ProjectManager
+from ilastik.shell.headless.headlessShell import HeadlessShell
+from ilastik.workflows.pixelClassification import PixelClassificationWorkflow
+from ilastik.workflows.pixelClassification import pixelClassificationWorkflowMainHeadless
+
+class TestPixelClassificationHeadlessMultiprocess(object):
+    """
+    Smoke test for --batch_workers: two worker processes export the predictions for two batch inputs.
+    """
+    @classmethod
+    def setupClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.PROJECT_FILE = os.path.join(cls.dir, 'test_project.ilp')
+        cls.EXPORT_DIR = os.path.join(cls.dir, 'export')
+        os.mkdir(cls.EXPORT_DIR)
+
+        cls.BATCH_INPUTS = []
+        for i in range(2):
+            path = os.path.join(cls.dir, 'random_data{}.npy'.format(i))
+            numpy.save(path, (numpy.random.random((1,30,30,5,1)) * 256).astype(numpy.uint8))
+            cls.BATCH_INPUTS.append(path)
+
+        cls.create_new_tst_project()
+
+    @classmethod
+    def teardownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    @classmethod
+    def create_new_tst_project(cls):
+        shell = HeadlessShell()
+        newProjectFile = ProjectManager.createBlankProjectFile(cls.PROJECT_FILE, PixelClassificationWorkflow, [])
+        newProjectFile.close()
+        shell.openProjectFile(cls.PROJECT_FILE)
+        workflow = shell.workflow
+
+        from ilastik.applets.dataSelection.opDataSelection import DatasetInfo
+        info = DatasetInfo()
+        info.filePath = cls.BATCH_INPUTS[0]
+        opDataSelection = workflow.dataSelectionApplet.topLevelOperator
+        opDataSelection.DatasetGroup.resize(1)
+        opDataSelection.DatasetGroup[0][0].setValue(info)
+
+        opFeatures = workflow.featureSelectionApplet.topLevelOperator
+        opFeatures.Scales.setValue( [0.3, 0.7] )
+        opFeatures.FeatureIds.setValue( ['GaussianSmoothing'] )
+        opFeatures.SelectionMatrix.setValue( numpy.array( [[True, True]] ) )
+
+        opPixelClass = workflow.pcApplet.topLevelOperator
+        opPixelClass.LabelNames.setValue(['Label 1', 'Label 2'])
+
+        slicing1 = sl[0:1,0:10,0:10,0:1,0:1]
+        opPixelClass.LabelInputs[0][slicing1] = 1 * numpy.ones(slicing2shape(slicing1), dtype=numpy.uint8)
+        slicing2 = sl[0:1,0:10,10:20,0:1,0:1]
+        opPixelClass.LabelInputs[0][slicing2] = 2 * numpy.ones(slicing2shape(slicing2), dtype=numpy.uint8)
+
+        shell.projectManager.saveProject()
+        shell.closeCurrentProject()
+
+    def testTwoWorkers(self):
+        argv = [ 'pixelClassificationWorkflowMainHeadless.py',
+                 '--project=' + self.PROJECT_FILE,
+                 '--batch_workers=2',
+                 '--batch_export_dir=' + self.EXPORT_DIR ]
+        argv += self.BATCH_INPUTS
+        assert pixelClassificationWorkflowMainHeadless.main(argv) == 0
+
+        for inputPath in self.BATCH_INPUTS:
+            base = os.path.splitext( os.path.split(inputPath)[1] )[0]
+            outputs = glob.glob( os.path.join(self.EXPORT_DIR, base + '_prediction*.h5') )
+            assert len(outputs) == 1, "Expected one output for {}, found {}".format( inputPath, outputs )
+            with h5py.File(outputs[0], 'r') as f:
+                pred_shape = f['/volume/prediction'].shape
+            assert pred_shape[:-1] == numpy.load(inputPath).shape[:-1], "Prediction volume has wrong shape: {}".format( pred_shape )
+            assert pred_shape[-1] == 2, "Prediction volume has wrong shape: {}".format( pred_shape )
+
+if __name__ == "__main__":
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -2,7 +2,7 @@ import numpy
 from lazyflow.graph import Graph
 from lazyflow.operators import Op5ifyer
 from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels import OpThresholdTwoLevels4d, OpThresholdTwoLevels, \
-                                                                    OpThresholdOneLevel
+                                                                    OpThresholdOneLevel, OpSelectLabels
 
 import ilastik.ilastik_logging
 ilastik.ilastik_logging.default_config.init()
@@ -109,6 +109,29 @@ class TestThresholdOneLevel(object):
         slicing[tIndex]= slice(0, 1, None)
         assert numpy.all(output5d[slicing].squeeze()==output[:].squeeze())
 
+    def testBlockwise(self):
+        g = Graph()
+        oper = OpThresholdOneLevel(graph=g)
+        oper.MinSize.setValue(5)
+        oper.MaxSize.setValue(self.maxSize)
+        oper.Threshold.setValue(0.2)
+        oper.InputImage.setValue(self.data)
+        expected = oper.Output[:].wait()
+        
+        # Objects that cross block boundaries must be stitched before the size filter
+        operBlockwise = OpThresholdOneLevel(graph=g)
+        operBlockwise.MinSize.setValue(5)
+        operBlockwise.MaxSize.setValue(self.maxSize)
+        operBlockwise.Threshold.setValue(0.2)
+        operBlockwise.SpatialBlockShape.setValue({ 'x' : 6, 'y' : 7, 'z' : 8 })
+        operBlockwise.InputImage.setValue(self.data)
+        output = operBlockwise.Output[:].wait()
+        assert numpy.all( (output != 0) == (expected != 0) )
+        
+        # A small request gives the same result as the corresponding part of the whole output
+        subregion = operBlockwise.Output[4:9, 10:15, 8:12, :].wait()
+        assert numpy.all( subregion == output[4:9, 10:15, 8:12, :] )
+
 
 class TestThresholdTwoLevels(object):
     def setUp(self):
@@ -204,6 +227,30 @@ class TestThresholdTwoLevels(object):
         # output is 4d (xyzc), out5d is 5d (xyzct).        
         assert numpy.all(out5d == output[...,numpy.newaxis])
         
+    def testBlockwise(self):
+        g = Graph()
+        oper = OpThresholdTwoLevels4d(graph = g)
+        oper.InputImage.setValue(self.data)
+        oper.MinSize.setValue(self.minSize)
+        oper.MaxSize.setValue(self.maxSize)
+        oper.HighThreshold.setValue(self.highThreshold)
+        oper.LowThreshold.setValue(self.lowThreshold)
+        # Blocks that cut through all clusters
+        oper.SpatialBlockShape.setValue({ 'x' : 6, 'y' : 7, 'z' : 8 })
+        
+        output = oper.Output[:].wait()
+        output = output.reshape((self.nx, self.ny, self.nz))
+        output = output.astype(numpy.bool).astype(numpy.uint8)
+        
+        output2 = self.thresholdTwoLevels(self.data)
+        output2 = output2.astype(numpy.bool).astype(numpy.uint8)
+        assert numpy.all(output==output2)
+        
+        # A small request gives the same result as the corresponding part of the whole output
+        subregion = oper.CachedOutput[4:9, 4:9, 4:9, :].wait()
+        subregion = subregion.reshape((5, 5, 5)).astype(numpy.bool).astype(numpy.uint8)
+        assert numpy.all(subregion==output[4:9, 4:9, 4:9])
+        
     def thresholdTwoLevels(self, data):
         #this function is the same as the operator, but without any lazyflow stuff
         #or memory management
@@ -291,6 +338,36 @@ class TestThresholdTwoLevels(object):
         assert numpy.all(output==output2)
         
         
+
+class TestSelectLabels(object):
+    def setUp(self):
+        data = numpy.random.rand(40, 30, 20)
+        self.bigLabels = vigra.analysis.labelVolumeWithBackground( (data > 0.3).astype(numpy.uint8) )
+        self.smallLabels = vigra.analysis.labelVolumeWithBackground( (data > 0.9).astype(numpy.uint8) )
+        self.bigLabels = self.bigLabels.reshape( self.bigLabels.shape + (1,) )
+        self.smallLabels = self.smallLabels.reshape( self.smallLabels.shape + (1,) )
+        self.bigLabels.axistags = vigra.defaultAxistags('xyzc')
+        self.smallLabels.axistags = vigra.defaultAxistags('xyzc')
+        
+    def testBlockwise(self):
+        g = Graph()
+        op = OpSelectLabels(graph=g)
+        op.BigLabels.setValue(self.bigLabels)
+        op.SmallLabels.setValue(self.smallLabels)
+        # Force many small blocks
+        op.BlockSizeMb = 0.01
+        
+        output = op.Output[:].wait()
+        
+        # Same as processing the whole volume at once
+        prod = (numpy.asarray(self.smallLabels) != 0) * numpy.asarray(self.bigLabels)
+        passed = numpy.unique(prod)
+        all_label_values = numpy.zeros( (self.bigLabels.max()+1,), dtype=numpy.uint8 )
+        for i, l in enumerate(passed):
+            all_label_values[l] = i+1
+        all_label_values[0] = 0
+        expected = all_label_values[ numpy.asarray(self.bigLabels) ]
+        assert (output == expected).all()
         
 if __name__ == "__main__":
     import nose
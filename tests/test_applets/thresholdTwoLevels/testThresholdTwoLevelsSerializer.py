@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+
+import numpy
+import h5py
+import vigra
+
+import ilastik
+from lazyflow.graph import Graph, OperatorWrapper
+from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels import OpThresholdTwoLevels
+from ilastik.applets.thresholdTwoLevels.thresholdTwoLevelsSerializer import ThresholdTwoLevelsSerializer
+
+import ilastik.ilastik_logging
+ilastik.ilastik_logging.default_config.init()
+
+class TestThresholdTwoLevelsSerializer(object):
+    """
+    Projects saved before the thresholding was computed blockwise
+    store the cached output as one block per time slice.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.projectFilePath = os.path.join(self.tmpdir, "project.ilp")
+        self.projectFile = h5py.File(self.projectFilePath, 'w')
+        self.projectFile.create_dataset("ilastikVersion", data=ilastik.__version__)
+
+        self.shape = (2, 40, 30, 20, 1)
+        data = numpy.random.random(self.shape).astype(numpy.float32)
+        self.data = vigra.taggedView(data, 'txyzc')
+
+    def tearDown(self):
+        self.projectFile.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _createOperator(self):
+        # As in ThresholdTwoLevelsApplet
+        op = OperatorWrapper( OpThresholdTwoLevels, graph=Graph(),
+                              broadcastingSlotNames=[ 'MinSize', 'MaxSize', 'HighThreshold', 'LowThreshold',
+                                                      'SmootherSigma', 'CurOperator', 'SingleThreshold', 'Channel' ] )
+        op.InputImage.resize(1)
+        op.InputImage[0].setValue( self.data )
+        # Smaller than the volume, so the internal caches are blockwise
+        op.SpatialBlockShape[0].setValue( { 'x':16, 'y':16, 'z':16 } )
+        return op
+
+    def testLoadSliceBlocks(self):
+        op = self._createOperator()
+        for curOperator in [0, 1]:
+            op.CurOperator.setValue( curOperator )
+            # The cached output as older versions stored it: one dataset per time slice, named after its roi
+            dtype = op.CachedOutput[0].meta.dtype
+            stored = numpy.random.randint(0, 2, size=self.shape).astype(dtype)
+            group = self.projectFile.create_group("ThresholdTwoLevels")
+            group.create_dataset("StorageVersion", data="0.1")
+            group.create_dataset("CurOperator", data=curOperator)
+            lane = group.create_group("CachedThresholdOutput").create_group("0000")
+            for t in range(self.shape[0]):
+                blockRoi = [ (t, 0, 0, 0, 0), (t+1,) + self.shape[1:] ]
+                lane.create_dataset( str(blockRoi), data=stored[t:t+1] )
+
+            ThresholdTwoLevelsSerializer( op, "ThresholdTwoLevels" ).deserializeFromHdf5( self.projectFile, self.projectFilePath )
+
+            # The stored blocks are used as they are, nothing is recomputed
+            assert ( op.CachedOutput[0][:].wait() == stored ).all()
+            assert sorted( (tuple(start), tuple(stop)) for start, stop in op.CleanBlocks[0].value ) == \
+                   [ ( (t, 0, 0, 0, 0), (t+1,) + self.shape[1:] ) for t in range(self.shape[0]) ]
+
+            del self.projectFile["ThresholdTwoLevels"]
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,75 @@
+import sys
+import numpy as np
+
+from ilastik.applets.tracking.base.trackingUtilities import relabel, relabelMergers, relabelLut, applyLut
+
+# The original implementations, which looped over the labels in the volume
+def referenceRelabel(volume, replace):
+    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
+    mp[1:] = 1
+    labels = np.unique(volume)
+    for label in labels:
+        if label > 0:
+            try:
+                r = replace[label]
+                mp[label] = r
+            except:
+                pass
+    return mp[volume]
+
+def referenceRelabelMergers(volume, merger):
+    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
+    mp[:] = 0
+    labels = np.unique(volume)
+    for label in labels:
+        if label > 0:
+            if label in merger:
+                mp[label] = merger[label]
+            else:
+                mp[label] = 1
+    return mp[volume]
+
+def randomCase(rng):
+    """
+    A random label volume and a random replacement dict, which may contain
+    background, labels that are not in the volume and labels beyond its maximum.
+    """
+    dtype = rng.choice([np.uint8, np.uint16, np.uint32])
+    maxLabel = rng.randint(0, 200)
+    shape = tuple( rng.randint(1, 12, size=rng.randint(1, 4)) )
+    volume = rng.randint(0, maxLabel + 1, size=shape).astype(dtype)
+    keys = rng.randint(0, maxLabel + 20, size=rng.randint(0, 50))
+    replace = dict( (int(k), int(v)) for k, v in zip(keys, rng.randint(0, 256, size=len(keys))) )
+    return volume, replace
+
+class TestRelabel(object):
+    def testRelabel(self):
+        rng = np.random.RandomState(0)
+        for i in range(200):
+            volume, replace = randomCase(rng)
+            result = relabel(volume, replace)
+            assert result.dtype == volume.dtype
+            assert (result == referenceRelabel(volume, replace)).all(), "Case {} differs".format(i)
+
+    def testRelabelMergers(self):
+        rng = np.random.RandomState(1)
+        for i in range(200):
+            volume, merger = randomCase(rng)
+            result = relabelMergers(volume, merger)
+            assert result.dtype == volume.dtype
+            assert (result == referenceRelabelMergers(volume, merger)).all(), "Case {} differs".format(i)
+
+    def testReusedLut(self):
+        # A lut is re-used for other volumes (e.g. time slices), which may contain larger labels
+        rng = np.random.RandomState(2)
+        replace = { 1 : 5, 3 : 7, 10 : 2 }
+        lut = relabelLut(replace, dtype=np.uint32)
+        for i in range(20):
+            volume = rng.randint(0, 30, size=(8, 9)).astype(np.uint32)
+            assert (applyLut(volume, lut) == referenceRelabel(volume, replace)).all()
+
+if __name__ == "__main__":
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,92 @@
+import sys
+import numpy
+
+from lazyflow.graph import Graph, Operator, OutputSlot
+from lazyflow.rtype import List
+from lazyflow.stype import Opaque
+
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.tracking.chaingraph.opChaingraphTracking import OpChaingraphTracking
+
+class OpCountingFeatures(Operator):
+    """
+    Provides fixed region features for each timestep and counts how often they are requested.
+    """
+    Output = OutputSlot(stype=Opaque, rtype=List)
+
+    def __init__(self, features, *args, **kwargs):
+        super(OpCountingFeatures, self).__init__(*args, **kwargs)
+        self.features = features
+        self.requestCount = 0
+
+    def setupOutputs(self):
+        self.Output.meta.shape = (len(self.features),)
+        self.Output.meta.dtype = object
+
+    def execute(self, slot, subindex, roi, result):
+        self.requestCount += 1
+        return dict( (t, self.features[t]) for t in roi )
+
+    def propagateDirty(self, slot, subindex, roi):
+        pass
+
+def regionFeatures(centers, counts):
+    # Row 0 is the background object
+    return { default_features_key : { 'RegionCenter' : numpy.array( [[0,0,0]] + centers, dtype=numpy.float32 ),
+                                      'Count' : numpy.array( [[0]] + [[c] for c in counts], dtype=numpy.float32 ) } }
+
+class TestTraxelstoreCache(object):
+    def setUp(self):
+        graph = Graph()
+        features = [ regionFeatures( [[1,1,0], [5,5,0], [8,8,0]], [10, 20, 300] ),
+                     regionFeatures( [[2,2,0], [6,6,0]], [15, 25] ) ]
+        self.opFeatures = OpCountingFeatures( features, graph=graph )
+        self.op = OpChaingraphTracking( graph=graph )
+        self.op.ObjectFeatures.connect( self.opFeatures.Output )
+
+    def _generate(self, size_range=(0,100)):
+        median_object_size = [0]
+        ts, empty_frame = self.op._generate_traxelstore( [0,1], (0,10), (0,10), (0,1), size_range,
+                                                         median_object_size=median_object_size )
+        return ts, empty_frame, median_object_size[0]
+
+    def testReuse(self):
+        ts1, empty_frame, median = self._generate()
+        assert self.opFeatures.requestCount == 1
+        assert not empty_frame
+        assert median == 17.5
+        assert self.op.FilteredLabels.value == { '0' : [3] }
+
+        # Same parameters: the traxels are reused, but each call gets its own TraxelStore
+        self.op.FilteredLabels.setValue( {} )
+        ts2, empty_frame, median = self._generate()
+        assert self.opFeatures.requestCount == 1
+        assert ts2 is not ts1
+        assert not empty_frame
+        assert median == 17.5
+        assert self.op.FilteredLabels.value == { '0' : [3] }
+
+        # Changed parameters: the traxels are rebuilt
+        ts3, empty_frame, median = self._generate( size_range=(0,1000) )
+        assert self.opFeatures.requestCount == 2
+        assert median == 20
+        assert self.op.FilteredLabels.value == {}
+
+        # Changed features: the traxels are rebuilt
+        # (The operator isn't configured without a LabelImage, so call propagateDirty directly)
+        self.op.propagateDirty( self.op.ObjectFeatures, (), None )
+        self._generate( size_range=(0,1000) )
+        assert self.opFeatures.requestCount == 3
+
+    def testMedianOfReusedTraxels(self):
+        # The first call doesn't ask for the median, a later call with the same parameters does
+        self.op._generate_traxelstore( [0,1], (0,10), (0,10), (0,1), (0,100) )
+        ts, empty_frame, median = self._generate()
+        assert self.opFeatures.requestCount == 1
+        assert median == 17.5
+
+if __name__ == "__main__":
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
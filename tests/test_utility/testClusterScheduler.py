@@ -0,0 +1,126 @@
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+from ilastik.clusterScheduler import TaskScheduler, LocalTaskProcess
+
+class TestTaskScheduler(object):
+    """
+    Runs the scheduler against localhost subprocesses.
+    Each task 'finishes' its block by creating a file named after the task.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _done(self, key):
+        return os.path.exists( os.path.join(self.tmpdir, key + '.done') )
+
+    def _command(self, key, script):
+        """Make a command that runs the given python snippet with 'done' and 'counter' paths defined."""
+        script = "done = {!r}; counter = {!r}\n".format( os.path.join(self.tmpdir, key + '.done'),
+                                                         os.path.join(self.tmpdir, key + '.count') ) + script
+        scriptPath = os.path.join(self.tmpdir, key + '.py')
+        with open(scriptPath, 'w') as f:
+            f.write(script)
+        return '"{}" "{}"'.format( sys.executable, scriptPath )
+
+    def _scheduler(self, **kwargs):
+        return TaskScheduler( LocalTaskProcess, self._done, poll_interval_secs=0.05, **kwargs )
+
+    def testAllFinish(self):
+        commands = dict( ("t{}".format(i), self._command("t{}".format(i), "open(done, 'w').close()")) for i in range(5) )
+        durations, failed = self._scheduler(max_concurrent=2).run( commands )
+        assert failed == []
+        assert set(durations.keys()) == set(commands.keys())
+
+    # Fails on the first attempt, succeeds on the second
+    FLAKY = """
+import os
+attempts = int(open(counter).read()) if os.path.exists(counter) else 0
+open(counter, 'w').write(str(attempts+1))
+if attempts > 0:
+    open(done, 'w').close()
+"""
+
+    def testRetry(self):
+        commands = { 'flaky' : self._command('flaky', self.FLAKY) }
+        durations, failed = self._scheduler(max_retries=1).run( commands )
+        assert failed == []
+        assert 'flaky' in durations
+
+    def testRetryLimit(self):
+        commands = { 'broken' : self._command('broken', "import sys; sys.exit(1)") }
+        durations, failed = self._scheduler(max_retries=2).run( commands )
+        assert failed == ['broken']
+        assert durations == {}
+
+    # Hangs on the first attempt, succeeds on the second
+    HANGING = """
+import os, time
+attempts = int(open(counter).read()) if os.path.exists(counter) else 0
+open(counter, 'w').write(str(attempts+1))
+if attempts == 0:
+    time.sleep(60)
+open(done, 'w').close()
+"""
+
+    def testTimeout(self):
+        commands = { 'hanging' : self._command('hanging', self.HANGING) }
+        durations, failed = self._scheduler(timeout_secs=1, max_retries=1).run( commands )
+        assert failed == []
+        assert durations['hanging'] < 30
+
+    def testStraggler(self):
+        commands = dict( ("t{}".format(i), self._command("t{}".format(i), "open(done, 'w').close()")) for i in range(4) )
+        commands['straggler'] = self._command('straggler', self.HANGING)
+        # No timeout and no retries: only the speculative copy can finish the straggler.
+        durations, failed = self._scheduler(speculative_fraction=0.5).run( commands )
+        assert failed == []
+        assert durations['straggler'] < 30
+
+    # Submits the task (in the background) and exits right away, like qsub
+    SUBMITTING = """
+import os, time
+attempts = int(open(counter).read()) if os.path.exists(counter) else 0
+open(counter, 'w').write(str(attempts+1))
+if os.fork() == 0:
+    time.sleep(1)
+    open(done, 'w').close()
+"""
+
+    def testSubmitted(self):
+        commands = { 'submitted' : self._command('submitted', self.SUBMITTING) }
+        durations, failed = self._scheduler(launch_submits=True, timeout_secs=30, max_retries=2).run( commands )
+        assert failed == []
+        # The exit of the submission is not a failure, so the task is only submitted once.
+        assert open( os.path.join(self.tmpdir, 'submitted.count') ).read() == '1'
+
+    def testSubmittedRequiresTimeout(self):
+        try:
+            self._scheduler(launch_submits=True)
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected a ValueError"
+
+    def testNoHandle(self):
+        # A launch function that runs the task to its end and returns no handle.
+        def launch(command):
+            subprocess.call( command, shell=True )
+            return None
+        commands = { 'ok' : self._command('ok', "open(done, 'w').close()"),
+                     'broken' : self._command('broken', "import sys; sys.exit(1)") }
+        durations, failed = TaskScheduler( launch, self._done, poll_interval_secs=0.05, max_retries=1 ).run( commands )
+        assert failed == ['broken']
+        assert durations.keys() == ['ok']
+
+if __name__ == "__main__":
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,37 @@
+import sys
+import argparse
+
+from lazyflow.graph import Graph
+from ilastik.clusterOps import OpClusterize
+
+class TestValidateConfig(object):
+    def _validate(self, **options):
+        config = { 'use_node_local_scratch' : False,
+                   'node_output_compression_cmd' : None,
+                   'node_output_decompression_cmd' : None,
+                   'task_speculative_fraction' : None }
+        config.update( options )
+        op = OpClusterize( graph=Graph() )
+        op._config = argparse.Namespace( **config )
+        try:
+            op._validateConfig()
+        except AssertionError:
+            return False
+        return True
+
+    def testSpeculativeCopies(self):
+        assert self._validate( task_speculative_fraction=0.1, use_node_local_scratch=True )
+        # Without node local scratch, the copies of a task would write the same output blocks
+        assert not self._validate( task_speculative_fraction=0.1 )
+
+    def testCompression(self):
+        assert self._validate( use_node_local_scratch=True, node_output_compression_cmd="gzip",
+                               node_output_decompression_cmd="gunzip" )
+        assert not self._validate( node_output_compression_cmd="gzip", node_output_decompression_cmd="gunzip" )
+        assert not self._validate( use_node_local_scratch=True, node_output_compression_cmd="gzip" )
+
+if __name__ == "__main__":
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy
+import h5py
+
+from ilastik.utility.h5HandlePool import H5HandlePool
+
+class TestH5HandlePool(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.tmpdir, "feature{}.h5".format(i))
+            with h5py.File(path, 'w') as f:
+                f['data'] = i + numpy.arange(60, dtype=numpy.float32).reshape(3,4,5)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testRead(self):
+        pool = H5HandlePool()
+        assert pool.getShapeAndDtype(self.paths[0], 'data') == ((3,4,5), numpy.float32)
+        data = pool.read(self.paths[1], 'data', numpy.s_[1:3, 0:2, :])
+        assert (data == 1 + numpy.arange(60).reshape(3,4,5)[1:3, 0:2, :]).all()
+
+        # Read directly into one channel of a bigger array
+        out = numpy.zeros((2,2,5,3), dtype=numpy.float32)
+        for i, path in enumerate(self.paths):
+            pool.read(path, 'data', numpy.s_[1:3, 0:2, :], out, numpy.s_[..., i])
+        for i in range(3):
+            assert (out[..., i] == i + numpy.arange(60).reshape(3,4,5)[1:3, 0:2, :]).all()
+        pool.close()
+
+    def testMaxOpenFiles(self):
+        pool = H5HandlePool(maxOpenFiles=2)
+        for path in self.paths:
+            pool.read(path, 'data', numpy.s_[0,0,0])
+        assert len(pool._entries) == 2
+        # Closed files are opened again
+        assert pool.read(self.paths[0], 'data', numpy.s_[0,0,0]) == 0
+        pool.close()
+
+    def testReplacedFile(self):
+        pool = H5HandlePool()
+        assert pool.read(self.paths[0], 'data', numpy.s_[0,0,0]) == 0
+
+        # mtime has a resolution of 1 second on some filesystems
+        time.sleep(1.1)
+        os.remove(self.paths[0])
+        with h5py.File(self.paths[0], 'w') as f:
+            f['data'] = numpy.ones((3,4,5), dtype=numpy.float32)
+        assert pool.read(self.paths[0], 'data', numpy.s_[0,0,0]) == 1
+        pool.close()
+
+if __name__ == "__main__":
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,112 @@
+import os
+import sys
+import shutil
+import tempfile
+import collections
+
+import numpy
+import h5py
+
+from ilastik.clusterOps import NodeScratchStager, compressedBlockPath, decompressStagedBlock
+
+class BlockFileset(object):
+    """
+    The parts of the BlockwiseFileset interface that NodeScratchStager uses:
+    2D uint8 blocks of 10x10, each one stored in its own file.
+    """
+    PathComponents = collections.namedtuple( 'PathComponents', 'externalPath filename internalPath' )
+    Description = collections.namedtuple( 'Description', 'dtype chunks' )
+
+    def __init__(self, baseDir):
+        self.baseDir = baseDir
+        self.blockShape = numpy.array( (10,10) )
+        self.description = BlockFileset.Description( 'uint8', None )
+
+    def getEntireBlockRoi(self, coord):
+        start = (numpy.array(coord) // self.blockShape) * self.blockShape
+        return start, start + self.blockShape
+
+    def getDatasetPathComponents(self, blockStart):
+        filename = "block_{}_{}.h5".format( *blockStart )
+        return BlockFileset.PathComponents( os.path.join( self.baseDir, "blocks", filename ), filename, "data" )
+
+class TestNodeScratchStager(object):
+    def setUp(self):
+        self.sharedDir = tempfile.mkdtemp()
+        self.scratchDir = tempfile.mkdtemp()
+        self.fileset = BlockFileset( self.sharedDir )
+
+    def tearDown(self):
+        shutil.rmtree(self.sharedDir)
+        shutil.rmtree(self.scratchDir)
+
+    def _sharedFiles(self):
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.sharedDir):
+            files += filenames
+        return sorted(files)
+
+    def _writeBlocks(self, stager):
+        stager.writeData( ((0,0), (10,5)), numpy.ones((10,5), dtype=numpy.uint8) )
+        stager.writeData( ((0,5), (10,10)), 2*numpy.ones((10,5), dtype=numpy.uint8) )
+        stager.writeData( ((10,0), (20,10)), 3*numpy.ones((10,10), dtype=numpy.uint8) )
+
+    def _checkCommitted(self, stager, blockFiles=["block_0_0.h5", "block_10_0.h5"]):
+        # Nothing reaches the shared storage before commit()
+        assert self._sharedFiles() == []
+        committed = stager.commit()
+        assert sorted( tuple(start) for start in committed ) == [(0,0), (10,0)]
+
+        # Only the committed block files are on the shared storage, and nothing is left on scratch.
+        assert self._sharedFiles() == blockFiles
+        assert os.listdir(self.scratchDir) == []
+
+    def _checkBlocks(self):
+        with h5py.File( self.fileset.getDatasetPathComponents((0,0)).externalPath, 'r' ) as f:
+            assert (f['data'][:, :5] == 1).all()
+            assert (f['data'][:, 5:] == 2).all()
+        with h5py.File( self.fileset.getDatasetPathComponents((10,0)).externalPath, 'r' ) as f:
+            assert (f['data'][:] == 3).all()
+
+    def testCommit(self):
+        stager = NodeScratchStager( self.fileset, self.scratchDir )
+        self._writeBlocks(stager)
+        self._checkCommitted(stager)
+        self._checkBlocks()
+
+    def testCommitCompressed(self):
+        stager = NodeScratchStager( self.fileset, self.scratchDir,
+                                    'gzip -1 --to-stdout "{uncompressed_file}" > "{compressed_file}"' )
+        self._writeBlocks(stager)
+        # Only the compressed files are copied to the shared storage
+        self._checkCommitted(stager, [compressedBlockPath("block_0_0.h5"), compressedBlockPath("block_10_0.h5")])
+
+        decompressionCmd = 'gzip -d --to-stdout "{compressed_file}" > "{uncompressed_file}"'
+        for blockStart in [(0,0), (10,0)]:
+            assert decompressStagedBlock( self.fileset, blockStart, decompressionCmd )
+            assert not decompressStagedBlock( self.fileset, blockStart, decompressionCmd )
+        assert self._sharedFiles() == ["block_0_0.h5", "block_10_0.h5"]
+        self._checkBlocks()
+
+    def testWriteAcrossBlocks(self):
+        stager = NodeScratchStager( self.fileset, self.scratchDir )
+        try:
+            stager.writeData( ((5,0), (15,10)), numpy.zeros((10,10), dtype=numpy.uint8) )
+        except AssertionError:
+            pass
+        else:
+            assert False, "Expected an AssertionError"
+
+    def testDiscard(self):
+        stager = NodeScratchStager( self.fileset, self.scratchDir )
+        self._writeBlocks(stager)
+        stager.discard()
+        assert self._sharedFiles() == []
+        assert os.listdir(self.scratchDir) == []
+        assert stager.commit() == []
+
+if __name__ == "__main__":
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
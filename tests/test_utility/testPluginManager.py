@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+from ilastik.plugins import LazyPluginManager, ObjectFeaturesPlugin
+
+PLUGIN_INFO = """
+[Core]
+Name = {name}
+Module = {module}
+
+[Documentation]
+Description = {name} for testing
+"""
+
+PLUGIN_MODULE = """
+from ilastik.plugins import ObjectFeaturesPlugin
+
+class {cls}(ObjectFeaturesPlugin):
+    def availableFeatures(self, image, labels):
+        return {{"{cls}Feature" : {{}}}}
+"""
+
+class TestLazyPluginManager(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.plugin_dir = os.path.join(self.tmpdir, "plugins")
+        os.mkdir(self.plugin_dir)
+        self.manifest_path = os.path.join(self.tmpdir, "manifest.json")
+        for name, module, cls in [("First Features", "first_feats", "FirstFeats"),
+                                  ("Second Features", "second_feats", "SecondFeats")]:
+            with open(os.path.join(self.plugin_dir, module + ".yapsy-plugin"), 'w') as f:
+                f.write(PLUGIN_INFO.format(name=name, module=module))
+            with open(os.path.join(self.plugin_dir, module + ".py"), 'w') as f:
+                f.write(PLUGIN_MODULE.format(cls=cls))
+
+    def tearDown(self):
+        for name in ["First_Features", "Second_Features"]:
+            sys.modules.pop("ilastik_plugin_" + name, None)
+        shutil.rmtree(self.tmpdir)
+
+    def _manager(self):
+        return LazyPluginManager( [self.plugin_dir], {"ObjectFeatures" : ObjectFeaturesPlugin}, self.manifest_path )
+
+    def testOnlySelectedPluginIsImported(self):
+        manager = self._manager()
+        assert not os.path.exists(self.manifest_path), "Nothing should happen before the first use"
+
+        plugin = manager.getPluginByName("First Features", "ObjectFeatures")
+        assert plugin.name == "First Features"
+        assert plugin.plugin_object.availableFeatures(None, None).keys() == ["FirstFeatsFeature"]
+        assert "ilastik_plugin_First_Features" in sys.modules
+        assert "ilastik_plugin_Second_Features" not in sys.modules
+
+        assert manager.getPluginByName("Unknown Features", "ObjectFeatures") is None
+
+        plugins = manager.getPluginsOfCategory("ObjectFeatures")
+        assert [p.name for p in plugins] == ["First Features", "Second Features"]
+        assert "ilastik_plugin_Second_Features" in sys.modules
+
+    def testManifest(self):
+        self._manager().collectPlugins()
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        assert sorted(p["name"] for p in manifest["plugins"]) == ["First Features", "Second Features"]
+
+        # The manifest is used as long as the directory is unchanged
+        manager = self._manager()
+        def scan():
+            assert False, "The plugin directory should not be scanned again"
+        manager._scanDirectories = scan
+        assert manager.getPluginByName("Second Features", "ObjectFeatures") is not None
+
+        # A changed directory is scanned again
+        os.remove(os.path.join(self.plugin_dir, "first_feats.yapsy-plugin"))
+        mtime = os.path.getmtime(self.plugin_dir)
+        os.utime(self.plugin_dir, (mtime + 10, mtime + 10))
+        manager = self._manager()
+        assert manager.getPluginByName("First Features", "ObjectFeatures") is None
+        assert manager.getPluginByName("Second Features", "ObjectFeatures") is not None
+
+if __name__ == "__main__":
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)